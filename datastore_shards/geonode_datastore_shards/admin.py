@@ -20,7 +20,7 @@
 
 from django.contrib import admin
 
-from .models import Database
+from .models import Database, PooledDatabase
 
 
 class DatabaseAdmin(admin.ModelAdmin):
@@ -28,3 +28,10 @@ class DatabaseAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Database, DatabaseAdmin)
+
+
+class PooledDatabaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created_at', )
+
+
+admin.site.register(PooledDatabase, PooledDatabaseAdmin)
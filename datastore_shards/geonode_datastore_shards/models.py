@@ -21,7 +21,7 @@
 from geonode.layers.models import Layer
 
 from django.db import models
-from django.db.models import signals
+from django.db.models import F, signals
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -47,16 +47,37 @@ class Database(models.Model):
         verbose_name_plural = 'Shard Databases'
 
 
+class PooledDatabase(models.Model):
+    """
+    A model representing an empty PostGIS database, ready to be claimed as a shard.
+    """
+    name = models.TextField(_("Pooled Database Name"), unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'Pooled Databases'
+
+
 def update_shard_layers_count(instance, sender, **kwargs):
     """
     Update layers_count for Database model.
     """
     store_name = instance.store
+    shardatabase = Database.objects.filter(name=store_name).first()
+    if shardatabase is None:
+        return
+    if shardatabase.strategy_type == Database.LAYERCOUNT:
+        # layercount shards count the slots reserved by get_shard_database_name
+        from .utils import consume_shard_reservation
+        shards = Database.objects.filter(pk=shardatabase.pk)
+        if kwargs.get('signal') is signals.post_delete:
+            shards.filter(layers_count__gt=0).update(layers_count=F('layers_count') - 1)
+        elif kwargs.get('created') and not consume_shard_reservation(store_name):
+            shards.update(layers_count=F('layers_count') + 1)
+        return
     # if layer is part of a shards we need to increment layers_count
-    if Database.objects.filter(name=store_name).exists():
-        shardatabase = Database.objects.get(name=store_name)
-        shardatabase.layers_count = Layer.objects.filter(store=store_name).count()
-        shardatabase.save()
+    shardatabase.layers_count = Layer.objects.filter(store=store_name).count()
+    shardatabase.save()
 
 
 signals.post_delete.connect(update_shard_layers_count, sender=Layer)
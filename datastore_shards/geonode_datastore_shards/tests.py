@@ -26,15 +26,20 @@ import dj_database_url
 import gisdata
 import mock
 import logging
+from psycopg2 import connect
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import connection
 
 from geonode.geoserver.signals import gs_catalog
 from geonode.layers.models import Layer
 from geonode.layers.utils import file_upload
 
-from .models import Database
+from .models import Database, PooledDatabase
+from . import utils
+from .utils import (
+    consume_shard_reservation, drop_postgis_shard, get_shard_database_name, provision_shard_pool)
 
 logger = logging.getLogger(__name__)
 
@@ -88,6 +93,9 @@ class DatastoreShardsCoreTest(GeoNodeBaseTestSupport):
         settings.SHARD_STRATEGY = 'layercount'
         settings.SHARD_LAYER_COUNT = SHARD_LAYER_COUNT
         settings.SHARD_PREFIX = SHARD_PREFIX
+        utils._current_shard.clear()
+        utils._reservations.db_name = None
+        utils._shard_pool.clear()
 
     def tearDown(self):
         super(GeoNodeBaseTestSupport, self).tearDown()
@@ -231,3 +239,96 @@ class DatastoreShardsCoreTest(GeoNodeBaseTestSupport):
         self.assertEqual(
             Database.objects.get(name='%s197103' % SHARD_PREFIX).layers_count, 0
         )
+
+    @mock.patch('geonode_datastore_shards.tasks.provision_shard_pool.delay')
+    def test_shard_pool(self, mock_delay):
+        """
+        Test shards claimed from the SHARD_POOL_SIZE pool.
+        """
+        settings.SHARD_STRATEGY = 'layercount'
+        settings.SHARD_POOL_SIZE = 2
+        try:
+            provision_shard_pool()
+            self.assertEqual(PooledDatabase.objects.count(), 2)
+            pooled_name = PooledDatabase.objects.order_by('created_at').first().name
+
+            # the new shard claims the oldest pooled database
+            db_name = get_shard_database_name()
+            self.assertEqual(db_name, '%s00000' % SHARD_PREFIX)
+            self.assertEqual(PooledDatabase.objects.count(), 1)
+            self.assertFalse(PooledDatabase.objects.filter(name=pooled_name).exists())
+            mock_delay.assert_called_once_with()
+
+            provision_shard_pool()
+            self.assertEqual(PooledDatabase.objects.count(), 2)
+        finally:
+            settings.SHARD_POOL_SIZE = 0
+            drop_postgis_shard('%s00000' % SHARD_PREFIX)
+            for pooled_database in PooledDatabase.objects.all():
+                drop_postgis_shard(pooled_database.name)
+                pooled_database.delete()
+
+    @mock.patch('geonode_datastore_shards.tasks.provision_shard_pool.delay')
+    def test_shard_pool_initial_fill(self, mock_delay):
+        """
+        Test the fill of the SHARD_POOL_SIZE pool scheduled by the first shard request.
+        """
+        settings.SHARD_STRATEGY = 'layercount'
+        settings.SHARD_POOL_SIZE = 1
+        try:
+            db_name = get_shard_database_name()
+            mock_delay.assert_called_once_with()
+            consume_shard_reservation(db_name)
+            # the pool is checked once per process
+            get_shard_database_name()
+            mock_delay.assert_called_once_with()
+        finally:
+            settings.SHARD_POOL_SIZE = 0
+            drop_postgis_shard('%s00000' % SHARD_PREFIX)
+
+    def test_shard_pool_lock(self):
+        """
+        Test that the SHARD_POOL_SIZE pool is provisioned by a single process at a time.
+        """
+        settings.SHARD_POOL_SIZE = 1
+        db = connection.settings_dict
+        conn = connect(dbname=db['NAME'], user=db['USER'], host=db['HOST'] or None,
+                       port=db['PORT'] or None, password=db['PASSWORD'])
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_advisory_lock(%s);', [utils.SHARD_POOL_LOCK_KEY])
+            # the pool is being provisioned by the other connection
+            provision_shard_pool()
+            self.assertEqual(PooledDatabase.objects.count(), 0)
+        finally:
+            settings.SHARD_POOL_SIZE = 0
+            conn.close()
+
+    def test_layercount_reservations(self):
+        """
+        Test the layer slots reserved in the "layercount" shards.
+        """
+        shard_names = ['%s0000%s' % (SHARD_PREFIX, i) for i in (0, 1)]
+        try:
+            db_name = get_shard_database_name()
+            self.assertEqual(db_name, shard_names[0])
+            # the pending reservation is returned until a layer uses it
+            with self.assertNumQueries(0):
+                self.assertEqual(get_shard_database_name(), db_name)
+            self.assertEqual(Database.objects.get(name=db_name).layers_count, 1)
+            self.assertTrue(consume_shard_reservation(db_name))
+            self.assertFalse(consume_shard_reservation(db_name))
+
+            # reserving a slot in the cached current shard is a single query
+            with self.assertNumQueries(1):
+                self.assertEqual(get_shard_database_name(), shard_names[0])
+            consume_shard_reservation(db_name)
+            self.assertEqual(Database.objects.get(name=db_name).layers_count, SHARD_LAYER_COUNT)
+
+            # the full shard is never overfilled
+            self.assertEqual(get_shard_database_name(), shard_names[1])
+            self.assertEqual(Database.objects.get(name=shard_names[0]).layers_count, SHARD_LAYER_COUNT)
+            self.assertEqual(Database.objects.get(name=shard_names[1]).layers_count, 1)
+        finally:
+            for shard_name in shard_names:
+                drop_postgis_shard(shard_name)
@@ -19,21 +19,32 @@
 #########################################################################
 
 
+import uuid
 import datetime
 import logging
+import threading
 from psycopg2 import connect
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import dj_database_url
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
 
-from geonode.layers.models import Layer
-
-from .models import Database
+from .models import Database, PooledDatabase
 
 
 logger = logging.getLogger(__name__)
 
+# process-wide cache of the current "layercount" shard
+_current_shard = {}
+# layer slots reserved by the current thread and not used yet
+_reservations = threading.local()
+# process-wide state of the PostGIS databases pool
+_shard_pool = {}
+# key of the PostgreSQL advisory lock taken while provisioning the pool
+SHARD_POOL_LOCK_KEY = 7301912
+
 
 def get_today():
     # we keep this in a function as we need to mock it in tests
@@ -50,6 +61,7 @@ def get_shard_database_name():
     shard_prefix = getattr(settings, 'SHARD_PREFIX', '')
     shard_suffix = getattr(settings, 'SHARD_SUFFIX', '')
     shard_layer_count = getattr(settings, 'SHARD_LAYER_COUNT', 100)
+    check_shard_pool()
     if shard_strategy == 'monthly':
         db_name = '%s%s%s' % (shard_prefix, get_today().strftime('%Y%m'), shard_suffix)
         create_postgis_shard(db_name, Database.MONTHLY)
@@ -57,54 +69,200 @@ def get_shard_database_name():
         db_name = '%s%s%s' % (shard_prefix, get_today().strftime('%Y'), shard_suffix)
         create_postgis_shard(db_name, Database.YEARLY)
     if shard_strategy == 'layercount':
-        shard_numeric_code = Database.objects.filter(strategy_type=Database.LAYERCOUNT).count()
-        if shard_numeric_code > 0:
-            # Do we really need a new shard?
-            last_store_name = Database.objects.filter(strategy_type=Database.LAYERCOUNT).order_by('-created_at')[0].name
-            if Layer.objects.filter(store=last_store_name).count() < shard_layer_count:
-                shard_numeric_code -= 1
-        db_name = '%s%05d%s' % (shard_prefix, shard_numeric_code, shard_suffix)
-        if Database.objects.filter(name=db_name).count() == 0:
-            create_postgis_shard(db_name, Database.LAYERCOUNT)
+        db_name = get_layercount_shard_name(shard_prefix, shard_suffix, shard_layer_count)
     return db_name
 
 
+def get_layercount_shard_name(shard_prefix, shard_suffix, shard_layer_count):
+    """
+    Reserve a layer slot in the current "layercount" shard, moving to the next shard when it is full.
+    The reservation is an atomic conditional increment of Database.layers_count, so concurrent
+    uploads cannot overfill a shard. Further calls in the same thread return the pending
+    reservation until the layer is saved (see consume_shard_reservation).
+    """
+    pending = getattr(_reservations, 'db_name', None)
+    if pending:
+        return pending
+    shard = _current_shard.get('shard') or _get_last_layercount_shard()
+    while True:
+        if shard is None:
+            shard = _get_layercount_shard(0, shard_prefix, shard_suffix)
+        reserved = Database.objects.filter(
+            pk=shard.pk, layers_count__lt=shard_layer_count
+        ).update(layers_count=F('layers_count') + 1)
+        if reserved:
+            break
+        if not Database.objects.filter(pk=shard.pk).exists():
+            # the cached shard has been dropped
+            shard = _get_last_layercount_shard()
+            continue
+        # the shard is full, move to the next one
+        shard_numeric_code = int(shard.name[len(shard_prefix):len(shard.name) - len(shard_suffix)])
+        shard = _get_layercount_shard(shard_numeric_code + 1, shard_prefix, shard_suffix)
+    _current_shard['shard'] = shard
+    _reservations.db_name = shard.name
+    return shard.name
+
+
+def consume_shard_reservation(db_name):
+    """
+    Mark the layer slot reserved by the current thread as used by a layer saved in db_name.
+    Return True if a reservation has been consumed.
+    """
+    if getattr(_reservations, 'db_name', None) == db_name:
+        _reservations.db_name = None
+        return True
+    return False
+
+
+def _get_last_layercount_shard():
+    """
+    Return the most recent "layercount" shard, if any.
+    """
+    return Database.objects.filter(strategy_type=Database.LAYERCOUNT).order_by('-id').first()
+
+
+def _get_layercount_shard(shard_numeric_code, shard_prefix, shard_suffix):
+    """
+    Return the "layercount" shard by numeric code, creating it if it does not exist.
+    """
+    db_name = '%s%05d%s' % (shard_prefix, shard_numeric_code, shard_suffix)
+    create_postgis_shard(db_name, Database.LAYERCOUNT)
+    return Database.objects.filter(name=db_name).first()
+
+
 def create_postgis_shard(db_name, shard_strategy):
     """
     Create a PostGIS shard database by name.
+    A pre-provisioned database is claimed from the pool when available.
     """
     shardatabase, created = Database.objects.get_or_create(name=db_name, strategy_type=shard_strategy)
     if created:
+        try:
+            if claim_pooled_database(db_name):
+                logger.debug("Claimed a pooled PostGIS database for shard: %s" % db_name)
+                refill_shard_pool()
+                return
+        except Exception as e:
+            logger.error(
+                "Error claiming a pooled PostGIS database for shard %s: %s" % (db_name, str(e)))
         logger.debug("Creating a new PostGIS datatase: %s" % db_name)
         try:
-            datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
-            user = datastore_db['USER']
-            host = datastore_db['HOST']
-            port = datastore_db['PORT']
-            password = datastore_db['PASSWORD']
-            # 1. create the database
-            conn = connect(dbname='template1', user=user, host=host, port=port, password=password)
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            cur = conn.cursor()
-            cur.execute('CREATE DATABASE %s;' % db_name)
-            cur.close()
-            conn.close()
-            # 2. enable PostGIS
-            conn = connect(dbname=db_name, user=user, host=host, port=port, password=password)
-            cur = conn.cursor()
-            cur.execute('CREATE EXTENSION postgis;')
-            cur.close()
-            conn.commit()
-            conn.close()
+            create_postgis_database(db_name)
         except Exception as e:
             logger.error(
                 "Error creating PostGIS database shard %s: %s" % (db_name, str(e)))
-        finally:
+
+
+def connect_datastore(db_name):
+    """
+    Open a connection to a database of the DATASTORE_URL server.
+    """
+    datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+    user = datastore_db['USER']
+    host = datastore_db['HOST']
+    port = datastore_db['PORT']
+    password = datastore_db['PASSWORD']
+    return connect(dbname=db_name, user=user, host=host, port=port, password=password)
+
+
+def execute_on_template(statement):
+    """
+    Execute a database level statement (CREATE/ALTER/DROP DATABASE) on template1.
+    """
+    conn = connect_datastore('template1')
+    try:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute(statement)
+        cur.close()
+    finally:
+        conn.close()
+
+
+def create_postgis_database(db_name):
+    """
+    Create a database by name and enable PostGIS on it.
+    """
+    # 1. create the database
+    execute_on_template('CREATE DATABASE %s;' % db_name)
+    # 2. enable PostGIS
+    conn = connect_datastore(db_name)
+    try:
+        cur = conn.cursor()
+        cur.execute('CREATE EXTENSION postgis;')
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def claim_pooled_database(db_name):
+    """
+    Rename the oldest pooled PostGIS database to db_name.
+    Return True if a pooled database has been claimed.
+    """
+    with transaction.atomic():
+        # concurrent uploads claim different databases
+        pooled_database = PooledDatabase.objects.select_for_update(
+            skip_locked=True).order_by('created_at').first()
+        if pooled_database is None:
+            return False
+        execute_on_template('ALTER DATABASE %s RENAME TO %s;' % (pooled_database.name, db_name))
+        pooled_database.delete()
+    return True
+
+
+def provision_shard_pool():
+    """
+    Create empty PostGIS databases until the pool contains SHARD_POOL_SIZE of them.
+    Concurrent calls return at once, while a single one fills the pool.
+    """
+    shard_pool_size = getattr(settings, 'SHARD_POOL_SIZE', 0)
+    shard_prefix = getattr(settings, 'SHARD_PREFIX', '')
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s);', [SHARD_POOL_LOCK_KEY])
+        locked = cursor.fetchone()[0]
+    if not locked:
+        logger.debug("The PostGIS databases pool is being provisioned by another process")
+        return
+    try:
+        while PooledDatabase.objects.count() < shard_pool_size:
+            db_name = '%spool_%s' % (shard_prefix, uuid.uuid4().hex[:12])
+            logger.debug("Creating a pooled PostGIS datatase: %s" % db_name)
             try:
-                if conn:
-                    conn.close()
+                create_postgis_database(db_name)
             except Exception as e:
-                logger.error("Error closing PostGIS conn %s", str(e))
+                logger.error(
+                    "Error creating pooled PostGIS database %s: %s" % (db_name, str(e)))
+                break
+            PooledDatabase.objects.create(name=db_name)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s);', [SHARD_POOL_LOCK_KEY])
+
+
+def check_shard_pool():
+    """
+    Fill the pool of PostGIS databases in background if it is not full, once per process.
+    """
+    shard_pool_size = getattr(settings, 'SHARD_POOL_SIZE', 0)
+    if shard_pool_size > 0 and not _shard_pool.get('checked'):
+        _shard_pool['checked'] = True
+        if PooledDatabase.objects.count() < shard_pool_size:
+            refill_shard_pool()
+
+
+def refill_shard_pool():
+    """
+    Refill the pool of PostGIS databases in background.
+    """
+    if getattr(settings, 'SHARD_POOL_SIZE', 0) > 0:
+        from .tasks import provision_shard_pool as provision_shard_pool_task
+        try:
+            provision_shard_pool_task.delay()
+        except Exception as e:
+            logger.error("Error scheduling the PostGIS databases pool refill: %s" % str(e))
 
 
 def drop_postgis_shard(db_name):
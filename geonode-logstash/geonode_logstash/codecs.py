@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+import six
+import zlib
+import json
+import struct
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Frames of binary payloads are prefixed by their length (4 bytes, big endian)
+FRAME_HEADER = struct.Struct('>I')
+
+
+class JsonCodec(object):
+    """
+    Plain JSON payloads, framed as JSON lines
+    """
+    name = 'json'
+    delimiter = b'\n'
+
+    def encode(self, data):
+        """
+        Serialize the message
+        :param data: dict or serialized json
+        :return: bytes
+        """
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        if isinstance(data, six.string_types):
+            data = data.encode('utf-8')
+        return bytes(data)
+
+    def frame(self, payload):
+        """
+        Frame an encoded message to be written on a stream
+        :param payload: encoded message
+        :return: bytes
+        """
+        if payload.endswith(self.delimiter):
+            return payload
+        return payload + self.delimiter
+
+
+class GzipCodec(JsonCodec):
+    """
+    Gzip compressed payloads, framed by length unless framed is False
+    """
+    name = 'gzip'
+    default_level = 6
+
+    def __init__(self, level=None, framed=True):
+        self.level = self.default_level if level is None else level
+        self.framed = framed
+
+    def encode(self, data):
+        # A new compressor is cheaper than copying the state of a shared one
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(super(GzipCodec, self).encode(data)) + compressor.flush()
+
+    def decode(self, payload):
+        """
+        Decompress an encoded message
+        :param payload: encoded message
+        :return: bytes
+        """
+        return zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+
+    def frame(self, payload):
+        if not self.framed:
+            # Legacy receivers read a bare stream of gzip members
+            return payload
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class ZstdCodec(GzipCodec):
+    """
+    Zstandard compressed payloads, framed by length
+    """
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise ImproperlyConfigured("The 'zstandard' package is required by the zstd codec.")
+        self.level = self.default_level if level is None else level
+        self.framed = True
+        self._compressor = zstandard.ZstdCompressor(level=self.level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, data):
+        return self._compressor.compress(JsonCodec.encode(self, data))
+
+    def decode(self, payload):
+        return self._decompressor.decompress(payload)
+
+
+CODECS = {
+    codec.name: codec for codec in (JsonCodec, GzipCodec, ZstdCodec)
+}
+
+
+def get_codec(name='json', level=None, framed=True):
+    """
+    Codec factory
+    :param name: one of "json", "gzip" or "zstd"
+    :param level: compression level (compressed codecs only)
+    :param framed: False for the unframed gzip payloads of the previous releases (gzip codec only)
+    :return: codec instance
+    """
+    try:
+        codec_class = CODECS[name]
+    except KeyError:
+        raise ImproperlyConfigured("Unknown analytics codec '{}'.".format(name))
+    if codec_class is JsonCodec:
+        return codec_class()
+    if codec_class is GzipCodec:
+        return codec_class(level=level, framed=framed)
+    return codec_class(level=level)
@@ -17,50 +17,51 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 #########################################################################
-import six
-import json
-import gzip
+import copy
 import pytz
-import time
 import socket
+import select
 import logging
-import sqlite3
 import traceback
-import pycountry
 
 from datetime import datetime, timedelta
+from threading import Event, Lock
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.db import connection
 from django.contrib.auth import get_user_model
 # from django_celery_beat.models import PeriodicTask
 
-from geonode.maps.models import Map
-from geonode.layers.models import Layer
-from geonode.documents.models import Document
 from geonode.monitoring.models import EventType
-from geonode.monitoring.collector import CollectorAPI
-from geonode.monitoring.views import ExceptionsListView
 
 from logstash_async import EVENT_CACHE
 from logstash_async.constants import constants
-from logstash_async.database import DatabaseCache
+from logstash_async.database import DatabaseCache, DatabaseLockedError
 from logstash_async.transport import TcpTransport
 from logstash_async.memory_cache import MemoryCache
 from logstash_async.worker import LogProcessingWorker
 from logstash_async.formatter import LogstashFormatter
 from logstash_async.handler import AsynchronousLogstashHandler
 
-from io import StringIO, BytesIO
-
+from .codecs import get_codec
 from .models import (
-    COUNTRIES_GEODB,
-    CentralizedServer
+    CentralizedServer,
+    get_country_center,
+    get_centralized_server_config
 )
 
 log = logging.getLogger(__name__)
 
 IS_ENABLED = settings.MONITORING_ENABLED and settings.USER_ANALYTICS_ENABLED
 GZIP_COMPRESSED = getattr(settings, 'USER_ANALYTICS_GZIP', False)
+CODEC = getattr(settings, 'USER_ANALYTICS_CODEC', 'gzip' if GZIP_COMPRESSED else 'json')
+COMPRESSION_LEVEL = getattr(settings, 'USER_ANALYTICS_COMPRESSION_LEVEL', None)
+GZIP_FRAMED = getattr(settings, 'USER_ANALYTICS_GZIP_FRAMED', True)
+QUERY_WORKERS = getattr(settings, 'USER_ANALYTICS_QUERY_WORKERS', 1)
+MAX_CATCHUP_WINDOWS = getattr(settings, 'USER_ANALYTICS_MAX_CATCHUP_WINDOWS', 48)
 
 DATA_TYPES_MAP = [
     {
@@ -207,6 +208,7 @@ class LogstashDispatcher(object):
         self._handler = None
         self._interval = 0
         self._collector = None
+        self._query_workers = QUERY_WORKERS
         self._init_server()
 
     def _init_server(self):
@@ -224,12 +226,16 @@ class LogstashDispatcher(object):
                 db_path = self._centralized_server.db_path if self._centralized_server.db_path else None
                 self._logger = logging.getLogger('geonode-logstash-logger')
                 self._logger.setLevel(logging.INFO)
+                codec = get_codec(CODEC, COMPRESSION_LEVEL, GZIP_FRAMED)
                 self._handler = GeonodeAsynchronousLogstashHandler(
-                    host, port, database_path=db_path, transport=GeonodeTcpTransport
+                    host, port, database_path=db_path,
+                    transport=partial(GeonodeTcpTransport, codec=codec), codec=codec
                 )
                 self._logger.addHandler(self._handler)
                 # self.client_ip = socket.gethostbyname(socket.gethostname())
                 self.client_ip = self._centralized_server.local_ip
+                # Imported here to keep the module cheap to import
+                from geonode.monitoring.collector import CollectorAPI
                 self._collector = CollectorAPI()
                 self._set_time_range()
         else:
@@ -268,7 +274,7 @@ class LogstashDispatcher(object):
         Configuring the SOCKET_TIMEOUT from the model
         :return: SOCKET_TIMEOUT
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.socket_timeout is not None:
             log.debug(" ---------------------- socket_timeout %s " % cs.socket_timeout)
             return cs.socket_timeout
@@ -281,7 +287,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUE_CHECK_INTERVAL from the model
         :return: QUEUE_CHECK_INTERVAL
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.queue_check_interval is not None:
             return cs.queue_check_interval
         else:
@@ -293,7 +299,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_FLUSH_INTERVAL from the model
         :return: QUEUED_EVENTS_FLUSH_INTERVAL
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.queue_events_flush_interval is not None:
             return cs.queue_events_flush_interval
         else:
@@ -305,7 +311,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_FLUSH_COUNT from the model
         :return: QUEUED_EVENTS_FLUSH_COUNT
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.queue_events_flush_count is not None:
             return cs.queue_events_flush_count
         else:
@@ -317,7 +323,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_BATCH_SIZE from the model
         :return: QUEUED_EVENTS_BATCH_SIZE
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.queue_events_batch_size is not None:
             return cs.queue_events_batch_size
         else:
@@ -329,7 +335,7 @@ class LogstashDispatcher(object):
         Configuring the DATABASE_TIMEOUT from the model
         :return: DATABASE_TIMEOUT
         """
-        cs = LogstashDispatcher._get_centralized_server()
+        cs = get_centralized_server_config()
         if cs and cs.logstash_db_timeout is not None:
             return cs.logstash_db_timeout
         else:
@@ -342,41 +348,58 @@ class LogstashDispatcher(object):
         """
         if self._centralized_server:
             if IS_ENABLED:
-                for data_type in DATA_TYPES_MAP:
-                    try:
-                        msg = self._get_message(data_type)
+                # The events left by a failed run are sent again along with their windows
+                self._discard_queued_events()
+                delivered_to = None
+                # Messages of the catch-up windows are built in parallel and queued in order
+                windows_messages = self._get_windows_messages()
+                for (_from, valid_to), messages in zip(self._windows, windows_messages):
+                    if messages is None:
+                        log.error("The data of the time window could not be retrieved.")
+                        # The next run resumes from this window
+                        break
+                    for msg in messages:
                         print(" ------------------------------------------------ ")
                         print(msg)
-                        if msg:
-                            self._logger.info(msg)
-                            time.sleep(LogstashDispatcher.get_socket_timeout())
-                    except Exception as e:
-                        # Note: it catches exceptions on current thread only
-                        traceback.print_exc()
-                        log.error("Sending data failed: " + str(e))
+                        self._logger.info(msg)
+                    # Each window is delivered before queuing the next one,
+                    # the socket timeout of each message is used as an upper bound
+                    if messages and not self._handler.wait_for_delivery(
+                        timeout=LogstashDispatcher.get_socket_timeout() * len(messages)
+                    ):
+                        log.error("Not all the messages have been delivered to the centralized server.")
+                        # The next run resumes from this window
+                        self._discard_queued_events()
+                        break
+                    delivered_to = valid_to
+                windows_messages.close()
                 # Updating CentralizedServer
-                self._update_server()
+                self._update_server(delivered_to)
             else:
                 log.error("Monitoring/analytics disabled, centralized server cannot be set up.")
         else:
             log.error("Centralized server not found.")
 
-    def _update_server(self):
+    def _discard_queued_events(self):
+        """
+        Discarding the events not delivered yet
+        :return: None
+        """
+        if not self._handler.discard_queued_events(timeout=LogstashDispatcher.get_socket_timeout() * 2):
+            log.error("The queued messages could not be discarded, they may be delivered twice.")
+
+    def _update_server(self, delivered_to=None):
         """
         Updating the CentralizedServer instance
+        :param delivered_to: end of the last time window delivered, if any
         :return: None
         """
-        # We have to wait for db to be updated
-        time.sleep(LogstashDispatcher.get_logstash_db_timeout())
-        # We have to retrieve the "entry_date" of the last event in queue
-        last_event_date = self._handler.get_last_entry_date()
-        if last_event_date:
-            date_time_obj = datetime.strptime(last_event_date, '%Y-%m-%d %H:%M:%S')
-            self._centralized_server.last_failed_deliver = pytz.utc.localize(date_time_obj)
-        else:
-            # If no events in queue then it means all events have been flushed
-            self._centralized_server.last_successful_deliver = self._valid_to
+        if delivered_to:
+            self._centralized_server.last_successful_deliver = delivered_to
+        if delivered_to == self._valid_to:
             self._centralized_server.last_failed_deliver = None
+        else:
+            self._centralized_server.last_failed_deliver = datetime.utcnow().replace(tzinfo=pytz.utc)
         self._centralized_server.next_scheduled_deliver = self._valid_to + timedelta(
             seconds=self._centralized_server.interval
         )
@@ -384,16 +407,90 @@ class LogstashDispatcher(object):
 
     def _set_time_range(self):
         """
-        Set up the time range as valid_to/valid_from and interval
+        Set up the time range as valid_to/valid_from and interval.
+        The time range starts from the last successful deliver (if any) and it is split
+        into windows of "interval" seconds, to catch up with the data not delivered yet.
         :return: None
         """
+        interval = timedelta(seconds=self._centralized_server.interval)
         self._valid_to = datetime.utcnow().replace(tzinfo=pytz.utc)
-        self._valid_from = self._valid_to - timedelta(
-            seconds=self._centralized_server.interval
-        )
+        last_deliver = self._centralized_server.last_successful_deliver
+        if last_deliver and last_deliver < self._valid_to:
+            self._valid_from = last_deliver
+        else:
+            self._valid_from = self._valid_to - interval
         self._valid_from = self._valid_from.replace(tzinfo=pytz.utc)
+        self._windows = []
+        window_from = self._valid_from
+        while window_from < self._valid_to and len(self._windows) < max(MAX_CATCHUP_WINDOWS, 1):
+            window_to = min(window_from + interval, self._valid_to)
+            self._windows.append((window_from, window_to))
+            window_from = window_to
+        # Older windows first, the remaining ones are sent by the next runs
+        self._valid_to = self._windows[-1][1]
         self._interval = (self._valid_to - self._valid_from).total_seconds()
 
+    def _for_window(self, valid_from, valid_to):
+        """
+        Copy of the dispatcher limited to a time window
+        :param valid_from: start of the window
+        :param valid_to: end of the window
+        :return: LogstashDispatcher
+        """
+        dispatcher = copy.copy(self)
+        dispatcher._valid_from = valid_from
+        dispatcher._valid_to = valid_to
+        dispatcher._interval = (valid_to - valid_from).total_seconds()
+        return dispatcher
+
+    def _get_windows_messages(self):
+        """
+        Retrieving the messages of all the time windows,
+        the windows are processed in parallel when USER_ANALYTICS_QUERY_WORKERS > 1
+        :return: generator of messages lists (None for a failed window), in the same order of the windows
+        """
+        windows = [self._for_window(valid_from, valid_to) for valid_from, valid_to in self._windows]
+        workers = min(self._query_workers, len(windows))
+        if workers > 1:
+            for window in windows:
+                # The metrics of the windows are queried in a row, to run a single pool
+                window._query_workers = 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for messages in executor.map(LogstashDispatcher._get_window_messages_in_thread, windows):
+                    yield messages
+        else:
+            for window in windows:
+                yield window._get_window_messages()
+
+    def _get_window_messages_in_thread(self):
+        """
+        Retrieving the messages of the time window from a worker thread
+        :return: messages list, None on failure
+        """
+        try:
+            return self._get_window_messages()
+        finally:
+            # Each thread opens its own DB connection
+            connection.close()
+
+    def _get_window_messages(self):
+        """
+        Retrieving the messages of all the data types for the time window
+        :return: messages list, None if the data of any type could not be retrieved
+        """
+        messages = []
+        for data_type in DATA_TYPES_MAP:
+            try:
+                msg = self._get_message(data_type)
+            except Exception as e:
+                traceback.print_exc()
+                log.error("Sending data failed: " + str(e))
+                # The window is sent as a whole or not at all
+                return None
+            if msg:
+                messages.append(msg)
+        return messages
+
     def _get_message(self, data_type):
         """
         Retrieving data querying the MetricValue model
@@ -416,27 +513,12 @@ class LogstashDispatcher(object):
                 "endTime": self._valid_to.isoformat()
             }
         }
-        # List data container (not used in case of "overview")
-        list_data = []
-        # For each metric we want to execute a query
-        for metric in data_type["metrics"]:
+        # List data container, keyed by name (not used in case of "overview")
+        list_data = OrderedDict()
+        # All the metrics of the data type are retrieved in a row
+        for metric, metrics_data in zip(data_type["metrics"], self._get_metrics_data(data_type)):
             # Name omitted in hooks when retrieving no-list data (es. "overview")
             is_list = "name" in metric["hooks"]
-            group_by = metric["params"]["group_by"] \
-                if "params" in metric and "group_by" in metric["params"] \
-                else None
-            event_type = EventType.get(metric["params"]["event_type"]) \
-                if "params" in metric and "event_type" in metric["params"] \
-                else None
-            # Retrieving data through the CollectorAPI object
-            metrics_data = self._collector.get_metrics_data(
-                metric_name=metric["name"],
-                valid_from=self._valid_from,
-                valid_to=self._valid_to,
-                interval=self._interval,
-                event_type=event_type,
-                group_by=group_by
-            )
             if metrics_data:
                 # data dictionary updating
                 for item in metrics_data:
@@ -447,28 +529,17 @@ class LogstashDispatcher(object):
                         for k, v in metric["hooks"].items()
                     }
                     if "countries" == data_name:
-                        try:
-                            country_iso_3 = pycountry.countries.get(
-                                alpha_3=name_value).alpha_3
-                            center = self._get_country_center(country_iso_3)
-                            item_value['center'] = center or ''
-                        except Exception as e:
-                            log.error(str(e))
+                        item_value['center'] = self._get_country_center(name_value) or ''
                     if is_list:
-                        try:
-                            list_item = filter(
-                                lambda l_item: l_item["name"] == name_value, list_data
-                            )
-                            _idx = list(list_item)[0]
-                            i = list_data.index(_idx)
-                            list_data[i].update(item_value)
-                        except (IndexError, ValueError) as e:
-                            list_data.append(item_value)
+                        if name_value in list_data:
+                            list_data[name_value].update(item_value)
+                        else:
+                            list_data[name_value] = item_value
                     else:
                         data.update(item_value)
                         has_data = True
         if list_data:
-            data.update({data_name: list_data})
+            data.update({data_name: list(list_data.values())})
             has_data = True
         if "extra" in data_type:
             for extra in data_type["extra"]:
@@ -479,6 +550,49 @@ class LogstashDispatcher(object):
                 has_data = True
         return data if has_data else None
 
+    def _get_metrics_data(self, data_type):
+        """
+        Retrieving the data of all the metrics of a data type,
+        the queries run in parallel when USER_ANALYTICS_QUERY_WORKERS > 1
+        :param data_type: field mapping to keep only interesting information
+        :return: list of query results, in the same order of the metrics
+        """
+        metrics = data_type["metrics"]
+        workers = min(self._query_workers, len(metrics))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(self._get_metric_data_in_thread, metrics))
+        return [self._get_metric_data(metric) for metric in metrics]
+
+    def _get_metric_data_in_thread(self, metric):
+        """
+        Retrieving the data of a metric from a worker thread
+        :param metric: metric mapping
+        :return: query results
+        """
+        try:
+            return self._get_metric_data(metric)
+        finally:
+            # Each thread opens its own DB connection
+            connection.close()
+
+    def _get_metric_data(self, metric):
+        """
+        Retrieving the data of a metric through the CollectorAPI object
+        :param metric: metric mapping
+        :return: query results
+        """
+        params = metric.get("params", {})
+        event_type = EventType.get(params["event_type"]) if "event_type" in params else None
+        return self._collector.get_metrics_data(
+            metric_name=metric["name"],
+            valid_from=self._valid_from,
+            valid_to=self._valid_to,
+            interval=self._interval,
+            event_type=event_type,
+            group_by=params.get("group_by")
+        )
+
     @staticmethod
     def _build_data(item, key):
         """
@@ -517,6 +631,7 @@ class LogstashDispatcher(object):
         Retrieving all the existing layers
         :return: layers count
         """
+        from geonode.layers.models import Layer
         return Layer.objects.count()
 
     @staticmethod
@@ -525,6 +640,7 @@ class LogstashDispatcher(object):
         Retrieving all the existing maps
         :return: maps count
         """
+        from geonode.maps.models import Map
         return Map.objects.count()
 
     @staticmethod
@@ -533,6 +649,7 @@ class LogstashDispatcher(object):
         Retrieving all the existing documents
         :return: documents count
         """
+        from geonode.documents.models import Document
         return Document.objects.count()
 
     def _get_errors(self):
@@ -540,6 +657,7 @@ class LogstashDispatcher(object):
         Retrieving errors
         :return: errors count
         """
+        from geonode.monitoring.views import ExceptionsListView
         return ExceptionsListView().get_queryset(
             valid_to=self._valid_to,
             valid_from=self._valid_from,
@@ -547,13 +665,14 @@ class LogstashDispatcher(object):
         ).count()
 
     @staticmethod
-    def _get_country_center(iso_3):
-        output = None
-        for _cnt in COUNTRIES_GEODB:
-            if iso_3 == _cnt['country.iso_3']:
-                output = [float(i) for i in _cnt['country.center']]
-                break
-        return output
+    def _get_country_center(code):
+        """
+        Retrieving the center of a country
+        :param code: ISO-3, ISO-2 code or display name of the country
+        :return: [Lat, Lon] or None if the country is unknown
+        """
+        center = get_country_center(code)
+        return list(center) if center else None
 
     def test_dispatch(self, host=None, port=None):
         """
@@ -574,18 +693,21 @@ class LogstashDispatcher(object):
             test_host = host if host else self._centralized_server.host
             test_port = int(port) if port else self._centralized_server.port
             sock.connect((test_host, test_port))
-            compressed_msg = self._handler.formatter.json_gzip(test_msg)
-            sock.sendall(compressed_msg)
+            codec = self._handler.formatter.codec
+            sock.sendall(codec.frame(codec.encode(test_msg)))
+            sock.close()
 
 
 class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
     """
-    Extends AsynchronousLogstashHandler to allow gzip compression
+    Extends AsynchronousLogstashHandler to allow payloads compression
     """
 
     def __init__(self, *args, **kwargs):
+        codec = kwargs.pop('codec', None)
+        patch_constants()
         super(GeonodeAsynchronousLogstashHandler, self).__init__(*args, **kwargs)
-        self.formatter = GeonodeLogstashFormatter(gzip=GZIP_COMPRESSED)
+        self.formatter = GeonodeLogstashFormatter(codec=codec or get_codec(CODEC, COMPRESSION_LEVEL, GZIP_FRAMED))
 
     def _start_worker_thread(self):
         """
@@ -610,7 +732,7 @@ class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
 
     def _format_record(self, record):
         """
-        Super method overriding to allow gzip compression
+        Super method overriding to allow payloads compression
         :param record: message to be formatted
         :return: formatted message
         """
@@ -625,79 +747,212 @@ class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
         if self._worker_thread_is_running():
             return self._worker_thread.get_last_queued_event_date()
 
+    def wait_for_delivery(self, timeout=None):
+        """
+        Force the flush of the queued events and wait for the worker thread to deliver them
+        :param timeout: maximum number of seconds to wait
+        :return: True if all the queued events have been delivered
+        """
+        if not self._worker_thread_is_running():
+            return False
+        self.flush()
+        return self._worker_thread.wait_until_drained(timeout)
+
+    def discard_queued_events(self, timeout=None):
+        """
+        Discard the queued events not delivered yet
+        :param timeout: maximum number of seconds to wait for the worker thread
+        :return: True if the events have been discarded
+        """
+        if self._worker_thread_is_running():
+            return self._worker_thread.discard_queued_events(timeout)
+        # Events queued by a previous process
+        if self._database_path:
+            GeonodeDatabaseCache(path=self._database_path).delete_all_events()
+        else:
+            GeonodeMemoryCache(cache=EVENT_CACHE).delete_all_events()
+        return True
+
 
 class GeonodeLogstashFormatter(LogstashFormatter):
     """
-    Extends LogstashFormatter to allow gzip compression
+    Extends LogstashFormatter to encode the messages through a codec
     """
 
-    def __init__(self, gzip=False, *args, **kwargs):
+    def __init__(self, gzip=False, codec=None, *args, **kwargs):
         super(GeonodeLogstashFormatter, self).__init__(*args, **kwargs)
-        self._gzip = gzip
+        self.codec = codec or get_codec('gzip' if gzip else 'json')
 
     def format(self, record):
         """
         Super method overriding to allow json compression
         :param record: message
-        :return: gzip compressed message
-        :ref: https://stackoverflow.com/questions/8506897/how-do-i-gzip-compress-a-string-in-python
+        :return: encoded message
         """
         _output = self._serialize(record.msg)
         if _output is None or len(_output) == 0:
             log.error("No record.msg content found!")
             return None
-        if self._gzip:
-            _output = self.json_gzip(_output)
-        return _output
-
-    def json_gzip(self, data):
-        """
-        Gzip compression of serialized json
-        :param j: input json to be compressed
-        :return: compressed object
-        """
-        gzip_j = None
-        if data:
-            try:
-                _out = BytesIO()
-                with gzip.GzipFile(fileobj=_out, mode="wb") as fout:
-                    if isinstance(data, six.string_types):
-                        data = data.encode('UTF-8')
-                    if isinstance(data, dict):
-                        data = json.dumps(data).encode('utf-8')
-                    fout.write(data)
-                    fout.flush()
-                gzip_j = sqlite3.Binary(_out.getvalue())
-            except Exception as e:
-                traceback.print_exc()
-                log.error(str(e))
-        return gzip_j
+        return self.codec.encode(_output)
 
 
 class GeonodeTcpTransport(TcpTransport):
     """
-    Extends TcpTransport to avoid loss of messages
+    Extends TcpTransport to keep the connection open and to send events in batches
     """
 
-    def _send(self, events):
+    _keep_connection = True
+
+    def __init__(self, *args, **kwargs):
+        codec = kwargs.pop('codec', None)
+        super(GeonodeTcpTransport, self).__init__(*args, **kwargs)
+        self._codec = codec or get_codec()
+
+    def send(self, events, use_logging=False):
         """
-        Super method override to avoid loss of messages
+        Super method override to write the whole batch of events at once,
+        the events which could not be written are sent again on a new connection
         :param events: events to be processed
+        :param use_logging: not used
+        :return: None
+        """
+        data, offsets = self._frame_events(events)
+        view = memoryview(data)
+        written = 0
+        retried = False
+        self._create_socket()
+        while written < len(data):
+            try:
+                # Partial writes are detected and resumed from the first byte not written
+                written += self._sock.send(view[written:])
+            except (socket.error, ValueError) as e:
+                self._close(force=True)
+                if retried:
+                    raise
+                retried = True
+                log.debug("Connection to the centralized server lost, reconnecting: %s", e)
+                # Events partially written are sent again from the beginning
+                written = max(offset for offset in offsets if offset <= written)
+                self._create_socket()
+
+    def _create_socket(self):
+        """
+        Super method override to drop connections closed by the server
         :return: None
         """
+        if self._sock is not None and not self._is_connection_alive():
+            self._close(force=True)
+        super(GeonodeTcpTransport, self)._create_socket()
+        if self._sock is not None:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _is_connection_alive(self):
+        """
+        Check whether the persistent connection has been closed by the server
+        :return: False if the server closed the connection
+        """
+        if self._ssl_enable:
+            # SSL sockets cannot be peeked, errors are handled when sending
+            return True
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            if readable:
+                return self._sock.recv(1, socket.MSG_PEEK) != b''
+        except (socket.error, ValueError):
+            return False
+        return True
+
+    def _frame_events(self, events):
+        """
+        Join the events in a single buffer, each of them framed by the codec
+        :param events: events to be framed
+        :return: buffer and offsets of the events within the buffer
+        """
+        frames = []
+        offsets = []
+        size = 0
         for event in events:
-            # To avoid loss of messages we need a short sleep, see the following issues:
-            # https://github.com/eht16/python-logstash-async/issues/22
-            # https://github.com/eht16/python-logstash-async/issues/33
-            time.sleep(0.1)
-            self._send_via_socket(event)
+            if isinstance(event, (bytearray, memoryview)):
+                frame = bytes(event)
+            else:
+                frame = self._convert_data_to_send(event)
+            frame = self._codec.frame(frame)
+            offsets.append(size)
+            frames.append(frame)
+            size += len(frame)
+        offsets.append(size)
+        return b''.join(frames), offsets
 
 
 class GeonodeLogProcessingWorker(LogProcessingWorker):
     """
     Extends LogProcessingWorker to use GeonodeDatabaseCache
+    and to signal when all the queued events have been flushed
     """
 
+    def __init__(self, *args, **kwargs):
+        super(GeonodeLogProcessingWorker, self).__init__(*args, **kwargs)
+        self._drained_event = Event()
+        self._wakeup_event = Event()
+        self._drained_lock = Lock()
+        self._last_flush_failed = False
+        self._discard_event = Event()
+        self._discarded_event = Event()
+
+    def enqueue_event(self, event):
+        """
+        Super method override to reset the drained signal
+        :param event: event to be queued
+        :return: None
+        """
+        with self._drained_lock:
+            super(GeonodeLogProcessingWorker, self).enqueue_event(event)
+            self._drained_event.clear()
+
+    def force_flush_queued_events(self):
+        """
+        Super method override to wake up the worker instead of waiting QUEUE_CHECK_INTERVAL
+        :return: None
+        """
+        super(GeonodeLogProcessingWorker, self).force_flush_queued_events()
+        self._wakeup_event.set()
+
+    def shutdown(self):
+        """
+        Super method override to wake up the worker instead of waiting QUEUE_CHECK_INTERVAL
+        :return: None
+        """
+        super(GeonodeLogProcessingWorker, self).shutdown()
+        self._wakeup_event.set()
+
+    def wait_until_drained(self, timeout=None):
+        """
+        Wait until all the queued events have been flushed
+        :param timeout: maximum number of seconds to wait
+        :return: True if the events have been flushed without errors
+        """
+        drained = self._drained_event.wait(timeout)
+        return drained and not self._last_flush_failed
+
+    def discard_queued_events(self, timeout=None):
+        """
+        Discard the events not delivered yet, from the worker thread
+        :param timeout: maximum number of seconds to wait
+        :return: True if the events have been discarded
+        """
+        self._discarded_event.clear()
+        self._discard_event.set()
+        self._wakeup_event.set()
+        return self._discarded_event.wait(timeout)
+
+    def _delay_processing(self):
+        """
+        Super method override to be woken up by flush/shutdown requests
+        :return: None
+        """
+        self._wakeup_event.wait(constants.QUEUE_CHECK_INTERVAL)
+        self._wakeup_event.clear()
+
     def _setup_database(self):
         """
         Ovverride of the super method to use GeonodeDatabaseCache
@@ -708,10 +963,61 @@ class GeonodeLogProcessingWorker(LogProcessingWorker):
                 path=self._database_path, event_ttl=self._event_ttl
             )
         else:
-            self._database = MemoryCache(
+            self._database = GeonodeMemoryCache(
                 cache=self._memory_cache, event_ttl=self._event_ttl
             )
 
+    def _flush_queued_events(self, force=False):
+        """
+        Super method override to flush all the queued events in a row
+        and to signal when the queue has been drained
+        :param force: flush regardless of QUEUED_EVENTS_FLUSH_INTERVAL/QUEUED_EVENTS_FLUSH_COUNT
+        :return: None
+        """
+        if self._discard_event.is_set():
+            # The internal queue is empty here, all the queued events are in the database
+            try:
+                self._database.delete_all_events()
+            except DatabaseLockedError:
+                # Try again later
+                return
+            self._discard_event.clear()
+            self._reset_flush_counters()
+            self._last_flush_failed = False
+            self._discarded_event.set()
+        if not force and not self._queued_event_interval_reached() and \
+                not self._queued_event_count_reached():
+            return
+        self._clear_flush_event()
+        self._last_flush_failed = False
+        while True:
+            try:
+                queued_events = self._database.get_queued_events()
+            except DatabaseLockedError:
+                # Try again later, the queue is not drained yet
+                return
+            except Exception as e:
+                self._safe_log(u'exception', u'Error retrieving queued events: %s', e, exc=e)
+                self._last_flush_failed = True
+                break
+            if not queued_events:
+                break
+            try:
+                events = [event['event_text'] for event in queued_events]
+                self._send_events(events)
+            except Exception as e:
+                self._safe_log(u'exception', u'An error occurred while sending events: %s', e, exc=e)
+                self._database.requeue_queued_events(queued_events)
+                self._last_flush_failed = True
+                break
+            else:
+                self._delete_queued_events_from_database()
+                self._reset_flush_counters()
+        with self._drained_lock:
+            # Events enqueued meanwhile will be flushed on the next run
+            if self._queue.empty():
+                self._drained_event.set()
+
     def get_last_queued_event_date(self):
         """
         Get the entry date of the last queued event
@@ -739,10 +1045,39 @@ class GeonodeDatabaseCache(DatabaseCache):
             results = cursor.fetchall()
         return results
 
+    def delete_all_events(self):
+        """
+        Delete all the events, queued or pending
+        :return: None
+        """
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM `event`;")
+
+
+class GeonodeMemoryCache(MemoryCache):
+    """
+    Extends MemoryCache to delete all the events
+    """
+
+    def delete_all_events(self):
+        """
+        Delete all the events, queued or pending
+        :return: None
+        """
+        self._cache.clear()
+
 
-constants.SOCKET_TIMEOUT = LogstashDispatcher.get_socket_timeout()
-constants.QUEUE_CHECK_INTERVAL = LogstashDispatcher.get_queue_check_interval()
-constants.QUEUED_EVENTS_FLUSH_INTERVAL = LogstashDispatcher.get_queue_events_flush_interval()
-constants.QUEUED_EVENTS_FLUSH_COUNT = LogstashDispatcher.get_queue_events_flush_count()
-constants.QUEUED_EVENTS_BATCH_SIZE = LogstashDispatcher.get_queue_events_batch_size()
-constants.DATABASE_TIMEOUT = LogstashDispatcher.get_logstash_db_timeout()
+def patch_constants():
+    """
+    Configuring logstash_async constants from the CentralizedServer model.
+    It is called when dispatchers and handlers are set up, instead of at import time,
+    so that importing this module does not hit the database.
+    :return: None
+    """
+    constants.SOCKET_TIMEOUT = LogstashDispatcher.get_socket_timeout()
+    constants.QUEUE_CHECK_INTERVAL = LogstashDispatcher.get_queue_check_interval()
+    constants.QUEUED_EVENTS_FLUSH_INTERVAL = LogstashDispatcher.get_queue_events_flush_interval()
+    constants.QUEUED_EVENTS_FLUSH_COUNT = LogstashDispatcher.get_queue_events_flush_count()
+    constants.QUEUED_EVENTS_BATCH_SIZE = LogstashDispatcher.get_queue_events_batch_size()
+    constants.DATABASE_TIMEOUT = LogstashDispatcher.get_logstash_db_timeout()
@@ -17,12 +17,23 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 #########################################################################
+import time
 import uuid
+import logging
+from threading import Lock
+from types import MappingProxyType
 from django.db import models
 from django.conf import settings
+from django.db.models import signals
 from django.utils.translation import ugettext_noop as _
 # from django_celery_beat.models import PeriodicTask, IntervalSchedule
 
+log = logging.getLogger(__name__)
+
+# Seconds after which the cached CentralizedServer configuration is reloaded anyway,
+# since changes saved by other processes are not notified by signals
+CONFIG_CACHE_TTL = getattr(settings, 'USER_ANALYTICS_CONFIG_TTL', 300)
+
 # center = [Lat, Lon]
 COUNTRIES_GEODB = [
     {
@@ -1981,6 +1992,33 @@ COUNTRIES_GEODB = [
 ]
 
 
+def _build_countries_centers():
+    """
+    Index of the COUNTRIES_GEODB centers by ISO-3, ISO-2 and display name
+    :return: read-only mapping of upper case keys to (Lat, Lon) tuples
+    """
+    centers = {}
+    for _cnt in COUNTRIES_GEODB:
+        center = tuple(float(i) for i in _cnt['country.center'])
+        for key in ('country.display_name', 'country.iso_2', 'country.iso_3'):
+            centers[_cnt[key].upper()] = center
+    return MappingProxyType(centers)
+
+
+COUNTRIES_CENTERS = _build_countries_centers()
+
+
+def get_country_center(code):
+    """
+    Get the center of a country
+    :param code: ISO-3, ISO-2 code or display name of the country
+    :return: (Lat, Lon) tuple or None if the country is unknown
+    """
+    if not code:
+        return None
+    return COUNTRIES_CENTERS.get(code.strip().upper())
+
+
 class CentralizedServer(models.Model):
 
     """
@@ -2117,3 +2155,38 @@ class CentralizedServer(models.Model):
     #         for pt in pts:
     #             pt.enabled = False
     #             pt.save()
+
+
+_config_cache = {}
+_config_cache_lock = Lock()
+
+
+def get_centralized_server_config():
+    """
+    Process-wide snapshot of the CentralizedServer configuration,
+    loaded once and invalidated when a CentralizedServer is saved or deleted
+    :return: CentralizedServer or None
+    """
+    with _config_cache_lock:
+        if _config_cache and time.time() - _config_cache['loaded'] < CONFIG_CACHE_TTL:
+            return _config_cache['server']
+        try:
+            server = CentralizedServer.objects.first()
+        except Exception as e:
+            # e.g. the DB has not been migrated yet, do not cache anything
+            log.debug("Centralized server configuration not available: %s", e)
+            return None
+        _config_cache.update(server=server, loaded=time.time())
+        return server
+
+
+def invalidate_centralized_server_config(*args, **kwargs):
+    """
+    Drop the cached CentralizedServer configuration
+    """
+    with _config_cache_lock:
+        _config_cache.clear()
+
+
+signals.post_save.connect(invalidate_centralized_server_config, sender=CentralizedServer)
+signals.post_delete.connect(invalidate_centralized_server_config, sender=CentralizedServer)
@@ -18,19 +18,60 @@
 #
 #########################################################################
 
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import socket
+import struct
 import logging
 import datetime
 import pytz
 import binascii
+import threading
+import importlib
+import subprocess
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from geonode.tests.base import GeoNodeBaseTestSupport
 from django.test.utils import override_settings
 from django.core.management import call_command
-from geonode_logstash.models import CentralizedServer
-from geonode_logstash.logstash import LogstashDispatcher
+from geonode_logstash.codecs import GzipCodec, JsonCodec, get_codec, zstandard
+from geonode_logstash.models import (
+    CentralizedServer,
+    get_country_center,
+    invalidate_centralized_server_config
+)
+from logstash_async.transport import TcpTransport
+from geonode_logstash.logstash import (
+    DATA_TYPES_MAP,
+    LogstashDispatcher,
+    GeonodeTcpTransport,
+    GeonodeLogstashFormatter,
+    GeonodeLogProcessingWorker
+)
 # from django_celery_beat.models import PeriodicTask, IntervalSchedul
 
 logger = logging.getLogger(__name__)
 
+# Maximum seconds allowed to import geonode_logstash.logstash
+IMPORT_TIME_BUDGET = 0.5
+# Maximum ratio of the codec to the legacy gzip encoding times
+CODEC_TIME_MARGIN = 1.5
+
+
+class PerEventTcpTransport(TcpTransport):
+    """
+    The former GeonodeTcpTransport: a connection for each batch and a write
+    for each event, without the 0.1s sleep between the events
+    """
+
+    def _send(self, events):
+        for event in events:
+            self._send_via_socket(event)
+
 
 class GeonodeLogstashTest(GeoNodeBaseTestSupport):
     """
@@ -177,6 +218,342 @@ class GeonodeLogstashTest(GeoNodeBaseTestSupport):
         ld._valid_from = self._valid_from
         ld._valid_to = self._valid_to
         msg = ld._get_message(LogstashDispatcher.DATA_TYPES_MAP[0])
-        formatter = ld._handler.formatter
-        compressed = formatter.json_gzip(msg)
-        self.assertTrue(binascii.hexlify(compressed), b'1f8b')
+        formatter = GeonodeLogstashFormatter(gzip=True)
+        compressed = formatter.codec.encode(msg)
+        self.assertEqual(binascii.hexlify(compressed[:2]), b'1f8b')
+        self.assertEqual(json.loads(formatter.codec.decode(compressed).decode("utf-8")), msg)
+
+    def test_worker_drained_signal(self):
+        class _Transport(object):
+            def __init__(self):
+                self.events = []
+
+            def send(self, events, use_logging=False):
+                self.events.extend(events)
+
+        transport = _Transport()
+        worker = GeonodeLogProcessingWorker(
+            host="localhost", port=5000, transport=transport,
+            ssl_enable=False, ssl_verify=False, keyfile=None, certfile=None, ca_certs=None,
+            database_path=None, cache={}, event_ttl=None
+        )
+        worker.start()
+        try:
+            worker.enqueue_event(b'{"test": "first"}')
+            worker.enqueue_event(b'{"test": "second"}')
+            worker.force_flush_queued_events()
+            self.assertTrue(worker.wait_until_drained(timeout=10))
+            self.assertEqual(len(transport.events), 2)
+        finally:
+            worker.shutdown()
+            worker.join()
+
+    def test_worker_discard_queued_events(self):
+        class _Transport(object):
+            def __init__(self):
+                self.events = []
+                self.fail = True
+
+            def send(self, events, use_logging=False):
+                if self.fail:
+                    raise socket.error("Connection refused")
+                self.events.extend(events)
+
+        transport = _Transport()
+        cache = {}
+        worker = GeonodeLogProcessingWorker(
+            host="localhost", port=5000, transport=transport,
+            ssl_enable=False, ssl_verify=False, keyfile=None, certfile=None, ca_certs=None,
+            database_path=None, cache=cache, event_ttl=None
+        )
+        worker.start()
+        try:
+            worker.enqueue_event(b'{"test": "failed"}')
+            worker.force_flush_queued_events()
+            self.assertFalse(worker.wait_until_drained(timeout=10))
+            # The events of the failed delivery are not sent again
+            self.assertTrue(worker.discard_queued_events(timeout=10))
+            self.assertEqual(cache, {})
+            transport.fail = False
+            worker.enqueue_event(b'{"test": "resumed"}')
+            worker.force_flush_queued_events()
+            self.assertTrue(worker.wait_until_drained(timeout=10))
+            self.assertEqual(transport.events, [b'{"test": "resumed"}'])
+        finally:
+            worker.shutdown()
+            worker.join()
+
+    def _tcp_sink(self):
+        """
+        Local TCP server counting connections and received bytes
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(5)
+        server.settimeout(0.1)
+        stopped = threading.Event()
+        stats = {"connections": 0, "data": b""}
+
+        def _serve():
+            while True:
+                try:
+                    conn, _addr = server.accept()
+                except socket.timeout:
+                    # Pending connections are accepted before stopping
+                    if stopped.is_set():
+                        break
+                    continue
+                stats["connections"] += 1
+                with conn:
+                    conn.settimeout(None)
+                    while True:
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        stats["data"] += chunk
+            server.close()
+
+        thread = threading.Thread(target=_serve)
+        thread.daemon = True
+        thread.start()
+        return server, stopped, thread, stats
+
+    def _benchmark_transport(self, transport_class, events, batch_size=10):
+        server, stopped, thread, stats = self._tcp_sink()
+        host, port = server.getsockname()
+        transport = transport_class(
+            host=host, port=port, ssl_enable=False, ssl_verify=False,
+            keyfile=None, certfile=None, ca_certs=None, timeout=5
+        )
+        start = time.time()
+        for i in range(0, len(events), batch_size):
+            transport.send(events[i:i + batch_size])
+        transport.close()
+        elapsed = time.time() - start
+        stopped.set()
+        thread.join(10)
+        return elapsed, stats
+
+    def test_tcp_transport_throughput(self):
+        events = [
+            '{{"data_type": "resources", "resources": [{{"name": "geonode:layer_{}", "hits": 1}}]}}'.format(i)
+            for i in range(2000)
+        ]
+        elapsed, stats = self._benchmark_transport(GeonodeTcpTransport, events)
+        received = stats["data"].splitlines()
+        self.assertEqual(len(received), len(events))
+        self.assertEqual(received[-1], events[-1].encode("utf-8"))
+        # A single persistent connection is used for all the batches
+        self.assertEqual(stats["connections"], 1)
+        # Baseline: one new connection for each batch and one write for each event,
+        # on fewer events as each of its connections waits for the delayed ACKs
+        base_events = events[:100]
+        base_elapsed, base_stats = self._benchmark_transport(PerEventTcpTransport, base_events)
+        self.assertEqual(base_stats["data"], "".join(base_events).encode("utf-8"))
+        self.assertEqual(base_stats["connections"], len(base_events) // 10)
+        rate = len(events) / max(elapsed, 1e-6)
+        base_rate = len(base_events) / max(base_elapsed, 1e-6)
+        logger.info("GeonodeTcpTransport: %d events/s, per event TcpTransport: %d events/s", rate, base_rate)
+        self.assertGreater(rate, base_rate)
+
+    @override_settings(MONITORING_ENABLED=True, USER_ANALYTICS_ENABLED=True)
+    def test_get_message_merge_by_name(self):
+        class _Collector(object):
+            def get_metrics_data(self, metric_name, group_by=None, **kwargs):
+                if group_by == "resource_on_label":
+                    return [
+                        {"resource": {"name": "geonode:roads"}, "val": 1},
+                        {"resource": {"name": "geonode:railways"}, "val": 2}
+                    ]
+                if group_by == "resource":
+                    return [
+                        {"resource": {"name": "geonode:railways", "type": "layer", "href": ""}, "val": 4}
+                    ]
+                return []
+
+        ld = LogstashDispatcher()
+        ld._valid_from = self._valid_from
+        ld._valid_to = self._valid_to
+        ld._collector = _Collector()
+        msg = ld._get_message(DATA_TYPES_MAP[1])
+        self.assertEqual(
+            msg["resources"],
+            [
+                {"name": "geonode:railways", "type": "layer", "url": "", "hits": 4,
+                 "unique_visits": 2, "downloads": 4, "ogc_hits": 4, "publications": 4},
+                {"name": "geonode:roads", "unique_visits": 1}
+            ]
+        )
+
+    def test_get_country_center(self):
+        center = (42.6384261, 12.674297)
+        self.assertEqual(get_country_center("ITA"), center)
+        self.assertEqual(get_country_center("it"), center)
+        self.assertEqual(get_country_center("Italy"), center)
+        self.assertIsNone(get_country_center("XXX"))
+        self.assertEqual(LogstashDispatcher._get_country_center("ITA"), list(center))
+
+    def test_catch_up_windows(self):
+        interval = 3600
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        ld = LogstashDispatcher()
+        ld._centralized_server = CentralizedServer(
+            interval=interval,
+            last_successful_deliver=now - datetime.timedelta(seconds=interval * 3.5)
+        )
+        ld._set_time_range()
+        self.assertEqual(len(ld._windows), 4)
+        self.assertEqual(ld._windows[0][0], ld._centralized_server.last_successful_deliver)
+        for (_from, _to), (next_from, _next_to) in zip(ld._windows, ld._windows[1:]):
+            self.assertEqual(_to, next_from)
+            self.assertEqual((_to - _from).total_seconds(), interval)
+        self.assertEqual(ld._valid_to, ld._windows[-1][1])
+
+    def test_windows_single_pool(self):
+        class _Collector(object):
+            def get_metrics_data(self, metric_name, group_by=None, **kwargs):
+                return [{"resource": {"name": "geonode:roads", "type": "layer", "href": ""}, "val": 1}]
+
+        interval = 3600
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        ld = LogstashDispatcher()
+        ld._centralized_server = CentralizedServer(
+            interval=interval,
+            last_successful_deliver=now - datetime.timedelta(seconds=interval * 3)
+        )
+        ld._set_time_range()
+        ld._collector = _Collector()
+        ld._query_workers = 4
+        with mock.patch("geonode_logstash.logstash.DATA_TYPES_MAP", [DATA_TYPES_MAP[1]]), \
+                mock.patch("geonode_logstash.logstash.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as executor:
+            windows_messages = list(ld._get_windows_messages())
+        self.assertEqual(len(windows_messages), len(ld._windows))
+        for (_from, _to), messages in zip(ld._windows, windows_messages):
+            self.assertEqual(messages[0]["time"]["endTime"], _to.isoformat())
+        # The metrics of each window are not queried by a nested pool
+        self.assertEqual(executor.call_count, 1)
+
+    def test_failed_window_query(self):
+        interval = 3600
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        server = CentralizedServer.objects.create(
+            host="localhost", port=5000, local_ip="127.0.0.1", interval=interval,
+            last_successful_deliver=now - datetime.timedelta(seconds=interval * 3)
+        )
+        ld = LogstashDispatcher()
+        ld._centralized_server = server
+        ld._set_time_range()
+        ld._handler = mock.Mock()
+        ld._handler.wait_for_delivery.return_value = True
+        ld._logger = mock.Mock()
+        failing_window = ld._windows[1]
+
+        def get_message(window, data_type):
+            if (window._valid_from, window._valid_to) == failing_window:
+                raise ValueError("query failed")
+            return {"data_type": data_type["name"]}
+
+        with mock.patch("geonode_logstash.logstash.IS_ENABLED", True), \
+                mock.patch.object(LogstashDispatcher, "_get_message", autospec=True, side_effect=get_message):
+            ld.dispatch_metrics()
+        # Only the messages of the first window are sent
+        self.assertEqual(ld._logger.info.call_count, len(DATA_TYPES_MAP))
+        server.refresh_from_db()
+        # The next run resumes from the failed window
+        self.assertEqual(server.last_successful_deliver, failing_window[0])
+        self.assertIsNotNone(server.last_failed_deliver)
+
+    def test_codecs_framing(self):
+        msg = {"data_type": "resources", "resources": self.resources}
+        json_codec = JsonCodec()
+        self.assertEqual(json_codec.frame(json_codec.encode(msg)), json.dumps(msg).encode("utf-8") + b"\n")
+        gzip_codec = get_codec("gzip", 9)
+        payload = gzip_codec.encode(msg)
+        self.assertEqual(payload[:2], b"\x1f\x8b")
+        self.assertEqual(json.loads(gzip_codec.decode(payload).decode("utf-8")), msg)
+        frame = gzip_codec.frame(payload)
+        self.assertEqual(struct.unpack(">I", frame[:4])[0], len(payload))
+        self.assertEqual(frame[4:], payload)
+        # The unframed payloads of the previous releases
+        self.assertEqual(get_codec("gzip", 9, framed=False).frame(payload), payload)
+
+    def test_codecs_benchmark(self):
+        messages = [
+            json.dumps({"data_type": "resources", "id": i, "resources": self.resources})
+            for i in range(1000)
+        ]
+
+        def _legacy_gzip(data):
+            _out = io.BytesIO()
+            with gzip.GzipFile(fileobj=_out, mode="wb") as fout:
+                fout.write(data.encode("utf-8"))
+            return _out.getvalue()
+
+        def _elapsed(encode):
+            # Best of a few runs, to leave out the scheduling noise
+            elapsed = []
+            for _run in range(5):
+                start = time.time()
+                size = sum(len(encode(msg)) for msg in messages)
+                elapsed.append(time.time() - start)
+            return size, min(elapsed)
+
+        legacy_size, legacy_elapsed = _elapsed(_legacy_gzip)
+        # GzipFile compresses at level 9 by default
+        size, elapsed = _elapsed(GzipCodec(level=9).encode)
+        self.assertLessEqual(size, legacy_size)
+        self.assertLess(elapsed, legacy_elapsed * CODEC_TIME_MARGIN)
+
+        codecs = [get_codec("json"), GzipCodec(level=1), GzipCodec()]
+        if zstandard is not None:
+            codecs.append(get_codec("zstd"))
+        for codec in codecs:
+            start = time.time()
+            size = sum(len(codec.frame(codec.encode(msg))) for msg in messages)
+            elapsed = time.time() - start
+            logger.info(
+                "%s (level %s): %d bytes in %.3fs, legacy gzip: %d bytes in %.3fs",
+                codec.name, getattr(codec, "level", None), size, elapsed, legacy_size, legacy_elapsed
+            )
+
+    def test_centralized_server_config_cache(self):
+        server = CentralizedServer.objects.create(
+            host="localhost", port=5000, local_ip="127.0.0.1", socket_timeout=3.0
+        )
+        invalidate_centralized_server_config()
+        with self.assertNumQueries(1):
+            self.assertEqual(LogstashDispatcher.get_socket_timeout(), 3.0)
+            LogstashDispatcher.get_queue_check_interval()
+            LogstashDispatcher.get_queue_events_flush_interval()
+            LogstashDispatcher.get_queue_events_flush_count()
+            LogstashDispatcher.get_queue_events_batch_size()
+            LogstashDispatcher.get_logstash_db_timeout()
+        # Saving the server invalidates the cached configuration
+        server.socket_timeout = 5.0
+        server.save()
+        self.assertEqual(LogstashDispatcher.get_socket_timeout(), 5.0)
+
+    def test_import_time(self):
+        # Timed in a fresh interpreter, where the dependencies are not imported yet
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import django; django.setup(); import geonode_logstash.logstash"],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+            stderr=subprocess.PIPE, universal_newlines=True, check=True
+        ).stderr
+        cumulative = [
+            int(line.split("|")[1]) for line in output.splitlines()
+            if line.startswith("import time:") and line.split("|")[-1].strip() == "geonode_logstash.logstash"
+        ]
+        # Microseconds, the module may be reported again when imported through its package
+        self.assertTrue(cumulative)
+        self.assertLess(max(cumulative) / 1e6, IMPORT_TIME_BUDGET)
+
+        package = sys.modules["geonode_logstash"]
+        module = sys.modules.pop("geonode_logstash.logstash")
+        try:
+            # Importing the module must not hit the database
+            with self.assertNumQueries(0):
+                importlib.import_module("geonode_logstash.logstash")
+        finally:
+            sys.modules["geonode_logstash.logstash"] = module
+            package.logstash = module
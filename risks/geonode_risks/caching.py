@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+"""
+Version keyed cache of the risks JSON API.
+
+Cached responses are keyed on the request path and on version counters,
+which are bumped whenever the data behind the response changes:
+
+ * divisions: any Administrative Division or Region change
+ * analysis:<id>: a Risk Analysis, or any object bound to it, changes
+ * metadata: any other object of the app (Hazard Types, Dimensions...), or
+   a GeoNode Layer, Style or Resource, changes
+ * analyses: bumped along with any analysis:<id> or metadata change
+
+Views of a single Risk Analysis (an/<id>/) depend on divisions, metadata and
+their own analysis:<id> counter, all the other views on divisions and analyses.
+Entries can live long (RISKS_API_CACHE_TTL), as they are never served once
+stale.
+"""
+
+import time
+import hashlib
+import logging
+
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import translation
+
+log = logging.getLogger(__name__)
+
+CACHE_TTL = getattr(settings, 'RISKS_API_CACHE_TTL', 6 * 60 * 60)
+KEY_PREFIX = 'geonode_risks:api'
+
+DIVISIONS = 'divisions'
+ANALYSES = 'analyses'
+METADATA = 'metadata'
+
+STATS = ('hits', 'misses',)
+
+
+def _version_key(name):
+    return '{}:version:{}'.format(KEY_PREFIX, name)
+
+
+def analysis_version(analysis_id):
+    return 'analysis:{}'.format(analysis_id)
+
+
+def get_versions(*names):
+    """
+    Return the current values of version counters
+    """
+    keys = [_version_key(name) for name in names]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # a counter lost by the cache restarts from a value never used before
+        initial = int(time.time() * 1000)
+        for key in missing:
+            cache.add(key, initial, None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key) for key in keys]
+
+
+def bump_versions(*names):
+    """
+    Invalidate the cached responses depending on the version counters
+    """
+    for name in names:
+        key = _version_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), None)
+
+
+def bump_analysis(analysis_id):
+    bump_versions(analysis_version(analysis_id), ANALYSES)
+
+
+def _incr_stat(name):
+    key = '{}:stats:{}'.format(KEY_PREFIX, name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def get_cache_stats():
+    """
+    Return the hit/miss counters of the cache
+    """
+    keys = ['{}:stats:{}'.format(KEY_PREFIX, name) for name in STATS]
+    values = cache.get_many(keys)
+    return dict((name, values.get(key, 0)) for name, key in zip(STATS, keys))
+
+
+def get_response_key(request, **kwargs):
+    if kwargs.get('an'):
+        try:
+            names = (DIVISIONS, METADATA, analysis_version(int(kwargs['an'])),)
+        except ValueError:
+            names = (DIVISIONS, ANALYSES,)
+    else:
+        names = (DIVISIONS, ANALYSES,)
+    versions = get_versions(*names)
+    path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    return '{}:response:{}:{}:{}'.format(
+        KEY_PREFIX, path, translation.get_language(), ':'.join(str(v) for v in versions))
+
+
+def versioned_cache(view):
+    """
+    Cache the successful GET responses of a view on the version counters
+    """
+    @wraps(view)
+    def _wrapped_view(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+
+        key = get_response_key(request, **kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            _incr_stat('hits')
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+            response['X-Risks-Cache'] = 'HIT'
+            return response
+
+        _incr_stat('misses')
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            cache.set(key, (response.content, response['Content-Type']), CACHE_TTL)
+        response['X-Risks-Cache'] = 'MISS'
+        return response
+    return _wrapped_view
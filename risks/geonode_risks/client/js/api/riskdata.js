@@ -40,12 +40,23 @@ const Api = {
         data.append('legend', legendBlob);
         data.append('dims', dimFields.dims);
         data.append('dimsVal', dimFields.dimsVal);
-        return axios.post(url, data, {responseType: 'blob'})
+        // without async the server renders the pdf in the request, as the older bundles expect
+        return axios.post(url, data, {params: {async: 1}})
+            .then((response) => Api.waitReport(response.data.pdf))
             .then((response) => {
                 FileSaver.saveAs(response.data, "report.pdf");
                 return response;
             })
             .catch((e) => { throw new Error(e.statusText); });
+    },
+    waitReport: function(url) {
+        // reports are rendered in background, poll until the pdf is ready
+        return axios.get(url, {responseType: 'blob'}).then((response) => {
+            if (response.status === 202) {
+                return new Promise((resolve) => setTimeout(resolve, 2000)).then(() => Api.waitReport(url));
+            }
+            return response;
+        });
     }
 };
 
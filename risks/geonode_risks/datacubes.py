@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import logging
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .caching import bump_analysis
+from .models import RiskAnalysisDymensionInfoAssociation, RiskDataCube
+
+log = logging.getLogger(__name__)
+
+DIMENSIONS = ('dim1', 'dim2', 'dim3', 'dim4', 'dim5')
+
+
+def sort_feature_values(features, fields, field_orders):
+    """
+    Return the value lines ([field values..., value]) of the features,
+    sorted by the order of the first dimension and then of the others
+    """
+    values = []
+
+    def make_order_val(feat):
+        """
+        compute order value
+        """
+        _order_vals = []
+
+        for idx, field_name in enumerate(field_orders):
+            order_val = feat['properties'].get(field_name)
+
+            if order_val is None:
+                order_val = 0
+            # 111 > 1, 1, 1
+            # mag = 10 ** (orders_len - idx)
+            mag = 1000 if idx == 0 else 1
+            _order_vals.append(int('{}'.format(order_val * mag)))
+        # return ''.join(_order_vals)
+        return sum(_order_vals)
+
+    def order_key(val):
+        # order by last val
+        order = val.pop(-1)
+        return order
+
+    for feat in features:
+        p = feat['properties']
+        line = []
+        [line.append(p[f]) for f in fields]
+        line.append(p['value'])
+        line.append(make_order_val(feat))
+        values.append(line)
+
+    values.sort(key=order_key)
+    return values
+
+
+def get_dimension_fields(risk, dims):
+    """
+    Return the value and order feature fields of the dimensions of a Risk Analysis
+    """
+    _fields = []
+    axis_map = risk.get_axis_map()
+    for dym in dims:
+        ass_list = RiskAnalysisDymensionInfoAssociation.objects.filter(riskanalysis=risk, dymensioninfo=dym)
+        dim_list = set([a.axis_to_dim(axis_map) for a in ass_list])
+        if len(dim_list) != 1:
+            raise ValueError("Cannot query more than one dimension at the moment, got {}".format(len(dim_list)))
+        _fields.append(list(dim_list)[0])
+    fields = ['{}_value'.format(f) for f in _fields]
+    field_orders = ['{}_order'.format(f) for f in _fields]
+    return (fields, field_orders)
+
+
+def get_risk_features(conn, table, risk):
+    """
+    Read the features of a Risk Analysis from the datastore, as the
+    {table}_data GeoServer layer returns them, grouped by adm_code
+    """
+    columns = []
+    joins = []
+    for dim in DIMENSIONS:
+        columns.append('{0}.dim_value {0}_value, {0}.dim_order {0}_order'.format(dim))
+        joins.append('LEFT JOIN public.dimension {0} ON ({0}.dim_id = rd.{0}_id)'.format(dim))
+    query = """SELECT t.adm_code, rd.value, {columns}
+                 FROM {table} t
+                 JOIN {table}_dimensions rd ON (rd.{table}_fid = t.fid)
+                 {joins}
+                WHERE t.risk_analysis = %s AND t.hazard_type = %s
+                ORDER BY t.fid;""".format(columns=', '.join(columns), table=table, joins=' '.join(joins))
+    field_names = ['value']
+    for dim in DIMENSIONS:
+        field_names.extend(['{}_value'.format(dim), '{}_order'.format(dim)])
+
+    features = defaultdict(list)
+    curs = conn.cursor()
+    try:
+        curs.execute(query, (risk.name, risk.hazard_type.mnemonic,))
+        for row in curs:
+            features[row[0]].append({'properties': dict(zip(field_names, row[1:]))})
+    finally:
+        curs.close()
+    return features
+
+
+def build_risk_data_cubes(risk):
+    """
+    Precompute the data extraction values of a Risk Analysis, for each
+    Administrative Division and Dimension, from the datastore.
+    Returns the number of cubes stored.
+    """
+    from .importers import get_connection_pool
+
+    datastore = settings.DATABASES[settings.OGC_SERVER['default']['DATASTORE']]
+    table = risk.layer.typename.split(":")[1] \
+        if ":" in risk.layer.typename else risk.layer.typename
+
+    pool = get_connection_pool(datastore['NAME'], datastore['USER'], datastore['PORT'],
+                               datastore['HOST'], datastore['PASSWORD'])
+    conn = pool.getconn()
+    try:
+        features = get_risk_features(conn, table, risk)
+        conn.rollback()
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+    cubes = []
+    dymlist = list(risk.dymension_infos.all().distinct())
+    for dimension in dymlist:
+        dims = [dimension] + [d for d in dymlist if d.id != dimension.id]
+        (fields, field_orders) = get_dimension_fields(risk, dims)
+        for adm_code, adm_features in features.items():
+            # as the GeoServer query, skip the features without the main dimension
+            adm_features = [f for f in adm_features if f['properties'][fields[0]] is not None]
+            cubes.append(RiskDataCube(risk_analysis=risk,
+                                      adm_code=adm_code,
+                                      dymensioninfo=dimension,
+                                      values=sort_feature_values(adm_features, fields, field_orders)))
+
+    with transaction.atomic():
+        RiskDataCube.objects.filter(risk_analysis=risk).delete()
+        RiskDataCube.objects.bulk_create(cubes, batch_size=500)
+    bump_analysis(risk.pk)
+    log.debug('Built %s data cubes for %s', len(cubes), risk.name)
+    return len(cubes)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import logging
+import math
+
+from django.conf import settings
+from django.contrib.gis import geos
+from django.db import IntegrityError, transaction
+
+from .models import AdministrativeDivision, AdministrativeDivisionGeometry
+
+log = logging.getLogger(__name__)
+
+# zoom levels of the web maps
+MIN_ZOOM = 0
+MAX_ZOOM = 30
+# simplification tolerances (in degrees) of the stored geometries, 0 is the full geometry
+GEOMETRY_TOLERANCES = tuple(sorted(set(
+    [0.0] + list(getattr(settings, 'RISKS_GEOMETRY_TOLERANCES', (0.001, 0.005, 0.02, 0.1,))))))
+
+
+def get_tolerance(zoom=None, tolerance=None):
+    """
+    Returns the coarsest stored tolerance not exceeding the requested
+    tolerance or, for a zoom level, the size of a pixel of a 256px web map tile.
+    Raises ValueError for a tolerance which is not a finite number
+    """
+    if tolerance is not None and (math.isnan(tolerance) or math.isinf(tolerance)):
+        raise ValueError('Invalid tolerance {}'.format(tolerance))
+    if tolerance is None and zoom is not None:
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        tolerance = 360.0 / (256 * 2 ** zoom)
+    if not tolerance or tolerance < 0:
+        return 0.0
+    return [t for t in GEOMETRY_TOLERANCES if t <= tolerance][-1]
+
+
+def make_geojson(wkt, tolerance):
+    """
+    Returns the GeoJSON of a WKT geometry, simplified with the tolerance
+    """
+    geom = geos.GEOSGeometry(wkt)
+    if tolerance > 0:
+        geom = geom.simplify(tolerance, preserve_topology=True)
+    return geom.json
+
+
+def get_division_geometries(division_ids, tolerance):
+    """
+    Returns the GeoJSON geometries of the Administrative Divisions, simplified
+    with the tolerance, by division id. Missing geometries are built and stored.
+    """
+    geometries = dict(AdministrativeDivisionGeometry.objects.filter(administrative_division__in=division_ids,
+                                                                    tolerance=tolerance)
+                                                            .values_list('administrative_division', 'geojson'))
+    missing = [division_id for division_id in division_ids if division_id not in geometries]
+    if not missing:
+        return geometries
+
+    built = []
+    for division_id, wkt in AdministrativeDivision.objects.filter(id__in=missing).values_list('id', 'geom'):
+        geometries[division_id] = geojson = make_geojson(wkt, tolerance)
+        built.append(AdministrativeDivisionGeometry(administrative_division_id=division_id,
+                                                    tolerance=tolerance,
+                                                    geojson=geojson))
+    try:
+        with transaction.atomic():
+            AdministrativeDivisionGeometry.objects.bulk_create(built, batch_size=200)
+    except IntegrityError:
+        # stored meanwhile by a concurrent request
+        log.debug('Geometries of %s already stored', missing)
+    return geometries
+
+
+def build_division_geometries(division_ids):
+    """
+    Builds the missing geometries of the Administrative Divisions for all the tolerances
+    """
+    for tolerance in GEOMETRY_TOLERANCES:
+        get_division_geometries(division_ids, tolerance)
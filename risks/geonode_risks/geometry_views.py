@@ -21,44 +21,46 @@
 from __future__ import print_function
 
 import json
+import hashlib
 import logging
 
-from django.conf import settings
-from django.views.generic import TemplateView, View
-from django.contrib.gis.gdal import OGRGeometry
+from django.http import HttpResponse
+from django.views.decorators.http import condition
+from django.views.generic import View
 
 from geonode.utils import json_response
-from .models import (HazardType, AdministrativeDivision,
-                                          RiskAnalysisDymensionInfoAssociation)
+from .models import AdministrativeDivision
 from .views import AppAware
-
-from .datasource import GeoserverDataSource
+from .caching import DIVISIONS, get_versions
+from .geometries import GEOMETRY_TOLERANCES, get_division_geometries, get_tolerance
 
 log = logging.getLogger(__name__)
 
 
 class AdministrativeGeometry(AppAware, View):
-    
+    """
+    Serves an Administrative Division and its children as GeoJSON features.
 
-    def _get_geometry(self, val):
-        """
-        converts geometry to geojson geom
-        """
-        g = OGRGeometry(val)
-        return json.loads(g.json)
+    Geometries are simplified for the `zoom` (web map zoom level) or
+    `tolerance` (degrees) query parameters, and served as stored.
+    """
+
+    def _get_tolerance(self, request):
+        zoom = request.GET.get('zoom')
+        tolerance = request.GET.get('tolerance')
+        return get_tolerance(zoom=int(zoom) if zoom else None,
+                             tolerance=float(tolerance) if tolerance else None)
 
     def _get_properties(self, val):
         return val.export()
 
-    def _make_feature(self, val, app):
+    def _make_feature(self, val, app, geometry):
         """
-        Returns feature from the object
+        Returns feature from the object, with the stored GeoJSON geometry
 
         """
-        return {"type": "Feature",
-                "properties": self._get_properties(val.set_app(app)),
-                "geometry": self._get_geometry(val.geom)
-                }
+        return u'{{"type": "Feature", "properties": {}, "geometry": {}}}'.format(
+            json.dumps(self._get_properties(val.set_app(app))), geometry)
 
 
     def get(self, request, adm_code, **kwargs):
@@ -67,19 +69,39 @@ class AdministrativeGeometry(AppAware, View):
         except KeyError:
             app = None
         try:
-            adm = AdministrativeDivision.objects.get(code=adm_code)
+            tolerance = self._get_tolerance(request)
+        except ValueError:
+            return json_response(errors=["Invalid zoom or tolerance"], status=400)
+        try:
+            adm = (AdministrativeDivision.objects.select_related('parent')
+                                                 .defer('geom', 'parent__geom').get(code=adm_code))
         except AdministrativeDivision.DoesNotExist:
             adm = None
         if adm is None:
             return json_response(errors=["Invalid code"], status=404)
 
-        children = adm.children.all()
-        _features = [adm] + list(children)
+        if adm.parent:
+            adm.parent.set_app(app)
+        children = list(adm.children.defer('geom'))
+        for child in children:
+            # parent_geom_href of the children, without loading the parent again
+            child.parent = adm
+        _features = [adm] + children
+
+        geometries = get_division_geometries([item.id for item in _features], tolerance)
+        features = [self._make_feature(item, app, geometries[item.id]) for item in _features]
+        out = u'{{"type": "FeatureCollection", "features": [{}]}}'.format(u', '.join(features))
+        return HttpResponse(out, content_type='application/json')
+
+
+def administrative_division_etag(request, adm_code, **kwargs):
+    """
+    ETag of the geometries, changed by any Administrative Division change
+    """
+    (version,) = get_versions(DIVISIONS)
+    key = u'{}:{}:{}:{}:{}'.format(kwargs.get('app'), adm_code, request.GET.urlencode(),
+                                   GEOMETRY_TOLERANCES, version)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
 
-        features = [self._make_feature(item, app) for item in _features]
-        out = {'type': 'FeatureCollection',
-               'features': features}
-        return json_response(out)
-                           
 
-administrative_division_view = AdministrativeGeometry.as_view()
+administrative_division_view = condition(etag_func=administrative_division_etag)(AdministrativeGeometry.as_view())
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import io
+import os
+import logging
+import threading
+
+from collections import OrderedDict
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from django.conf import settings
+from django.contrib.gis import geos
+from django.db import transaction
+from django.db.models import Q
+from django.utils import six
+
+from .caching import bump_analysis
+from .models import (AdministrativeDivision, Region, RiskAnalysis,
+                     RiskAnalysisAdministrativeDivisionAssociation)
+
+import xlrd
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+log = logging.getLogger(__name__)
+
+DIMENSIONS = ('dim1', 'dim2', 'dim3', 'dim4', 'dim5')
+# maximum number of datastore connections kept by each process
+IMPORT_POOL_SIZE = getattr(settings, 'RISKS_IMPORT_POOL_SIZE', 2)
+# serializes the merges of concurrent loads, which share public.dimension
+LOADER_LOCK = 'geonode_risks.RiskDataLoader'
+# number of values collected before they are loaded on the datastore
+LOADER_CHUNK_SIZE = getattr(settings, 'RISKS_IMPORT_CHUNK_SIZE', 10000)
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+FEATURE_COLUMNS = ('risk_analysis', 'hazard_type', 'admin', 'adm_code', 'region')
+
+
+class WorkbookReader(object):
+    """
+    Reads a workbook one sheet at a time, row by row, so that memory does not
+    grow with the size of the file.
+
+    xlsx files are streamed with openpyxl (read-only mode) when it is
+    installed, other files are read with xlrd loading each sheet on demand.
+    Rows are lists of cell values following the xlrd conventions: numbers
+    are floats, booleans are 1/0 and empty cells are ''.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.streaming = openpyxl is not None and not filename.lower().endswith('.xls')
+        if self.streaming:
+            self.wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        else:
+            self.wb = xlrd.open_workbook(filename=filename, on_demand=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.streaming:
+            self.wb.close()
+        else:
+            self.wb.release_resources()
+
+    def sheet_names(self):
+        if self.streaming:
+            return self.wb.sheetnames
+        return self.wb.sheet_names()
+
+    def rows(self, sheet_name):
+        """
+        Iterate the rows of a sheet, raises KeyError for a missing sheet
+        """
+        if sheet_name not in self.sheet_names():
+            raise KeyError(sheet_name)
+        if self.streaming:
+            return self._openpyxl_rows(sheet_name)
+        return self._xlrd_rows(sheet_name)
+
+    def _openpyxl_rows(self, sheet_name):
+        for row in self.wb[sheet_name].iter_rows(values_only=True):
+            yield [self._cell_value(value) for value in row]
+
+    def _xlrd_rows(self, sheet_name):
+        sheet = self.wb.sheet_by_name(sheet_name)
+        try:
+            for row_num in range(sheet.nrows):
+                yield sheet.row_values(row_num)
+        finally:
+            self.wb.unload_sheet(sheet_name)
+
+    @staticmethod
+    def _cell_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, six.integer_types):
+            return float(value)
+        return value
+
+
+def get_connection_pool(db_name, db_user, db_port, db_host, db_passwd):
+    """
+    Return the datastore connection pool of the current process
+    """
+    db_host = db_host if db_host is not None else 'localhost'
+    db_port = db_port if db_port is not None else 5432
+    key = (os.getpid(), db_name, db_user, db_port, db_host)
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = ThreadedConnectionPool(
+                0, IMPORT_POOL_SIZE,
+                dbname=db_name, user=db_user, port=db_port, host=db_host, password=db_passwd)
+        return _connection_pools[key]
+
+
+def get_cell(row, col_num):
+    """
+    Return a cell value of a row, '' for the missing trailing cells
+    """
+    return row[col_num] if col_num < len(row) else ''
+
+
+class RiskImportContext(object):
+    """
+    State shared by the risk importers (importriskdata, importriskmetadata
+    and importadditionaldata) for the duration of an import.
+
+    Administrative Divisions are loaded once, indexed by code and name, and
+    their WKT geometries are parsed once. The Risk Analysis / Administrative
+    Division associations are collected and stored in bulk by
+    save_associations().
+    """
+
+    def __init__(self, risk=None, region=None):
+        self.risk = risk
+        self.region = region
+        self.divisions = {}
+        self.divisions_by_name = {}
+        self.geometries = {}
+        self.regions_by_name = {}
+        self.associated_divisions = OrderedDict()
+        if region is not None:
+            self.load_divisions(AdministrativeDivision.objects.filter(region=region))
+
+    @classmethod
+    def for_risk(cls, name_or_id):
+        """
+        Create a context for the Risk Analysis matching a name or an id
+        """
+        try:
+            risk_id = int(name_or_id)
+        except (TypeError, ValueError,):
+            risk_id = None
+        if risk_id is None:
+            q = Q(name=name_or_id)
+        else:
+            q = Q(name=name_or_id) | Q(id=risk_id)
+        return cls(RiskAnalysis.objects.get(q))
+
+    def load_divisions(self, queryset):
+        for adm_div in queryset:
+            self.divisions[adm_div.code] = adm_div
+            self.divisions_by_name.setdefault(adm_div.name, adm_div)
+
+    def get_division(self, code):
+        """
+        Return the Administrative Division with the given code,
+        raises AdministrativeDivision.DoesNotExist
+        """
+        try:
+            return self.divisions[code]
+        except KeyError:
+            adm_div = AdministrativeDivision.objects.get(code=code)
+            self.divisions[code] = adm_div
+            return adm_div
+
+    def get_division_by_name(self, name):
+        """
+        Return the first Administrative Division with the given name, or None
+        """
+        if name not in self.divisions_by_name:
+            self.divisions_by_name[name] = AdministrativeDivision.objects.filter(name=name).first()
+        return self.divisions_by_name[name]
+
+    def get_region_by_name(self, name):
+        """
+        Return the first Region with the given name, or None
+        """
+        if name not in self.regions_by_name:
+            self.regions_by_name[name] = Region.objects.filter(name=name).first()
+        return self.regions_by_name[name]
+
+    def get_geometry(self, adm_div):
+        """
+        Return the parsed geometry of an Administrative Division
+        """
+        try:
+            return self.geometries[adm_div.code]
+        except KeyError:
+            geom = geos.fromstr(adm_div.geom, srid=adm_div.srid)
+            self.geometries[adm_div.code] = geom
+            return geom
+
+    def associate(self, adm_div):
+        """
+        Mark the Administrative Division as covered by the Risk Analysis
+        """
+        self.associated_divisions[adm_div.id] = adm_div
+
+    def save_associations(self):
+        """
+        Store the missing Risk Analysis / Administrative Division associations,
+        return the number of associations created
+        """
+        with transaction.atomic():
+            # imports of the same Risk Analysis running in parallel wait for each other here
+            RiskAnalysis.objects.select_for_update().filter(pk=self.risk.pk).first()
+            existing = set(RiskAnalysisAdministrativeDivisionAssociation.objects.filter(
+                riskanalysis=self.risk,
+                administrativedivision__in=list(self.associated_divisions)
+            ).values_list('administrativedivision_id', flat=True))
+            associations = [
+                RiskAnalysisAdministrativeDivisionAssociation(riskanalysis=self.risk, administrativedivision=adm_div)
+                for adm_div_id, adm_div in self.associated_divisions.items() if adm_div_id not in existing]
+            RiskAnalysisAdministrativeDivisionAssociation.objects.bulk_create(associations)
+        self.associated_divisions.clear()
+        if associations:
+            # bulk_create sends no post_save signals
+            bump_analysis(self.risk.pk)
+        return len(associations)
+
+
+def copy_value(value):
+    """
+    Format a value as a field of the COPY text format
+    """
+    if value is None:
+        return u'\\N'
+    if isinstance(value, six.binary_type):
+        value = value.decode('utf-8')
+    elif not isinstance(value, six.text_type):
+        value = u'{}'.format(value)
+    return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')\
+        .replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+
+def copy_rows(curs, table, columns, rows):
+    """
+    Load rows into a table through COPY ... FROM STDIN
+    """
+    data = io.BytesIO()
+    for row in rows:
+        line = u'\t'.join(copy_value(value) for value in row) + u'\n'
+        data.write(line.encode('utf-8'))
+    data.seek(0)
+    curs.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), data)
+
+
+class RiskDataLoader(object):
+    """
+    Collects the values of a Risk Analysis layer table in memory and loads
+    them on the datastore in bulk.
+
+    Dimensions, features and values are staged through COPY into temporary
+    tables and merged into public.dimension, {table} and {table}_dimensions
+    with one set based INSERT ... SELECT for each table. Records already
+    stored are kept, as the row by row import did. Concurrent loads are
+    serialized by a transaction level advisory lock.
+
+    The values are cleared once loaded, so a large import can be loaded
+    in chunks within the same transaction.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, values):
+        """
+        Add a value, described as a dictionary with the_geom, dim1..dim5
+        (and their dimN_order), value and the FEATURE_COLUMNS fields
+        """
+        self.values.append(values)
+
+    def extend(self, values):
+        self.values.extend(values)
+
+    def clear(self):
+        del self.values[:]
+
+    def load(self, conn):
+        """
+        Load and clear the collected values, return the number of new values
+        stored. The transaction is left to the caller.
+        """
+        if not self.values:
+            return 0
+        curs = conn.cursor()
+        try:
+            curs.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (LOADER_LOCK,))
+            dim_ids = self._load_dimensions(curs)
+            fids = self._load_features(curs)
+            loaded = self._load_values(curs, fids, dim_ids)
+            # the next chunk of the transaction stages its own values
+            curs.execute("DROP TABLE risk_dimension_staging, risk_feature_staging, risk_value_staging;")
+        finally:
+            curs.close()
+        self.clear()
+        return loaded
+
+    def _load_dimensions(self, curs):
+        dimensions = OrderedDict()
+        for values in self.values:
+            for dim_col in DIMENSIONS:
+                if values[dim_col]:
+                    dimensions.setdefault(
+                        (dim_col, six.text_type(values[dim_col])), values['{}_order'.format(dim_col)])
+
+        curs.execute("""CREATE TEMP TABLE risk_dimension_staging (
+                            dim_col character varying(30),
+                            dim_value character varying(255),
+                            dim_order integer
+                        ) ON COMMIT DROP;""")
+        copy_rows(curs, 'risk_dimension_staging', ('dim_col', 'dim_value', 'dim_order'),
+                  ((dim_col, dim_value, dim_order or 0)
+                   for (dim_col, dim_value), dim_order in dimensions.items()))
+        curs.execute("""INSERT INTO public.dimension (dim_col, dim_value, dim_order)
+                        SELECT s.dim_col, s.dim_value, s.dim_order
+                          FROM risk_dimension_staging s
+                         WHERE NOT EXISTS (SELECT dim_id FROM public.dimension d
+                                            WHERE d.dim_col = s.dim_col AND d.dim_value = s.dim_value);""")
+        curs.execute("""SELECT d.dim_col, d.dim_value, min(d.dim_id)
+                          FROM public.dimension d
+                          JOIN risk_dimension_staging s
+                            ON (d.dim_col = s.dim_col AND d.dim_value = s.dim_value)
+                         GROUP BY d.dim_col, d.dim_value;""")
+        return dict(((dim_col, dim_value), dim_id) for dim_col, dim_value, dim_id in curs.fetchall())
+
+    def _load_features(self, curs):
+        features = OrderedDict()
+        for values in self.values:
+            key = tuple(six.text_type(values[column]) for column in FEATURE_COLUMNS)
+            if key not in features:
+                # serialized once for each division
+                features[key] = values['the_geom'].hexewkb
+
+        curs.execute("""CREATE TEMP TABLE risk_feature_staging (
+                            risk_analysis character varying(80),
+                            hazard_type character varying(30),
+                            admin character varying(150),
+                            adm_code character varying(30),
+                            region character varying(80),
+                            the_geom text
+                        ) ON COMMIT DROP;""")
+        copy_rows(curs, 'risk_feature_staging', FEATURE_COLUMNS + ('the_geom',),
+                  (key + (the_geom,) for key, the_geom in features.items()))
+        curs.execute("""INSERT INTO {table} (the_geom, risk_analysis, hazard_type, admin, adm_code, region)
+                        SELECT s.the_geom::geometry, s.risk_analysis, s.hazard_type, s.admin, s.adm_code, s.region
+                          FROM risk_feature_staging s
+                         WHERE NOT EXISTS (SELECT fid FROM {table} t WHERE
+                                 t.risk_analysis = s.risk_analysis AND
+                                 t.hazard_type = s.hazard_type AND
+                                 t.admin = s.admin AND
+                                 t.adm_code = s.adm_code AND
+                                 t.region = s.region);""".format(table=self.table))
+        curs.execute("""SELECT t.risk_analysis, t.hazard_type, t.admin, t.adm_code, t.region, min(t.fid)
+                          FROM {table} t
+                          JOIN risk_feature_staging s ON (
+                                 t.risk_analysis = s.risk_analysis AND
+                                 t.hazard_type = s.hazard_type AND
+                                 t.admin = s.admin AND
+                                 t.adm_code = s.adm_code AND
+                                 t.region = s.region)
+                         GROUP BY t.risk_analysis, t.hazard_type, t.admin, t.adm_code, t.region;""".format(
+            table=self.table))
+        return dict((tuple(row[:-1]), row[-1]) for row in curs.fetchall())
+
+    def _load_values(self, curs, fids, dim_ids):
+        rows = []
+        for row_num, values in enumerate(self.values):
+            fid = fids[tuple(six.text_type(values[column]) for column in FEATURE_COLUMNS)]
+            row = [row_num, fid]
+            for dim_col in DIMENSIONS:
+                row.append(dim_ids[(dim_col, six.text_type(values[dim_col]))] if values[dim_col] else None)
+            row.append(values['value'])
+            rows.append(row)
+
+        curs.execute("""CREATE TEMP TABLE risk_value_staging (
+                            row_num integer,
+                            fid integer,
+                            dim1_id integer,
+                            dim2_id integer,
+                            dim3_id integer,
+                            dim4_id integer,
+                            dim5_id integer,
+                            value character varying(255)
+                        ) ON COMMIT DROP;""")
+        copy_rows(curs, 'risk_value_staging',
+                  ('row_num', 'fid', 'dim1_id', 'dim2_id', 'dim3_id', 'dim4_id', 'dim5_id', 'value'), rows)
+        # the first value wins over duplicated cells, as it did with the row by row import
+        curs.execute("""INSERT INTO {table}_dimensions ({table}_fid, dim1_id, dim2_id, dim3_id, dim4_id, dim5_id, value)
+                        SELECT fid, dim1_id, dim2_id, dim3_id, dim4_id, dim5_id, value FROM (
+                            SELECT DISTINCT ON (fid, dim1_id, dim2_id, dim3_id, dim4_id, dim5_id) *
+                              FROM risk_value_staging
+                             ORDER BY fid, dim1_id, dim2_id, dim3_id, dim4_id, dim5_id, row_num
+                        ) s
+                         WHERE NOT EXISTS (SELECT {table}_fid FROM public.{table}_dimensions t WHERE
+                                 t.{table}_fid = s.fid AND
+                                 (t.dim1_id IS NULL OR t.dim1_id = s.dim1_id) AND
+                                 (t.dim2_id IS NULL OR t.dim2_id = s.dim2_id) AND
+                                 (t.dim3_id IS NULL OR t.dim3_id = s.dim3_id) AND
+                                 (t.dim4_id IS NULL OR t.dim4_id = s.dim4_id) AND
+                                 (t.dim5_id IS NULL OR t.dim5_id = s.dim5_id));""".format(table=self.table))
+        log.debug('Loaded %s new values of %s in %s', curs.rowcount, len(rows), self.table)
+        return curs.rowcount
@@ -21,10 +21,10 @@
 
 from optparse import make_option
 
-from django.db.models import Q
 from django.core.management.base import BaseCommand, CommandError
 
 from geonode.contrib.risks.models import RiskAnalysis, AdditionalData
+from geonode.contrib.risks.importers import RiskImportContext
 
 
 class Command(BaseCommand):
@@ -51,17 +51,9 @@ class Command(BaseCommand):
         sheet_file = options['sheet_file'][0]
 
         try:
-            risk_id = int(risk_name)
-        except (TypeError, ValueError,):
-            risk_id = None
-        if risk_id is None:
-            q = Q(name=risk_name)
-        else:
-            q = Q(name=risk_name)|Q(id=risk_id)
-        try:
-            risk = RiskAnalysis.objects.get(q)
+            context = RiskImportContext.for_risk(risk_name)
         except RiskAnalysis.DoesNotExist:
             raise CommandError("Cannot find risk analysis: {}".format(risk_name))
 
-        ad = AdditionalData.import_from_sheet(risk, sheet_file)
+        ad = AdditionalData.import_from_sheet(context.risk, sheet_file)
         print("AdditionalData {} added".format(ad))
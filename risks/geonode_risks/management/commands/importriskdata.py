@@ -19,22 +19,20 @@
 #########################################################################
 
 import traceback
-import psycopg2
 
 from optparse import make_option
 
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.gis import geos
+from django.utils import six
 
 from geonode.contrib.risks.models import Region, AdministrativeDivision
 from geonode.contrib.risks.models import RiskAnalysis, RiskApp
 from geonode.contrib.risks.models import RiskAnalysisDymensionInfoAssociation
-from geonode.contrib.risks.models import RiskAnalysisAdministrativeDivisionAssociation
-
-import xlrd
-from xlrd.sheet import ctype_text
+from geonode.contrib.risks.importers import LOADER_CHUNK_SIZE, RiskDataLoader, RiskImportContext
+from geonode.contrib.risks.importers import WorkbookReader, get_cell, get_connection_pool
+from geonode.contrib.risks.datacubes import build_risk_data_cubes
 
 
 class Command(BaseCommand):
@@ -324,6 +322,18 @@ class Command(BaseCommand):
             default=RiskApp.APP_DATA_EXTRACTION,
             help="Name of Risk App, default: {}".format(RiskApp.APP_DATA_EXTRACTION),
             )
+        parser.add_argument(
+            '-s',
+            '--scenario',
+            dest='scenarios',
+            action='append',
+            help='Import only the given Scenario (can be repeated), default: all the Scenarios.')
+        parser.add_argument(
+            '--skip-data-cubes',
+            action='store_false',
+            dest='build_cubes',
+            default=True,
+            help='Do not rebuild the data cubes, the caller rebuilds them once all the Scenarios are imported.')
         return parser
 
     def handle(self, **options):
@@ -347,132 +357,85 @@ class Command(BaseCommand):
 
         risk = RiskAnalysis.objects.get(name=risk_analysis, app=app)
 
-        wb = xlrd.open_workbook(filename=excel_file)
         region = Region.objects.get(name=region)
         region_code = region.administrative_divisions.filter(parent=None)[0].code
 
         scenarios = RiskAnalysisDymensionInfoAssociation.objects.filter(riskanalysis=risk, axis='x')
+        if options.get('scenarios'):
+            scenarios = scenarios.filter(value__in=options.get('scenarios'))
         round_periods = RiskAnalysisDymensionInfoAssociation.objects.filter(riskanalysis=risk, axis='y')
 
         table_name = risk.layer.typename.split(":")[1] \
             if ":" in risk.layer.typename else risk.layer.typename
 
-        for scenario in scenarios:
-            # Dump Vectorial Data from DB
-            datastore = settings.OGC_SERVER['default']['DATASTORE']
-            if (datastore):
-                ogc_db_name = settings.DATABASES[datastore]['NAME']
-                ogc_db_user = settings.DATABASES[datastore]['USER']
-                ogc_db_passwd = settings.DATABASES[datastore]['PASSWORD']
-                ogc_db_host = settings.DATABASES[datastore]['HOST']
-                ogc_db_port = settings.DATABASES[datastore]['PORT']
-
-            sheet = wb.sheet_by_name(scenario.value)
-            row_headers = sheet.row(0)
-            for rp_idx, rp in enumerate(round_periods):
-                col_num = -1
-                if app.name == RiskApp.APP_DATA_EXTRACTION:
-                    for idx, cell_obj in enumerate(row_headers):
-                        # cell_type_str = ctype_text.get(cell_obj.ctype, 'unknown type')
-                        # print('(%s) %s %s' % (idx, cell_type_str, cell_obj.value))
-                        try:
-                            # if int(cell_obj.value) == int(rp.value):
-                            if cell_obj.value == rp.value:
-                                # print('[%s] (%s) RP-%s' % (scenario.value, idx, rp.value))
-                                col_num = idx
-                                break
-                        except:
-                            traceback.print_exc()
-                            pass
-                elif app.name == RiskApp.APP_COST_BENEFIT:
-                     col_num = 0
-
-                if col_num >= 0:
-                    conn = self.get_db_conn(ogc_db_name, ogc_db_user, ogc_db_port, ogc_db_host, ogc_db_passwd)
+        # Dump Vectorial Data from DB
+        datastore = settings.OGC_SERVER['default']['DATASTORE']
+        if (datastore):
+            ogc_db_name = settings.DATABASES[datastore]['NAME']
+            ogc_db_user = settings.DATABASES[datastore]['USER']
+            ogc_db_passwd = settings.DATABASES[datastore]['PASSWORD']
+            ogc_db_host = settings.DATABASES[datastore]['HOST']
+            ogc_db_port = settings.DATABASES[datastore]['PORT']
+
+        # Resolve the cells of the workbook and load them in chunks, one savepoint for each sheet
+        context = RiskImportContext(risk, region)
+        loader = RiskDataLoader(table_name)
+        base_values = {
+            'table': table_name,  # From rp.layer
+            'dim3': None,
+            'dim4': None,
+            'dim5': None,
+            'risk_analysis': risk_analysis,
+            'hazard_type': risk.hazard_type.mnemonic,
+            'region': region.name,
+        }
+        pool = get_connection_pool(ogc_db_name, ogc_db_user, ogc_db_port, ogc_db_host, ogc_db_passwd)
+        conn = pool.getconn()
+        try:
+            curs = conn.cursor()
+            with WorkbookReader(excel_file) as reader:
+                for scenario in scenarios:
+                    rows = reader.rows(scenario.value)
+                    if app.name == RiskApp.APP_DATA_EXTRACTION:
+                        values = self.get_data_extraction_values(
+                            context, rows, scenario, round_periods, region_code, base_values)
+                    elif app.name == RiskApp.APP_COST_BENEFIT:
+                        values = self.get_cost_benefit_values(
+                            context, rows, scenario, round_periods, base_values)
+                    else:
+                        continue
+                    curs.execute("SAVEPOINT risk_data_sheet;")
                     try:
-                        if app.name == RiskApp.APP_DATA_EXTRACTION:
-                            for row_num in range(1, sheet.nrows):
-                                cell_obj = sheet.cell(row_num, 5)
-                                cell_type_str = ctype_text.get(cell_obj.ctype, 'unknown type')
-                                # print('(%s) %s %s' % (idx, cell_type_str, cell_obj.value))
-                                if cell_obj.value:
-                                    adm_code = cell_obj.value \
-                                        if cell_type_str == 'text' \
-                                        else region_code + '{:04d}'.format(int(cell_obj.value))
-                                    adm_div = AdministrativeDivision.objects.get(code=adm_code)
-                                    value = sheet.cell_value(row_num, col_num)
-                                    print('[%s] (%s) %s / %s' % (scenario.value, rp.value, adm_div.name, value))
-
-                                    db_values = {
-                                        'table': table_name,  # From rp.layer
-                                        'the_geom': geos.fromstr(adm_div.geom, srid=adm_div.srid),
-                                        'dim1': scenario.value,
-                                        'dim1_order': scenario.order,
-                                        'dim2': rp.value,
-                                        'dim2_order': rp.order,
-                                        'dim3': None,
-                                        'dim4': None,
-                                        'dim5': None,
-                                        'risk_analysis': risk_analysis,
-                                        'hazard_type': risk.hazard_type.mnemonic,
-                                        'admin': adm_div.name,
-                                        'adm_code': adm_div.code,
-                                        'region': region.name,
-                                        'value': value
-                                    }
-                                    self.insert_db(conn, db_values)
-                                    risk_adm = RiskAnalysisAdministrativeDivisionAssociation.\
-                                        objects.\
-                                        filter(riskanalysis=risk, administrativedivision=adm_div)
-                                    if len(risk_adm) == 0:
-                                        RiskAnalysisAdministrativeDivisionAssociation.\
-                                            objects.\
-                                            create(riskanalysis=risk, administrativedivision=adm_div)
-                        elif app.name == RiskApp.APP_COST_BENEFIT:
-                            cell_obj = sheet.cell(rp_idx + 1, 0)
-                            cell_type_str = ctype_text.get(cell_obj.ctype, 'unknown type')
-                            if cell_obj.value:
-                                adm_div = AdministrativeDivision.objects.get(name=region)
-                                value = sheet.cell_value(rp_idx + 1, 1)
-                                print('[%s] (%s) %s / %s' % (scenario.value, rp.value, adm_div.name, value))
-
-                                db_values = {
-                                'table': table_name,  # From rp.layer
-                                'the_geom': geos.fromstr(adm_div.geom, srid=adm_div.srid),
-                                'dim1': scenario.value,
-                                'dim1_order': scenario.order,
-                                'dim2': rp.value,
-                                'dim2_order': rp.order,
-                                'dim3': None,
-                                'dim4': None,
-                                'dim5': None,
-                                'risk_analysis': risk_analysis,
-                                'hazard_type': risk.hazard_type.mnemonic,
-                                'admin': adm_div.name,
-                                'adm_code': adm_div.code,
-                                'region': region.name,
-                                'value': value
-                                }
-                                self.insert_db(conn, db_values)
-                                risk_adm = RiskAnalysisAdministrativeDivisionAssociation.\
-                                objects.\
-                                filter(riskanalysis=risk, administrativedivision=adm_div)
-                                if len(risk_adm) == 0:
-                                    RiskAnalysisAdministrativeDivisionAssociation.\
-                                    objects.\
-                                    create(riskanalysis=risk, administrativedivision=adm_div)
-
-                        # Finished Import: Commit on DB
-                        conn.commit()
+                        for db_values in values:
+                            loader.add(db_values)
+                            if len(loader) >= LOADER_CHUNK_SIZE:
+                                loader.load(conn)
+                        loader.load(conn)
                     except Exception:
-                        try:
-                            conn.rollback()
-                        except:
-                            pass
-
                         traceback.print_exc()
-                    finally:
-                        conn.close()
+                        loader.clear()
+                        curs.execute("ROLLBACK TO SAVEPOINT risk_data_sheet;")
+                    else:
+                        curs.execute("RELEASE SAVEPOINT risk_data_sheet;")
+            curs.close()
+
+            # Finished Import: Commit on DB
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except:
+                pass
+
+            traceback.print_exc()
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+        context.save_associations()
+
+        # Precompute the data extraction values, otherwise the stale cubes would be served
+        if options.get('build_cubes', True):
+            build_risk_data_cubes(risk)
 
         # Import or Update Metadata if Metadata File has been specified/found
         if excel_metadata_file:
@@ -490,109 +453,54 @@ class Command(BaseCommand):
 
         return risk_analysis
 
-    def get_db_conn(self, db_name, db_user, db_port, db_host, db_passwd):
-        """Get db conn (GeoNode)"""
-        db_host = db_host if db_host is not None else 'localhost'
-        db_port = db_port if db_port is not None else 5432
-        conn = psycopg2.connect(
-            "dbname='%s' user='%s' port='%s' host='%s' password='%s'" % (db_name, db_user, db_port, db_host, db_passwd)
-        )
-        return conn
-
-    def insert_db(self, conn, values):
-        """Remove spurious records from GeoNode DB"""
-        curs = conn.cursor()
-
-        insert_template = """INSERT INTO {table} (
-                          the_geom,
-                          risk_analysis, hazard_type,
-                          admin, adm_code,
-                          region)
-                  SELECT '{the_geom}',
-                          '{risk_analysis}', '{hazard_type}',
-                          '{admin}', '{adm_code}',
-                          '{region}'
-                  WHERE
-                  NOT EXISTS (SELECT fid FROM {table} WHERE
-                    risk_analysis = '{risk_analysis}' AND
-                    hazard_type = '{hazard_type}' AND
-                    admin = '{admin}' AND
-                    adm_code = '{adm_code}' AND
-                    region = '{region}')
-                  RETURNING fid;"""
-
-        curs.execute(insert_template.format(**values))
-        id_of_new_row = curs.fetchone()
-        next_table_fid = None
-        if id_of_new_row:
-            next_table_fid = id_of_new_row[0]
-        else:
-            next_table_fid = None
-
-        if next_table_fid is None:
-            select_template = """SELECT fid FROM {table} WHERE
-                    risk_analysis = '{risk_analysis}' AND
-                    hazard_type = '{hazard_type}' AND
-                    admin = '{admin}' AND
-                    adm_code = '{adm_code}' AND
-                    region = '{region}'"""
-
-            curs.execute(select_template.format(**values))
-            id_of_new_row = curs.fetchone()
-            if id_of_new_row:
-                next_table_fid = id_of_new_row[0]
-            else:
-                raise CommandError("Could not find any suitable Risk Analysis on target DB!")
-
-        dim_ids = {
-            'fid': next_table_fid,
-            'table': values['table'],
-            'value': values['value']
-        }
-        for dim_idx in range(1, 6):
-            dim_col = 'dim{}'.format(dim_idx)
-            dim_order = 'dim{}_order'.format(dim_idx)
-            if values[dim_col]:
-                values['dim_col'] = dim_col
-                values['dim_order'] = values[dim_order]
-                values['dim_value'] = values[dim_col]
-                insert_dimension_template = "INSERT INTO public.dimension(dim_col, dim_value, dim_order) " +\
-                                            "SELECT %(dim_col)s, %(dim_value)s, %(dim_order)s " +\
-                                            "WHERE NOT EXISTS " +\
-                                            "(SELECT dim_id FROM public.dimension " +\
-                                            "WHERE dim_col = %(dim_col)s AND dim_value = %(dim_value)s) " +\
-                                            "RETURNING dim_id;"
-
-                curs.execute(insert_dimension_template.format(**values), values)
-                id_of_new_row = curs.fetchone()
-                next_dim_id = None
-                if id_of_new_row:
-                    next_dim_id = id_of_new_row[0]
-
-                if next_dim_id is None:
-                    select_dimension_template = "SELECT dim_id FROM public.dimension " +\
-                        "WHERE dim_col = %(dim_col)s AND dim_value = %(dim_value)s;"
-
-
-                    curs.execute(select_dimension_template.format(**values), values)
-                    id_of_new_row = curs.fetchone()
-                    if id_of_new_row:
-                        next_dim_id = id_of_new_row[0]
-                    else:
-                        raise CommandError("Could not find any suitable Dimension on target DB!")
-
-                dim_ids[dim_col] = next_dim_id
-            else:
-                dim_ids[dim_col] = 'NULL'
-
-        insert_dimension_value_template = "INSERT INTO {table}_dimensions({table}_fid, dim1_id, dim2_id, dim3_id, dim4_id, dim5_id, value) " +\
-                                          "SELECT {fid}, {dim1}, {dim2}, {dim3}, {dim4}, {dim5}, '{value}' " +\
-                                          "WHERE NOT EXISTS (SELECT {table}_fid FROM public.{table}_dimensions WHERE " +\
-                                          " {table}_fid = {fid} AND " +\
-                                          " (dim1_id IS NULL OR dim1_id = {dim1}) AND " +\
-                                          " (dim2_id IS NULL OR dim2_id = {dim2}) AND " +\
-                                          " (dim3_id IS NULL OR dim3_id = {dim3}) AND " +\
-                                          " (dim4_id IS NULL OR dim4_id = {dim4}) AND " +\
-                                          " (dim5_id IS NULL OR dim5_id = {dim5}) " +\
-                                          ") RETURNING {table}_fid;"
-        curs.execute(insert_dimension_value_template.format(**dim_ids))
+    def get_data_extraction_values(self, context, rows, scenario, round_periods, region_code, base_values):
+        """Yield the values of a scenario sheet, one column for each Round Period"""
+        # match the Round Periods on the sheet header once
+        row_headers = next(rows, [])
+        header_columns = {}
+        for idx, header in enumerate(row_headers):
+            header_columns.setdefault(header, idx)
+        columns = [(rp, header_columns[rp.value]) for rp in round_periods if rp.value in header_columns]
+
+        if not columns:
+            return
+        for row in rows:
+            cell_value = get_cell(row, 5)
+            if cell_value:
+                adm_code = cell_value \
+                    if isinstance(cell_value, six.string_types) \
+                    else region_code + '{:04d}'.format(int(cell_value))
+                adm_div = context.get_division(adm_code)
+                for rp, col_num in columns:
+                    value = get_cell(row, col_num)
+                    print('[%s] (%s) %s / %s' % (scenario.value, rp.value, adm_div.name, value))
+                    yield self.get_db_values(context, base_values, adm_div, scenario, rp, value)
+                context.associate(adm_div)
+
+    def get_cost_benefit_values(self, context, rows, scenario, round_periods, base_values):
+        """Yield the values of a scenario sheet, one row for each Round Period"""
+        rp_rows = dict((rp_idx + 1, rp) for rp_idx, rp in enumerate(round_periods))
+        for row_num, row in enumerate(rows):
+            rp = rp_rows.get(row_num)
+            if rp is not None and get_cell(row, 0):
+                adm_div = context.get_division_by_name(context.region.name)
+                if adm_div is None:
+                    raise AdministrativeDivision.DoesNotExist(context.region.name)
+                value = get_cell(row, 1)
+                print('[%s] (%s) %s / %s' % (scenario.value, rp.value, adm_div.name, value))
+                yield self.get_db_values(context, base_values, adm_div, scenario, rp, value)
+                context.associate(adm_div)
+
+    def get_db_values(self, context, base_values, adm_div, scenario, rp, value):
+        db_values = dict(base_values)
+        db_values.update({
+            'the_geom': context.get_geometry(adm_div),
+            'dim1': scenario.value,
+            'dim1_order': scenario.order,
+            'dim2': rp.value,
+            'dim2_order': rp.order,
+            'admin': adm_div.name,
+            'adm_code': adm_div.code,
+            'value': value
+        })
+        return db_values
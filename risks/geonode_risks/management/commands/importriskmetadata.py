@@ -28,9 +28,8 @@ from django.db.models import Q
 from geonode.base.models import TopicCategory
 from geonode.contrib.risks.models import RiskAnalysis, RiskApp
 from geonode.contrib.risks.models import HazardSet, PointOfContact
-from geonode.contrib.risks.models import Region, AdministrativeDivision
-
-import xlrd
+from geonode.contrib.risks.models import Region
+from geonode.contrib.risks.importers import RiskImportContext, WorkbookReader, get_cell
 
 
 class Command(BaseCommand):
@@ -107,9 +106,9 @@ is mandatory")
             raise CommandError("Input Risk Metadata Table '--excel_file' \
 is mandatory")
 
-        wb = xlrd.open_workbook(filename=excel_file)
         risk = RiskAnalysis.objects.get(name=risk_analysis, app=app)
         region = Region.objects.get(name=region)
+        context = RiskImportContext(risk)
         # region_code = region.administrative_divisions.filter(parent=None)[0].code
 
         """
@@ -172,8 +171,6 @@ is mandatory")
          Electronic Mail Address  	     [O]
          Role  	                         [O]
         """
-        sheet = wb.sheet_by_index(0)
-
         hazardsets = HazardSet.objects.filter(riskanalysis=risk, country=region)
         if len(hazardsets) > 0:
             hazardset = hazardsets[0]
@@ -181,14 +178,14 @@ is mandatory")
             hazardset = HazardSet()
 
         d = {}
-        for row_num in range(0, sheet.nrows):
-            cell_title = sheet.cell_value(row_num, 0).strip()
-            cell_obj = sheet.cell(row_num, 2)
-            if cell_title and 'Section' not in cell_title:
-                cell_id = row_num
-                cell_value = cell_obj.value.strip()
-                d[cell_id] = cell_value
-                print("[%s] (%s) %s: %s" % (row_num, cell_title, d[row_num], cell_value))
+        with WorkbookReader(excel_file) as reader:
+            for row_num, row in enumerate(reader.rows(reader.sheet_names()[0])):
+                cell_title = get_cell(row, 0).strip()
+                if cell_title and 'Section' not in cell_title:
+                    cell_id = row_num
+                    cell_value = get_cell(row, 2).strip()
+                    d[cell_id] = cell_value
+                    print("[%s] (%s) %s: %s" % (row_num, cell_title, d[row_num], cell_value))
 
         # Create or Update the HazardSet
         hazardset.riskanalysis = risk
@@ -240,14 +237,14 @@ is mandatory")
 
         # Relationships
         if d[15]:
-            poc_adm = AdministrativeDivision.objects.filter(name=d[15])
-            if len(poc_adm) > 0:
-                poc.administrative_area = poc_adm[0]
+            poc_adm = context.get_division_by_name(d[15])
+            if poc_adm is not None:
+                poc.administrative_area = poc_adm
 
         if d[17]:
-            poc_ctry = Region.objects.filter(name=d[17])
-            if len(poc_ctry) > 0:
-                poc.country = poc_ctry[0]
+            poc_ctry = context.get_region_by_name(d[17])
+            if poc_ctry is not None:
+                poc.country = poc_ctry
         hazardset.poc = poc
 
         # Metadata Author
@@ -263,14 +260,14 @@ is mandatory")
 
         # Relationships
         if d[51]:
-            poc_adm = AdministrativeDivision.objects.filter(name=d[51])
-            if len(poc_adm) > 0:
-                author.administrative_area = poc_adm[0]
+            poc_adm = context.get_division_by_name(d[51])
+            if poc_adm is not None:
+                author.administrative_area = poc_adm
 
         if d[53]:
-            poc_ctry = Region.objects.filter(name=d[53])
-            if len(poc_ctry) > 0:
-                author.country = poc_ctry[0]
+            poc_ctry = context.get_region_by_name(d[53])
+            if poc_ctry is not None:
+                author.country = poc_ctry
         hazardset.author = author
         hazardset.save()
 
@@ -25,6 +25,7 @@ from django.contrib.gis.gdal import DataSource
 from django.contrib.gis import geos
 
 from geonode.contrib.risks.models import Region, AdministrativeDivision
+from geonode.contrib.risks.geometries import build_division_geometries
 
 
 class Command(BaseCommand):
@@ -97,6 +98,7 @@ is mandatory")
             raise CommandError("Input Administrative Unit Shapefile \
 '--shape-file' is mandatory")
 
+        division_ids = []
         ds = DataSource(shape_file)
         print ('Opening Data Source "%s"' % ds.name)
 
@@ -183,3 +185,9 @@ is mandatory")
                         adm_division.save()
                     else:
                         region_obj.administrative_divisions.add(adm_division)
+
+                if adm_level in (0, 1, 2,):
+                    division_ids.append(adm_division.id)
+
+        # store the simplified GeoJSON geometries served by the geometry API
+        build_division_geometries(division_ids)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_risks', '0048_riskanalysisdymensioninfoassociation_scenraio_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiskDataCube',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True)),
+                ('adm_code', models.CharField(max_length=30)),
+                ('values', jsonfield.fields.JSONField(default=[])),
+                ('dymensioninfo', models.ForeignKey(related_name='data_cubes', to='geonode_risks.DymensionInfo')),
+                ('risk_analysis', models.ForeignKey(related_name='data_cubes', to='geonode_risks.RiskAnalysis')),
+            ],
+            options={
+                'db_table': 'risks_riskdatacube',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='riskdatacube',
+            unique_together=set([('risk_analysis', 'adm_code', 'dymensioninfo')]),
+        ),
+    ]
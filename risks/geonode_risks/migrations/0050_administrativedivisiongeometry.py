@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_risks', '0049_riskdatacube'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdministrativeDivisionGeometry',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True)),
+                ('tolerance', models.FloatField(default=0)),
+                ('geojson', models.TextField()),
+                ('administrative_division', models.ForeignKey(related_name='geometries', to='geonode_risks.AdministrativeDivision')),
+            ],
+            options={
+                'db_table': 'risks_administrativedivisiongeometry',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='administrativedivisiongeometry',
+            unique_together=set([('administrative_division', 'tolerance')]),
+        ),
+    ]
@@ -18,16 +18,22 @@
 #
 #########################################################################
 
+import copy
+
 from django.urls import reverse
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, signals
 from mptt.models import MPTTModel, TreeForeignKey
 from django.core import files
 from geonode.base.models import ResourceBase, TopicCategory
 from geonode.layers.models import Layer, Style
 
 from jsonfield import JSONField
-import xlrd
+
+from .caching import ANALYSES, DIVISIONS, METADATA, bump_analysis, bump_versions, get_versions
+
+# code -> ancestors chain of Administrative Divisions, see AdministrativeDivision.get_location_chain()
+_location_chains = {}
 
 
 class RiskApp(models.Model):
@@ -222,11 +228,13 @@ class AnalysisType(RiskAppAware, HazardTypeAware, LocationAware, Exportable, mod
         ht = self.get_hazard_type()
         return self.get_url('analysis_type', loc.code, ht.mnemonic, self.name)
 
-    def get_risk_analysis_list(self, **kwargs):
+    def get_risk_analysis_list(self, extended=False, **kwargs):
         loc = self.get_location()
         ht = self.get_hazard_type().set_location(loc)
+        related = RiskAnalysis.EXPORT_RELATED_EXTENDED if extended else RiskAnalysis.EXPORT_RELATED
         ra = self.riskanalysis_analysistype.filter(hazard_type=ht,
-                                                   administrative_divisions__in=[loc])
+                                                   administrative_divisions__in=[loc])\
+                                           .select_related(*related)
         if kwargs:
             ra = ra.filter(**kwargs)
         risk_analysis = [r.set_location(loc)
@@ -276,8 +284,30 @@ class HazardType(RiskAppAware, LocationAware, Exportable, models.Model):
         db_table = 'risks_hazardtype'
         verbose_name_plural = 'Hazards'
 
+    @classmethod
+    def get_for_location(cls, app, loc):
+        """
+        Returns the Hazard Types of the app set to the location, with their
+        Risk Analysis counts and default Analysis Types fetched in bulk
+        """
+        hazard_types = [ht.set_app(app).set_location(loc) for ht in cls.objects.filter(app=app)]
+        ra = RiskAnalysis.objects.filter(administrative_divisions=loc,
+                                         hazard_type__app=app)
+        counts = dict(ra.order_by().values_list('hazard_type').annotate(total=models.Count('id')))
+        default_types = {}
+        for ht_id, at_name in ra.filter(app=app, analysis_type__app=app)\
+                                .order_by('analysis_type__name')\
+                                .values_list('hazard_type', 'analysis_type__name'):
+            default_types.setdefault(ht_id, at_name)
+        for ht in hazard_types:
+            ht._risk_analysis_count = counts.get(ht.id, 0)
+            ht._default_analysis_type = default_types.get(ht.id)
+        return hazard_types
+
     @property
     def risk_analysis_count(self):
+        if hasattr(self, '_risk_analysis_count'):
+            return self._risk_analysis_count
         loc = self.get_location()
         ra = RiskAnalysis.objects.filter(administrative_divisions=loc,
                                          hazard_type=self)
@@ -289,15 +319,19 @@ class HazardType(RiskAppAware, LocationAware, Exportable, models.Model):
                                          app=self.app,
                                          hazard_type=self)
 
-        at = AnalysisType.objects.filter(riskanalysis_analysistype__in=ra, app=self.app).distinct()
+        at = AnalysisType.objects.filter(riskanalysis_analysistype__in=ra, app=self.app)\
+                                 .select_related('app').distinct()
         return at
 
     def default_analysis_type(self):
         loc = self.get_location()
-        at = self.get_analysis_types()
-        if at.exists():
-            at = at.first()
-            return {'href': self.get_url('analysis_type', loc.code, self.mnemonic, at.name)}
+        if hasattr(self, '_default_analysis_type'):
+            at_name = self._default_analysis_type
+        else:
+            at = self.get_analysis_types().first()
+            at_name = at.name if at else None
+        if at_name:
+            return {'href': self.get_url('analysis_type', loc.code, self.mnemonic, at_name)}
         else:
             return {}
 
@@ -337,6 +371,10 @@ class RiskAnalysis(RiskAppAware, Schedulable, LocationAware, HazardTypeAware, An
                               ('referenceStyle', 'get_reference_style',),
                               ('additionalTables', 'get_additional_data',),
                               ('hazardSet', 'get_hazard_set_extended',))
+    # related objects used by the exports above
+    EXPORT_RELATED = ('app', 'hazardset__topic_category',)
+    EXPORT_RELATED_EXTENDED = EXPORT_RELATED + ('layer', 'style', 'reference_layer', 'reference_style',
+                                                'hazardset__poc', 'hazardset__author', 'hazardset__country',)
 
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=30, null=False, blank=False,
@@ -425,6 +463,18 @@ class RiskAnalysis(RiskAppAware, Schedulable, LocationAware, HazardTypeAware, An
         db_table = 'risks_riskanalysis'
         verbose_name_plural = 'Risks Analysis'
 
+    def get_axis_map(self):
+        """
+        Returns the layer attribute of each axis, queried once per instance
+        """
+        if getattr(self, '_axis_map', None) is None:
+            axis_map = {}
+            for axis, layer_attribute in RiskAnalysisDymensionInfoAssociation.get_axis(self)\
+                                                                             .values_list('axis', 'layer_attribute'):
+                axis_map.setdefault(axis, layer_attribute)
+            self._axis_map = axis_map
+        return self._axis_map
+
     def get_risk_details(self, dimension=None):
         """
         Returns dictionary with selected fields for
@@ -555,13 +605,38 @@ class AdministrativeDivision(RiskAppAware, Exportable, MPTTModel):
         order_insertion_by = ['name']
 
     def get_parents_chain(self):
-        parent = self.parent
-        out = []
-        while parent is not None:
-            out.append(parent)
-            parent = parent.parent
-        out.reverse()
-        return out
+        """
+        Returns the ancestors of the division, from the root, with a single query
+        """
+        chain = list(self.get_ancestors()) + [self]
+        # so that parent lookups along the chain don't query again
+        for parent, child in zip(chain, chain[1:]):
+            child.parent = parent
+        return chain[:-1]
+
+    @classmethod
+    def get_location_chain(cls, code):
+        """
+        Returns the division with the given code preceded by its ancestors,
+        None if it doesn't exist. Chains are cached in the process until
+        any division changes.
+        """
+        (version,) = get_versions(DIVISIONS)
+        if _location_chains.get('version') != version:
+            _location_chains.clear()
+            _location_chains['version'] = version
+        chain = _location_chains.get(code)
+        if chain is None:
+            try:
+                loc = cls.objects.get(code=code)
+            except cls.DoesNotExist:
+                return
+            chain = _location_chains[code] = loc.get_parents_chain() + [loc]
+        # copies, as views set the app on the returned divisions
+        locations = [copy.copy(location) for location in chain]
+        for parent, child in zip(locations, locations[1:]):
+            child.parent = parent
+        return locations
 
 
 class Region(models.Model):
@@ -659,11 +734,20 @@ class DymensionInfo(RiskAnalysisAware, Exportable, models.Model):
 
     def get_axis(self):
         risk = self.get_risk_analysis()
-        return self.riskanalysis_associacion.filter(riskanalysis=risk).order_by('order')
+        cached = getattr(self, '_axis', None)
+        if cached is None or cached[0] is not risk:
+            axis = list(self.riskanalysis_associacion.filter(riskanalysis=risk)
+                                                     .select_related('resource__resource__category',
+                                                                     'resource__resource__license')
+                                                     .order_by('order'))
+            for ax in axis:
+                ax.riskanalysis = risk
+            cached = self._axis = (risk, axis,)
+        return cached[1]
 
     def get_axis_values(self):
         axis = self.get_axis()
-        return list(axis.values_list('value', flat=True))
+        return [a.value for a in axis]
 
     def get_axis_layers(self):
         axis = self.get_axis()
@@ -671,7 +755,7 @@ class DymensionInfo(RiskAnalysisAware, Exportable, models.Model):
 
     def get_axis_order(self):
         axis = self.get_axis()
-        return list(axis.values_list('value', 'order'))
+        return [(a.value, a.order,) for a in axis]
 
     def get_axis_layer_attributes(self):
         axis = self.get_axis()
@@ -762,27 +846,21 @@ class RiskAnalysisDymensionInfoAssociation(models.Model):
         """
         return cls.objects.filter(riskanalysis=risk).order_by('order')
 
-    def axis_to_dim(self):
+    def axis_to_dim(self, axis_map=None):
         """
         return dimX_value for axis
         """
-        risk = self.riskanalysis
-        axis = self.get_axis(risk)
-        for ax in axis:
-            if self.axis == ax.axis:
-                return ax.layer_attribute
+        if axis_map is None:
+            axis_map = self.riskanalysis.get_axis_map()
+        if self.axis in axis_map:
+            return axis_map[self.axis]
         return self.DIM[self.axis]
 
-    def axis_attribute(self):
+    def axis_attribute(self, axis_map=None):
         """
         return dX for axis
         """
-        risk = self.riskanalysis
-        axis = self.get_axis(risk)
-        for ax in axis:
-            if self.axis == ax.axis:
-                return 'd{}'.format(ax.layer_attribute[3:])
-        return 'd{}'.format(self.DIM[self.axis][3:])
+        return 'd{}'.format(self.axis_to_dim(axis_map)[3:])
 
 
 class PointOfContact(Exportable, models.Model):
@@ -1083,7 +1161,7 @@ class FurtherResource(models.Model):
             qparams = qparams & Q(Q(analysistypefurtherresourceassociation__hazard_type=htype)|Q(analysistypefurtherresourceassociation__hazard_type__isnull=True))
         else:
             qparams = qparams & Q(analysistypefurtherresourceassociation__hazard_type__isnull=True)
-        return cls.objects.filter(qparams).distinct()
+        return cls.objects.filter(qparams).select_related('resource__category', 'resource__license').distinct()
 
     @classmethod
     def for_dymension_info(cls, dyminfo, region=None, ranalysis=None):
@@ -1111,7 +1189,7 @@ class FurtherResource(models.Model):
             qparams = qparams & Q(Q(dymensioninfofurtherresourceassociation__riskanalysis__isnull=True)|Q(dymensioninfofurtherresourceassociation__riskanalysis=ranalysis))
         else:
             qparams = qparams & Q(dymensioninfofurtherresourceassociation__riskanalysis__isnull = True)
-        return cls.objects.filter(qparams).distinct()
+        return cls.objects.filter(qparams).select_related('resource__category', 'resource__license').distinct()
 
     @classmethod
     def for_hazard_set(cls, hset, region=None):
@@ -1134,7 +1212,7 @@ class FurtherResource(models.Model):
         else:
             qparams = qparams & Q(hazard_set__region__isnull=True)
 
-        return cls.objects.filter(qparams).distinct()
+        return cls.objects.filter(qparams).select_related('resource__category', 'resource__license').distinct()
 
 
 class AnalysisTypeFurtherResourceAssociation(models.Model):
@@ -1396,24 +1474,75 @@ class AdditionalData(Exportable, models.Model):
 
     @classmethod
     def import_from_sheet(cls, risk, sheet_file, name=None, sheets=None):
-        wb = xlrd.open_workbook(filename=sheet_file)
+        from .importers import WorkbookReader
         out = []
-        for sheet in wb.sheets():
-            col_names = [item.value for item in sheet.row(0)]
-            # first row in column 0 belongs to column names
-            row_names = [item.value for item in sheet.col(0)[1:]]
+        with WorkbookReader(sheet_file) as reader:
+            for sheet_name in reader.sheet_names():
+                rows = reader.rows(sheet_name)
+                col_names = next(rows, [])
+                # first row in column 0 belongs to column names
+                row_names = []
+                values = []
+                for row in rows:
+                    row_names.append(row[0] if row else '')
+                    values.append(row[1:])
+
+                data = {'column_names': col_names,
+                        'row_names': row_names,
+                        'values': values}
+
+                ad = cls.objects.create(name=sheet_name, risk_analysis=risk, data=data)
+                out.append(ad)
+        return out
 
-            values = []
-            for rnum in range(1, sheet.nrows):
-                values.append([item.value for item in sheet.row(rnum)[1:]])
 
-            data = {'column_names': col_names,
-                    'row_names': row_names,
-                    'values': values}
+class RiskDataCube(models.Model):
+    """
+    Values of a Risk Analysis for an Administrative Division, sorted along a
+    Dimension, as served by the data extraction API.
+    Built from the datastore when the Risk Data is imported.
+    """
+    id = models.AutoField(primary_key=True)
+    adm_code = models.CharField(max_length=30, null=False, blank=False)
+    values = JSONField(null=False, blank=False, default=[])
+
+    # Relationships
+    risk_analysis = models.ForeignKey(RiskAnalysis, related_name='data_cubes')
+    dymensioninfo = models.ForeignKey(DymensionInfo, related_name='data_cubes')
+
+    def __str__(self):
+        return u"{0}".format(self.risk_analysis.name + " - " + self.adm_code +
+                             " - " + self.dymensioninfo.name)
+
+    class Meta:
+        """
+        """
+        db_table = 'risks_riskdatacube'
+        unique_together = (('risk_analysis', 'adm_code', 'dymensioninfo',),)
+
+
+class AdministrativeDivisionGeometry(models.Model):
+    """
+    GeoJSON geometry of an Administrative Division, simplified with a
+    tolerance, as served by the geometry API.
+    Built when first requested and dropped when the division is saved.
+    """
+    id = models.AutoField(primary_key=True)
+    tolerance = models.FloatField(null=False, default=0)
+    geojson = models.TextField(null=False, blank=False)
+
+    # Relationships
+    administrative_division = models.ForeignKey(AdministrativeDivision, related_name='geometries')
+
+    def __str__(self):
+        return u"{0} - {1}".format(self.administrative_division.code, self.tolerance)
+
+    class Meta:
+        """
+        """
+        db_table = 'risks_administrativedivisiongeometry'
+        unique_together = (('administrative_division', 'tolerance',),)
 
-            ad = cls.objects.create(name=sheet.name, risk_analysis=risk, data=data)
-            out.append(ad)
-        return out
 
 def create_risks_apps(apps, schema_editor):
     RA = apps.get_model('geonode_risks', 'RiskApp')
@@ -1426,3 +1555,46 @@ def uncreate_risks_apps(apps, schema_editor):
 
 def get_risk_app_default():
     return RiskApp.objects.get(name=RiskApp.APP_DATA_EXTRACTION).id
+
+
+def invalidate_risks_api_cache(instance, sender, **kwargs):
+    """
+    Bump the risks API cache versions depending on a changed object.
+    """
+    if isinstance(instance, (AdministrativeDivision, Region,)):
+        bump_versions(DIVISIONS)
+        _location_chains.clear()
+    elif isinstance(instance, RiskAnalysis):
+        bump_analysis(instance.pk)
+    else:
+        analysis_id = getattr(instance, 'risk_analysis_id', None) or getattr(instance, 'riskanalysis_id', None)
+        if analysis_id:
+            bump_analysis(analysis_id)
+        else:
+            bump_versions(METADATA, ANALYSES)
+
+
+for cached_model in (RiskApp, AnalysisType, HazardType, RiskAnalysis, AdministrativeDivision, Region,
+                     DymensionInfo, RiskAnalysisAdministrativeDivisionAssociation,
+                     RiskAnalysisDymensionInfoAssociation, PointOfContact, HazardSet, FurtherResource,
+                     AnalysisTypeFurtherResourceAssociation, DymensionInfoFurtherResourceAssociation,
+                     HazardSetFurtherResourceAssociation, AdditionalData,):
+    signals.post_save.connect(invalidate_risks_api_cache, sender=cached_model)
+    signals.post_delete.connect(invalidate_risks_api_cache, sender=cached_model)
+signals.m2m_changed.connect(invalidate_risks_api_cache, sender=RiskAnalysis.additional_layers.through)
+signals.m2m_changed.connect(invalidate_risks_api_cache, sender=Region.administrative_divisions.through)
+# the responses embed the layers, styles and resource metadata of GeoNode
+for geonode_model in (ResourceBase, Layer, Style,):
+    signals.post_save.connect(invalidate_risks_api_cache, sender=geonode_model)
+    signals.post_delete.connect(invalidate_risks_api_cache, sender=geonode_model)
+
+
+def drop_division_geometries(instance, sender, **kwargs):
+    """
+    Drop the stored geometries of a saved Administrative Division, they are
+    built again from its geom when requested.
+    """
+    AdministrativeDivisionGeometry.objects.filter(administrative_division=instance).delete()
+
+
+signals.post_save.connect(drop_division_geometries, sender=AdministrativeDivision)
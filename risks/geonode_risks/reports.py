@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+"""
+PDF reports rendered in Celery tasks.
+
+Reports are identified by a hash of their inputs and stored as
+reports/<hash>.pdf in the default storage, so identical requests reuse an
+already rendered PDF. The rendering state of each report is kept in the
+Django cache, along with the renderer slots limiting how many reports are
+rendered at once (RISKS_PDF_RENDERERS).
+"""
+
+import os
+import time
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+from .pdf_helpers import generate_pdf
+
+log = logging.getLogger(__name__)
+
+PDF_RENDERERS = getattr(settings, 'RISKS_PDF_RENDERERS', 2)
+# seconds a report may render for
+PDF_TIMEOUT = getattr(settings, 'RISKS_PDF_TIMEOUT', 5 * 60)
+# seconds a report may wait for a free renderer
+PDF_WAIT = getattr(settings, 'RISKS_PDF_WAIT', 5 * 60)
+# pending states and renderer slots outlive the wait and the rendering
+PDF_STATE_TTL = PDF_WAIT + PDF_TIMEOUT
+PDF_CACHE_TTL = getattr(settings, 'RISKS_PDF_CACHE_TTL', 24 * 60 * 60)
+
+REPORTS_DIR = 'reports'
+KEY_PREFIX = 'geonode_risks:pdf'
+
+REPORT_READY = 'ready'
+REPORT_PENDING = 'pending'
+REPORT_ERROR = 'error'
+
+
+def _state_key(report_hash):
+    return '{}:state:{}'.format(KEY_PREFIX, report_hash)
+
+
+def get_report_path(report_hash):
+    return default_storage.path(os.path.join(REPORTS_DIR, '{}.pdf'.format(report_hash)))
+
+
+def get_report_state(report_hash):
+    """
+    Returns the state of a report, None if it was never requested
+    """
+    path = get_report_path(report_hash)
+    if os.path.exists(path) and os.path.getmtime(path) > time.time() - PDF_CACHE_TTL:
+        return REPORT_READY
+    return cache.get(_state_key(report_hash))
+
+
+def queue_report(report_hash):
+    """
+    Marks a report as pending, returns False if it already is
+    """
+    key = _state_key(report_hash)
+    if cache.add(key, REPORT_PENDING, PDF_STATE_TTL):
+        return True
+    if cache.get(key) == REPORT_ERROR:
+        # requested again after a failure
+        cache.set(key, REPORT_PENDING, PDF_STATE_TTL)
+        return True
+    return False
+
+
+def refresh_report(report_hash):
+    """
+    Keeps a report pending while its task waits for a renderer or renders it
+    """
+    cache.set(_state_key(report_hash), REPORT_PENDING, PDF_STATE_TTL)
+
+
+def acquire_renderer_slot():
+    """
+    Returns the key of a free renderer slot, None if all of them are taken
+    """
+    for slot in range(PDF_RENDERERS):
+        key = '{}:renderer:{}'.format(KEY_PREFIX, slot)
+        # slots of crashed renderers are freed on timeout
+        if cache.add(key, os.getpid(), PDF_STATE_TTL):
+            return key
+
+
+def release_renderer_slot(key):
+    cache.delete(key)
+
+
+def render_report(report_hash, urls, clear_state=True):
+    """
+    Renders the report documents to the report path, clear_state removes
+    the pending state set by queue_report
+    """
+    path = get_report_path(report_hash)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # created meanwhile by another renderer
+            pass
+    tmp_path = '{}.{}.pdf'.format(path[:-len('.pdf')], os.getpid())
+    try:
+        generate_pdf(urls=urls, pdf=tmp_path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    if clear_state:
+        cache.delete(_state_key(report_hash))
+    return path
+
+
+def fail_report(report_hash):
+    cache.set(_state_key(report_hash), REPORT_ERROR, PDF_STATE_TTL)
+
+
+def purge_reports():
+    """
+    Removes the reports older than RISKS_PDF_CACHE_TTL
+    """
+    reports_dir = default_storage.path(REPORTS_DIR)
+    if not os.path.isdir(reports_dir):
+        return
+    expired = time.time() - PDF_CACHE_TTL
+    for name in os.listdir(reports_dir):
+        path = os.path.join(reports_dir, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.unlink(path)
+        except OSError:
+            pass
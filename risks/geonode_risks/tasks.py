@@ -18,6 +18,7 @@
 #
 #########################################################################
 
+import os
 import StringIO
 import traceback
 
@@ -25,9 +26,28 @@ from django.conf import settings
 from django.core.mail import send_mail
 from django.core.management import call_command
 
+from celery import chord
+from celery.backends.base import DisabledBackend
+
 from geonode.celery_app import app
 
-from .models import RiskAnalysis, HazardSet
+from .models import RiskAnalysis, HazardSet, RiskAnalysisDymensionInfoAssociation
+from .datacubes import build_risk_data_cubes
+from .reports import (PDF_WAIT, acquire_renderer_slot, fail_report, purge_reports,
+                      refresh_report, release_renderer_slot, render_report)
+
+# split the Risk Data imports in one Celery task for each Scenario
+RISKS_PARALLEL_IMPORT = getattr(settings, 'RISKS_PARALLEL_IMPORT', False)
+# seconds between the attempts of PDF reports waiting for a free renderer
+RISKS_PDF_RETRY_DELAY = getattr(settings, 'RISKS_PDF_RETRY_DELAY', 5)
+
+
+def can_run_chords():
+    """
+    Chords need a result backend storing the results of their tasks
+    """
+    return not app.conf.task_ignore_result and not isinstance(app.backend, DisabledBackend)
+
 
 def create_risk_analysis(input_file, file_ini):
     _create_risk_analysis.apply_async(args=(input_file, file_ini))
@@ -85,24 +105,23 @@ def import_risk_data(input_file, risk_app, risk_analysis, region, final_name):
         'interval_step': 0.2,
         'interval_max': 0.2,
     })
-def _import_risk_data(input_file, risk_app_name, risk_analysis_name, region_name, final_name):
-        out = StringIO.StringIO()
+def _import_risk_data(self, input_file, risk_app_name, risk_analysis_name, region_name, final_name):
         risk = None
         try:
             risk = RiskAnalysis.objects.get(name=risk_analysis_name)
             risk.set_processing()
-            # value = out.getvalue()
-            call_command('importriskdata',
-                         commit=False,
-                         risk_app=risk_app_name,
-                         region=region_name,
-                         excel_file=input_file,
-                         risk_analysis=risk_analysis_name,
-                         stdout=out)
-            risk.refresh_from_db()
-            risk.data_file = final_name
-            risk.save()
-            risk.set_ready()
+            scenarios = list(RiskAnalysisDymensionInfoAssociation.objects.filter(
+                riskanalysis=risk, axis='x').values_list('value', flat=True))
+            if RISKS_PARALLEL_IMPORT and len(scenarios) > 1 and can_run_chords():
+                # one chunk for each Scenario, the last one to complete finalizes the import
+                chunks = [_import_risk_data_scenario.si(input_file, risk_app_name, risk_analysis_name,
+                                                        region_name, scenario)
+                          for scenario in scenarios]
+                chord(chunks)(_finalize_risk_data_import.si(risk_analysis_name, final_name))
+            else:
+                # importriskdata builds the data cubes
+                _run_importriskdata(input_file, risk_app_name, risk_analysis_name, region_name)
+                _finalize_risk_data_import(risk_analysis_name, final_name, build_cubes=False)
         except Exception, e:
             error_message = "Sorry, the input file is not valid: {}".format(e)
             if risk is not None:
@@ -110,6 +129,55 @@ def _import_risk_data(input_file, risk_app_name, risk_analysis_name, region_name
                 risk.set_error()
             raise ValueError(error_message)
 
+
+@app.task(
+    bind=True,
+    name='geonode_risks.tasks.import_risk_data_scenario',
+    queue='default',
+    acks_late=True)
+def _import_risk_data_scenario(self, input_file, risk_app_name, risk_analysis_name, region_name, scenario):
+        try:
+            # the chord callback rebuilds the data cubes once, after all the Scenarios
+            _run_importriskdata(input_file, risk_app_name, risk_analysis_name, region_name, scenario,
+                                build_cubes=False)
+        except Exception, e:
+            error_message = "Sorry, the input file is not valid: {}".format(e)
+            RiskAnalysis.objects.get(name=risk_analysis_name).set_error()
+            raise ValueError(error_message)
+
+
+@app.task(
+    name='geonode_risks.tasks.finalize_risk_data_import',
+    queue='default',
+    acks_late=True)
+def _finalize_risk_data_import(risk_analysis_name, final_name, build_cubes=True):
+        risk = RiskAnalysis.objects.get(name=risk_analysis_name)
+        try:
+            if build_cubes:
+                build_risk_data_cubes(risk)
+        except Exception, e:
+            risk.set_error()
+            raise ValueError("Sorry, the risk data could not be processed: {}".format(e))
+        risk.data_file = final_name
+        risk.save()
+        risk.set_ready()
+
+
+def _run_importriskdata(input_file, risk_app_name, risk_analysis_name, region_name, scenario=None,
+                        build_cubes=True):
+    out = StringIO.StringIO()
+    call_command('importriskdata',
+                 commit=False,
+                 risk_app=risk_app_name,
+                 region=region_name,
+                 excel_file=input_file,
+                 risk_analysis=risk_analysis_name,
+                 scenarios=[scenario] if scenario is not None else None,
+                 build_cubes=build_cubes,
+                 stdout=out)
+    return out.getvalue()
+
+
 def import_risk_metadata(input_file, risk_app, risk_analysis, region, final_name):
     risk_analysis.set_queued()
     _import_risk_metadata.apply_async(args=(input_file, risk_app.name, risk_analysis.name, region.name, final_name,))
@@ -158,3 +226,36 @@ def _import_risk_metadata(input_file, risk_app_name, risk_analysis_name, region_
             if risk is not None:
                 risk.set_error()
             raise ValueError(error_message)
+
+
+def generate_pdf_report(report_hash, urls, input_paths):
+    _generate_pdf_report.apply_async(args=(report_hash, urls, input_paths,))
+
+
+@app.task(
+    bind=True,
+    name='geonode_risks.tasks.generate_pdf_report',
+    queue='default',
+    acks_late=True,
+    max_retries=PDF_WAIT // RISKS_PDF_RETRY_DELAY)
+def _generate_pdf_report(self, report_hash, urls, input_paths):
+    # on each attempt, so that the pending state outlives the wait
+    refresh_report(report_hash)
+    slot = acquire_renderer_slot()
+    if slot is None and self.request.retries < self.max_retries:
+        # all the renderers are busy
+        raise self.retry(countdown=RISKS_PDF_RETRY_DELAY)
+    try:
+        if slot is None:
+            raise ValueError("No renderer available")
+        render_report(report_hash, urls)
+    except Exception, e:
+        fail_report(report_hash)
+        raise ValueError("Sorry, the pdf report could not be generated: {}".format(e))
+    finally:
+        if slot is not None:
+            release_renderer_slot(slot)
+        for path in input_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+    purge_reports()
@@ -30,6 +30,7 @@ from .models import Region
 from .models import RiskAnalysis, HazardType
 from .models import AnalysisType, DymensionInfo
 from .models import RiskAnalysisDymensionInfoAssociation
+from .models import RiskAnalysisAdministrativeDivisionAssociation
 from .tests import RisksTestCase
 
 TESTDATA_FILE_INI = os.path.join(
@@ -194,6 +195,14 @@ class RisksSmokeTests(RisksTestCase):
         self.assertIsNotNone(value2)
         self.assertEqual(value1, value2)
 
+        # Administrative Divisions are associated once
+        risk = RiskAnalysis.objects.get(name=TEST_RISK_ANALYSIS)
+        associations = RiskAnalysisAdministrativeDivisionAssociation.objects.filter(riskanalysis=risk)
+        self.assertTrue(associations.exists())
+        self.assertEqual(
+            associations.count(),
+            associations.values('administrativedivision').distinct().count())
+
     def test_smoke_createanalysis(self):
         """
         Execute smoke tests in a predefined order
@@ -22,11 +22,14 @@ from __future__ import print_function
 
 import os
 import json
+import mock
 import types
 
 from StringIO import StringIO
 
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from factory.django import DjangoModelFactory
 from factory import SubFactory
@@ -36,7 +39,12 @@ from geonode.base.models import ResourceBase
 from .models import (DymensionInfo, AnalysisType, RiskAnalysis, 
                      Layer, FurtherResource, AdministrativeDivision,
                      AnalysisTypeFurtherResourceAssociation,
-                     HazardType)
+                     HazardType, RiskDataCube,
+                     RiskAnalysisAdministrativeDivisionAssociation,
+                     AdministrativeDivisionGeometry)
+from .views import FeaturesSource
+from .reports import get_report_path
+from .tasks import _generate_pdf_report
 from .tests import RisksTestCase
 from .tests.smoke import (TESTDATA_FILE_INI, TESTDATA_FILE_DATA,
                           TEST_RISK_ANALYSIS, TEST_REGION, 
@@ -183,6 +191,71 @@ class RisksViewTestCase(RisksTestCase):
         self.assertEqual(len(resp_data['riskAnalysisData']['additionalLayers']), len(to_add))
 
 
+    def test_location_chain(self):
+        """
+        Check that location chains are read with one query and cached
+
+        """
+        division = AdministrativeDivision.objects.order_by('-level').first()
+        # saving a division drops the cached chains
+        division.save()
+        expected = []
+        parent = division
+        while parent is not None:
+            expected.insert(0, parent.code)
+            parent = parent.parent
+        queries = 2 if len(expected) > 1 else 1
+
+        with self.assertNumQueries(queries):
+            chain = AdministrativeDivision.get_location_chain(division.code)
+        self.assertEqual([location.code for location in chain], expected)
+        with self.assertNumQueries(0):
+            cached = AdministrativeDivision.get_location_chain(division.code)
+            self.assertEqual([location.parent_id for location in cached[1:]],
+                             [location.id for location in cached[:-1]])
+        self.assertIsNot(cached[-1], chain[-1])
+        self.assertIsNone(AdministrativeDivision.get_location_chain('INVALID'))
+
+        division.save()
+        with self.assertNumQueries(queries):
+            AdministrativeDivision.get_location_chain(division.code)
+
+    def test_geometry_views(self):
+        """
+        Check that simplified geometries are stored and served with an ETag
+
+        """
+        loc = AdministrativeDivision.objects.get(code='AF')
+        url = '/risks/data_extraction/geom/AF/'
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['type'], 'FeatureCollection')
+        self.assertEqual(data['features'][0]['properties']['label'], loc.name)
+        self.assertEqual(len(data['features']), 1 + loc.children.count())
+        self.assertTrue(AdministrativeDivisionGeometry.objects.filter(administrative_division=loc,
+                                                                      tolerance=0).exists())
+
+        resp = self.client.get(url, {'zoom': 3})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.content)['features']), len(data['features']))
+        self.assertTrue(AdministrativeDivisionGeometry.objects.filter(administrative_division=loc,
+                                                                      tolerance__gt=0).exists())
+        self.assertEqual(self.client.get(url, {'zoom': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'zoom': 2000}).status_code, 200)
+        self.assertEqual(self.client.get(url, {'zoom': -5}).status_code, 200)
+        self.assertEqual(self.client.get(url, {'tolerance': 'nan'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'tolerance': 'inf'}).status_code, 400)
+
+        etag = resp['ETag']
+        resp = self.client.get(url, {'zoom': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        loc.save()
+        self.assertFalse(loc.geometries.exists())
+        resp = self.client.get(url, {'zoom': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
     def test_data_views(self):
         """
         Check if data views returns proper data
@@ -269,6 +342,86 @@ class RisksViewTestCase(RisksTestCase):
                 # cannot evaluate
                 #self.assertTrue(len(data['riskAnalysisData']['data']['values'])>0)
 
+    def test_data_cubes(self):
+        """
+        Check that data extraction is served from the precomputed data cubes
+
+        """
+        risk = RiskAnalysis.objects.get(name=TEST_RISK_ANALYSIS)
+        cubes = RiskDataCube.objects.filter(risk_analysis=risk)
+        self.assertTrue(cubes.exists())
+        self.assertEqual(cubes.count(), cubes.values('adm_code', 'dymensioninfo').distinct().count())
+
+        with mock.patch.object(FeaturesSource, 'get_features') as get_features:
+            resp = self.get_risk_analysis('/risks/data_extraction/loc/AF/')
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(get_features.called)
+        data = json.loads(resp.content)
+        dimension = DymensionInfo.objects.get(name=data['riskAnalysisData']['data']['dimensions'][0]['name'])
+        cube = cubes.get(adm_code='AF', dymensioninfo=dimension)
+        self.assertTrue(len(cube.values) > 0)
+        self.assertEqual(data['riskAnalysisData']['data']['values'], cube.values)
+
+    def test_versioned_cache(self):
+        """
+        Check that cached responses are dropped when the Risk Analysis or its
+        layer changes
+
+        """
+        risk = RiskAnalysis.objects.get(name=TEST_RISK_ANALYSIS)
+        resp = self.get_risk_analysis('/risks/data_extraction/loc/AF/')
+        url = resp.wsgi_request.get_full_path()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp['X-Risks-Cache'], 'HIT')
+        cached = json.loads(resp.content)
+
+        risk.descriptor_file = 'changed.ini'
+        risk.save()
+        resp = self.client.get(url)
+        self.assertEqual(resp['X-Risks-Cache'], 'MISS')
+        self.assertEqual(json.loads(resp.content), cached)
+
+        # the responses embed the GeoNode layers too
+        resp = self.client.get(url)
+        self.assertEqual(resp['X-Risks-Cache'], 'HIT')
+        risk.layer.save()
+        resp = self.client.get(url)
+        self.assertEqual(resp['X-Risks-Cache'], 'MISS')
+
+    def test_export_queries(self):
+        """
+        Check that exporting more Hazard Types and Risk Analysis doesn't
+        run more queries
+
+        """
+        def count_queries(url):
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            return len(ctx.captured_queries)
+
+        risk = RiskAnalysis.objects.get(name=TEST_RISK_ANALYSIS)
+        loc = AdministrativeDivision.objects.get(code='AF')
+        urls = ('/risks/data_extraction/loc/AF/',
+                '/risks/data_extraction/loc/AF/ht/{}/'.format(risk.hazard_type.mnemonic),
+                '/risks/data_extraction/loc/AF/ht/{}/at/{}/an/{}/'.format(risk.hazard_type.mnemonic,
+                                                                          risk.analysis_type.name,
+                                                                          risk.id),)
+        queries = [count_queries(url) for url in urls]
+
+        for idx in range(3):
+            HazardType.objects.create(mnemonic='HT{}'.format(idx), title='Hazard {}'.format(idx),
+                                      order=100 + idx, app=risk.app)
+            copy = RiskAnalysis.objects.get(id=risk.id)
+            copy.id = None
+            copy.name = '{}_{}'.format(risk.name[:25], idx)
+            copy.save()
+            RiskAnalysisAdministrativeDivisionAssociation.objects.create(riskanalysis=copy,
+                                                                         administrativedivision=loc)
+
+        self.assertEqual([count_queries(url) for url in urls], queries)
+
     def get_risk_analysis(self, url):
         client = self.client
         resp = client.get(url)
@@ -302,3 +455,51 @@ class RisksViewTestCase(RisksTestCase):
         self.assertTrue(pdf_data['success'])
         
         
+
+    def test_pdf_report_queue(self):
+        """
+        Check that a report is queued once, pending until rendered and
+        then streamed
+
+        """
+        report = self.get_risk_analysis('/risks/data_extraction/loc/AF/')
+        pdf_url = json.loads(report.content)['pdfReport']
+
+        def post():
+            upload_data = {'map': open(PDF_INPUT_TEST, 'rb'),
+                           'chart_0': open(PDF_INPUT_TEST, 'rb'),
+                           'dims': 'Scenario',
+                           'dimsVal': 'Base'}
+            return self.client.post('{}?async=1'.format(pdf_url), upload_data)
+
+        def fake_pdf(urls, pdf, **kwargs):
+            with open(pdf, 'wb') as f:
+                f.write('%PDF-1.4 test')
+            return pdf
+
+        with mock.patch('geonode_risks.views.generate_pdf_report') as generate_pdf_report:
+            resp = post()
+            self.assertEqual(resp.status_code, 202)
+            data = json.loads(resp.content)
+            self.assertEqual(data['status'], 'pending')
+            self.assertEqual(self.client.get(data['pdf']).status_code, 202)
+
+            # the pending report is not queued again
+            self.assertEqual(post().status_code, 202)
+            self.assertEqual(generate_pdf_report.call_count, 1)
+            report_hash, urls, input_paths = generate_pdf_report.call_args[0]
+
+        with mock.patch('geonode_risks.reports.generate_pdf', side_effect=fake_pdf):
+            _generate_pdf_report.apply(args=(report_hash, urls, input_paths,))
+        try:
+            self.assertFalse([path for path in input_paths if os.path.exists(path)])
+            resp = self.client.get(data['pdf'])
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp['Content-Type'], 'application/pdf')
+            self.assertEqual(''.join(resp.streaming_content), '%PDF-1.4 test')
+
+            resp = post()
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.content)['status'], 'ready')
+        finally:
+            os.unlink(get_report_path(report_hash))
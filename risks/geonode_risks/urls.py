@@ -34,6 +34,8 @@ geometry_urls = [
 ]
 api_urls = [
     url(r'risk/(?P<risk_id>[\d]+)/layers/$', views.risk_layers, name='layers'),
+    url(r'cache/$', views.cache_stats, name='cache_stats'),
+    url(r'report/(?P<report_hash>[0-9a-f]{32})/$', views.pdf_report_result, name='pdf_report_result'),
 ]
 
 urlpatterns = [
@@ -21,6 +21,7 @@
 from __future__ import print_function
 import os
 import json
+import hashlib
 import logging
 
 from django.conf import settings
@@ -29,10 +30,10 @@ from django.views.generic import TemplateView, View, FormView
 from django.urls import reverse
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile, File
-from django.http import HttpResponse, FileResponse
+from django.http import FileResponse
 from django.template.loader import render_to_string
+from django.utils import translation
 from django.utils.crypto import get_random_string
-from django.views.decorators.cache import cache_page
 
 
 from geonode.layers.models import Layer
@@ -41,10 +42,14 @@ from geonode.base.forms import ValuesListField
 from .models import (HazardType, AdministrativeDivision,
                                           RiskAnalysisDymensionInfoAssociation,
                                           RiskAnalysis, DymensionInfo, AnalysisType,
-                                          FurtherResource, RiskApp)
+                                          FurtherResource, RiskApp, RiskDataCube)
 
 from .datasource import GeoserverDataSource
-from .pdf_helpers import generate_pdf
+from .datacubes import sort_feature_values
+from .caching import DIVISIONS, METADATA, analysis_version, get_cache_stats, get_versions, versioned_cache
+from .reports import (REPORT_ERROR, REPORT_PENDING, REPORT_READY, acquire_renderer_slot,
+                      get_report_path, get_report_state, queue_report, release_renderer_slot, render_report)
+from .tasks import RISKS_PDF_RETRY_DELAY, generate_pdf_report
 
 cost_benefit_index = TemplateView.as_view(template_name='risks/cost_benefit_index.html')
 
@@ -58,7 +63,10 @@ class AppAware(object):
 
     def get_app(self):
         app_name = self.get_app_name()
-        return RiskApp.objects.get(name=app_name)
+        app = getattr(self, '_app', None)
+        if app is None or app.name != app_name:
+            app = self._app = RiskApp.objects.get(name=app_name)
+        return app
 
 class ContextAware(AppAware):
 
@@ -227,7 +235,8 @@ class FeaturesSource(object):
 
     def get_dim_association(self, analysis, dyminfo):
         ass_list = RiskAnalysisDymensionInfoAssociation.objects.filter(riskanalysis=analysis, dymensioninfo=dyminfo)
-        dim_list = set([a.axis_to_dim() for a in ass_list])
+        axis_map = analysis.get_axis_map()
+        dim_list = set([a.axis_to_dim(axis_map) for a in ass_list])
         if len(dim_list) != 1:
             raise ValueError("Cannot query more than one dimension at the moment, got {}".format(len(dim_list)))
 
@@ -288,12 +297,7 @@ cost_benefit_index = RiskIndexView.as_view()
 class LocationSource(object):
 
     def get_location(self, **kwargs):
-        try:
-            loc = AdministrativeDivision.objects.get(code=kwargs['loc'])
-        except AdministrativeDivision.DoesNotExist:
-            return
-        locations = loc.get_parents_chain() + [loc]
-        return locations
+        return AdministrativeDivision.get_location_chain(kwargs['loc'])
 
 
 class LocationView(ContextAware, LocationSource, View):
@@ -304,13 +308,13 @@ class LocationView(ContextAware, LocationSource, View):
             return json_response(errors=['Invalid location code'], status=404)
         loc = locations[-1]
         app = self.get_app()
-        hazard_types = HazardType.objects.filter(app=app)
+        hazard_types = HazardType.get_for_location(app, loc)
 
 
         location_data = {'navItems': [location.set_app(app).export() for location in locations],
                          'context': self.get_context_url(**kwargs),
                          'furtherResources': self.get_further_resources(**kwargs),
-                         'overview': [ht.set_location(loc).export() for ht in hazard_types]}
+                         'overview': [ht.export() for ht in hazard_types]}
 
         return json_response(location_data)
 
@@ -376,7 +380,7 @@ class HazardTypeView(ContextAware, LocationSource, View):
     def get_hazard_type(self, location, **kwargs):
         app = self.get_app()
         try:
-            return HazardType.objects.get(mnemonic=kwargs['ht'], app=app).set_location(location)
+            return HazardType.objects.get(mnemonic=kwargs['ht'], app=app).set_app(app).set_location(location)
         except (KeyError, HazardType.DoesNotExist,):
             return
 
@@ -396,7 +400,7 @@ class HazardTypeView(ContextAware, LocationSource, View):
             return json_response(errors=['Invalid location code'], status=404)
         loc = locations[-1]
         app = self.get_app()
-        hazard_types = HazardType.objects.filter(app=app)
+        hazard_types = HazardType.get_for_location(app, loc)
 
         hazard_type = self.get_hazard_type(loc, **kwargs)
 
@@ -408,7 +412,7 @@ class HazardTypeView(ContextAware, LocationSource, View):
             return json_response(errors=['No analysis type available for location/hazard type'], status=404)
 
         out = {'navItems': [location.set_app(app).export() for location in locations],
-               'overview': [ht.set_location(loc).export() for ht in hazard_types],
+               'overview': [ht.export() for ht in hazard_types],
                'context': self.get_context_url(**kwargs),
                'furtherResources': self.get_further_resources(**kwargs),
                'hazardType': hazard_type.get_hazard_details(),
@@ -492,63 +496,43 @@ class DataExtractionView(FeaturesSource, HazardTypeView):
 
     """
 
+    def get_data_dimensions(self, risk, dimension, dimensions):
+        return [dimension.set_risk_analysis(risk)] + [d.set_risk_analysis(risk) for d in dimensions if d.id != dimension.id]
+
     def reformat_features(self, risk, dimension, dimensions, features):
         """
         Returns risk data as proper structure
 
         """
-        values = []
-        dims = [dimension.set_risk_analysis(risk)] + [d.set_risk_analysis(risk) for d in dimensions if d.id != dimension.id]
+        dims = self.get_data_dimensions(risk, dimension, dimensions)
 
         _fields = [self.get_dim_association(risk, d) for d in dims]
         fields = ['{}_value'.format(f[1]) for f in _fields]
         field_orders = ['{}_order'.format(f[1]) for f in _fields]
 
-        orders = [dict(d.get_axis_order()) for d in dims]
-
-        orders_len = len(orders)
-
-        def make_order_val(feat):
-            """
-            compute order value
-            """
-            _order_vals = []
-
-            for idx, o in enumerate(orders):
-                field_name = field_orders[idx]
-                val = feat['properties'].get(field_name)
-                # order_val = o.get(val)
-                order_val = val
-
-                if order_val is None:
-                    order_val = 0
-                # 111 > 1, 1, 1
-                # mag = 10 ** (orders_len - idx)
-                mag = 1000 if idx == 0 else 1
-                _order_vals.append(int('{}'.format(order_val * mag)))
-            # return ''.join(_order_vals)
-            return sum(_order_vals)
-
-        def order_key(val):
-            # order by last val
-            order = val.pop(-1)
-            return order
-
-        for feat in features:
-            p = feat['properties']
-            line = []
-            [line.append(p[f]) for f in fields]
-            line.append(p['value'])
-            line.append(make_order_val(feat))
-            values.append(line)
-
-        values.sort(key=order_key)
+        values = sort_feature_values(features, fields, field_orders)
 
         out = {'dimensions': [dim.set_risk_analysis(risk).export() for dim in dims],
                'values': values}
 
         return out
 
+    def get_risk_data(self, risk, dimension, dimensions, loc, **kwargs):
+        """
+        Returns risk data from the precomputed data cubes, querying GeoServer
+        for Risk Analysis imported before the cubes were introduced
+        """
+        cube = RiskDataCube.objects.filter(risk_analysis=risk, adm_code=loc.code, dymensioninfo=dimension).first()
+        if cube is not None or risk.data_cubes.exists():
+            dims = self.get_data_dimensions(risk, dimension, dimensions)
+            return {'dimensions': [dim.export() for dim in dims],
+                    'values': cube.values if cube is not None else []}
+
+        feat_kwargs = self.url_kwargs_to_query_params(**kwargs)
+        feat_kwargs['risk_analysis'] = risk.name
+        features = self.get_features(risk, dimension, dimensions, **feat_kwargs)
+        return self.reformat_features(risk, dimension, dimensions, features['features'])
+
     def get(self, request, *args, **kwargs):
         locations = self.get_location(**kwargs)
         app = self.get_app()
@@ -565,7 +549,7 @@ class DataExtractionView(FeaturesSource, HazardTypeView):
         if not atype:
             return json_response(errors=['No analysis type available for location/hazard type'], status=404)
 
-        risks = atype.get_risk_analysis_list(id=kwargs['an'])
+        risks = atype.get_risk_analysis_list(extended=True, id=kwargs['an'])
         if not risks:
             return json_response(errors=['No risk analysis found for given parameters'], status=404)
         risk = risks[0]
@@ -577,10 +561,7 @@ class DataExtractionView(FeaturesSource, HazardTypeView):
         else:
             dimension = dymlist.filter(riskanalysis_associacion__axis=self.AXIS_X).distinct().get()
 
-        feat_kwargs = self.url_kwargs_to_query_params(**kwargs)
-        feat_kwargs['risk_analysis'] = risk.name
-        features = self.get_features(risk, dimension, dymlist, **feat_kwargs)
-        out['riskAnalysisData']['data'] = self.reformat_features(risk, dimension, dymlist, features['features'])
+        out['riskAnalysisData']['data'] = self.get_risk_data(risk, dimension, dymlist, loc, **kwargs)
         out['context'] = self.get_context_url(**kwargs)
         out['wms'] = {'style': None,
                       'viewparams': self.get_viewparams(risk, hazard_type, loc),
@@ -810,15 +791,70 @@ class PDFReportView(ContextAware, FormView):
         log.error("Cannot generate pdf: %s: %s", self.request.build_absolute_uri(), form.errors)
         return json_response(out, status=400)
 
+    def get_report_hash(self, form):
+        """
+        Returns the hash of the report inputs: uploads, url context, language
+        and the versions of the risks data the report shows
+        """
+        md5 = hashlib.md5()
+        versions = get_versions(DIVISIONS, METADATA, analysis_version(self.kwargs['an']))
+        md5.update(json.dumps([sorted(self.kwargs.items()), translation.get_language(), versions,
+                               settings.RISKS['PDF_GENERATOR']['NAME']]))
+        for k, v in sorted(form.cleaned_data.items()):
+            md5.update(k)
+            if v is None:
+                continue
+            if isinstance(v, File):
+                for chunk in v.chunks():
+                    md5.update(chunk)
+                v.seek(0)
+            else:
+                md5.update(json.dumps(v))
+        return md5.hexdigest()
+
     def form_valid(self, form):
         ctx = self.get_context_url(_full=True, **self.kwargs)
-
-        r = self.request
-        out = {'success': True}
         app = self.get_app()
-        config = {}
 
-        randomizer = get_random_string(7)
+        # identical requests share the rendered report
+        randomizer = report_hash = self.get_report_hash(form)
+        if not self.request.GET.get('async'):
+            # clients polling for the report ask for it, the others get the pdf in the response
+            return self.render_report_now(form, ctx, app, report_hash)
+        if get_report_state(report_hash) == REPORT_READY or not queue_report(report_hash):
+            return self.report_response(report_hash)
+
+        cleanup_paths = self.save_report_inputs(form, ctx, randomizer)
+        generate_pdf_report(report_hash, self.get_document_urls(app, randomizer), cleanup_paths)
+        return self.report_response(report_hash)
+
+    def render_report_now(self, form, ctx, app, report_hash):
+        """
+        Renders the report in the request, unless it is already rendered
+        """
+        if get_report_state(report_hash) != REPORT_READY:
+            slot = acquire_renderer_slot()
+            if slot is None:
+                response = json_response(errors=['All the pdf renderers are busy'], status=503)
+                response['Retry-After'] = RISKS_PDF_RETRY_DELAY
+                return response
+            # inputs apart from the ones of a report rendering in background
+            randomizer = get_random_string(7)
+            cleanup_paths = self.save_report_inputs(form, ctx, randomizer)
+            try:
+                # the state belongs to the background rendering of the same report, if any
+                render_report(report_hash, self.get_document_urls(app, randomizer), clear_state=False)
+            finally:
+                release_renderer_slot(slot)
+                for path in cleanup_paths:
+                    if os.path.exists(path):
+                        os.unlink(path)
+        return report_file_response(report_hash)
+
+    def save_report_inputs(self, form, ctx, randomizer):
+        """
+        Saves the form data read by the report page, returns their paths
+        """
         cleanup_paths = []
         for k, v in form.cleaned_data.items():
             if v is None:
@@ -826,52 +862,21 @@ class PDFReportView(ContextAware, FormView):
             if not isinstance(v, File):
                 target_path = os.path.join(ctx, '{}_{}.txt'.format(k, randomizer))
                 v = ContentFile(json.dumps(v))
-                target_path = default_storage.save(target_path, v)
-                cleanup_paths.append(default_storage.path(target_path))
-                
             else:
-                basename, ext = os.path.splitext(v.name)
                 target_path = os.path.join(ctx, '{}_{}.png'.format(k, randomizer))
-                target_path = default_storage.save(target_path, v)
-                cleanup_paths.append(default_storage.path(target_path))
-
-            if settings.TEST:
-                full_path = default_storage.path(target_path)
-                target_path = full_path
-            else:
-                target_path = default_storage.url(target_path)
-
-            config[k] = target_path
-
-        pdf_path = default_storage.path(os.path.join(ctx, 'report_{}.pdf'.format(randomizer)))
-        cleanup_paths.append(pdf_path)
-        config['pdf'] = pdf_path
-        config['urls'] = self.get_document_urls(app, randomizer)
-
-        pdf = generate_pdf(**config)
-        out['pdf'] = pdf
-
-        def cleanup():
-            self.cleanup(cleanup_paths)
-
-        with open(pdf, 'rb') as fd:
-            data = fd.read()
-
-
-        resp = HttpResponse(data, content_type='application/pdf')
-        resp['Content-Disposition'] = 'attachment; filename="report.pdf"'
-        cleanup()
-        return resp
-
-        #return CleaningFileResponse(f, on_close=cleanup)
-
-    def cleanup(self, paths):
-        for path in paths:
-            if os.path.exists(path):
-                try:
-                    os.unlink(path)
-                except OSError, err:
-                    print('error when removing', path, err)
+            # the report reads the inputs by name
+            if default_storage.exists(target_path):
+                default_storage.delete(target_path)
+            target_path = default_storage.save(target_path, v)
+            cleanup_paths.append(default_storage.path(target_path))
+        return cleanup_paths
+
+    def report_response(self, report_hash):
+        state = get_report_state(report_hash)
+        out = {'success': state != REPORT_ERROR,
+               'status': state,
+               'pdf': reverse('risks:api:pdf_report_result', args=(report_hash,))}
+        return json_response(out, status=200 if state == REPORT_READY else 202)
 
     def render_report_markup(self, ctx, request, *args, **kwargs):
 
@@ -885,11 +890,39 @@ class PDFReportView(ContextAware, FormView):
 
         return html_path_absolute
 
-CACHE_TTL = 120
-location_view = cache_page(CACHE_TTL)(LocationView.as_view()) 
-hazard_type_view = cache_page(CACHE_TTL)(HazardTypeView.as_view())
-analysis_type_view = cache_page(CACHE_TTL)(HazardTypeView.as_view())
-data_extraction = cache_page(CACHE_TTL)(DataExtractionView.as_view())
+location_view = versioned_cache(LocationView.as_view())
+hazard_type_view = versioned_cache(HazardTypeView.as_view())
+analysis_type_view = versioned_cache(HazardTypeView.as_view())
+data_extraction = versioned_cache(DataExtractionView.as_view())
+
+
+def cache_stats(request):
+    """
+    Hit/miss counters of the risks API cache
+    """
+    if not request.user.is_staff:
+        return json_response(errors=['Forbidden'], status=403)
+    return json_response(get_cache_stats())
+
+
+def report_file_response(report_hash):
+    resp = FileResponse(open(get_report_path(report_hash), 'rb'), content_type='application/pdf')
+    resp['Content-Disposition'] = 'attachment; filename="report.pdf"'
+    return resp
+
+
+def pdf_report_result(request, report_hash):
+    """
+    Streams a rendered PDF report, or returns the state of its rendering
+    """
+    state = get_report_state(report_hash)
+    if state == REPORT_READY:
+        return report_file_response(report_hash)
+    if state == REPORT_PENDING:
+        return json_response({'success': True, 'status': state}, status=202)
+    if state == REPORT_ERROR:
+        return json_response(errors=['Cannot generate pdf'], status=500)
+    return json_response(errors=['Invalid report'], status=404)
 
 risk_layers = RiskLayersView.as_view()
 pdf_report = PDFReportView.as_view()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction, DatabaseError
+
+TABLE = 'gazetteer_gazetteerentry'
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # prefix search mode, istartswith
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS gazetteer_placename_upper_index '
+        'ON {} (UPPER(place_name) text_pattern_ops)'.format(TABLE))
+
+    # fulltext search mode, previously set up by hand
+    schema_editor.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS placename_tsv tsvector'.format(TABLE))
+    schema_editor.execute(
+        "UPDATE {} SET placename_tsv = to_tsvector('english', coalesce(place_name, '')) "
+        "WHERE placename_tsv IS NULL".format(TABLE))
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS placename_tsv_index ON {} USING gin(placename_tsv)'.format(TABLE))
+    schema_editor.execute('DROP TRIGGER IF EXISTS tsvectorupdate ON {}'.format(TABLE))
+    schema_editor.execute(
+        'CREATE TRIGGER tsvectorupdate BEFORE INSERT OR UPDATE ON {} FOR EACH ROW EXECUTE PROCEDURE '
+        "tsvector_update_trigger(placename_tsv, 'pg_catalog.english', place_name)".format(TABLE))
+
+    # trigram search mode, pg_trgm may need to be installed by a superuser
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            schema_editor.execute(
+                'CREATE INDEX IF NOT EXISTS gazetteer_placename_trgm_index '
+                'ON {} USING gin(place_name gin_trgm_ops)'.format(TABLE))
+    except DatabaseError as e:
+        print('Could not create the gazetteer trigram index, needed by the trigram search mode: %s' % e)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS gazetteer_placename_upper_index')
+    schema_editor.execute('DROP INDEX IF EXISTS gazetteer_placename_trgm_index')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gazetteer', '0003_auto_20180316_1109'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction, DatabaseError
+
+TABLE = 'gazetteer_gazetteerentry'
+
+
+def create_trigram_gist_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # trigram search mode, the <-> ordering needs a GiST index
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            schema_editor.execute(
+                'CREATE INDEX IF NOT EXISTS gazetteer_placename_trgm_gist_index '
+                'ON {} USING gist(place_name gist_trgm_ops)'.format(TABLE))
+            schema_editor.execute('DROP INDEX IF EXISTS gazetteer_placename_trgm_index')
+    except DatabaseError as e:
+        print('Could not create the gazetteer trigram index, needed by the trigram search mode: %s' % e)
+
+
+def drop_trigram_gist_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute(
+                'CREATE INDEX IF NOT EXISTS gazetteer_placename_trgm_index '
+                'ON {} USING gin(place_name gin_trgm_ops)'.format(TABLE))
+    except DatabaseError as e:
+        print('Could not create the gazetteer trigram index: %s' % e)
+    schema_editor.execute('DROP INDEX IF EXISTS gazetteer_placename_trgm_gist_index')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gazetteer', '0004_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_gist_index, drop_trigram_gist_index),
+    ]
@@ -1,7 +1,11 @@
 import json
+import mock
 from lxml import etree
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase, Client
+from django.utils.six.moves import reload_module
+from . import utils
 from .utils import getGazetteerEntry
 
 
@@ -53,6 +57,41 @@ class GazetteerTest(TestCase):
             self.assertContains(response, text="base:CA1", html=False, status_code=200)
             self.assertContains(response, text="base:CA2", html=False, status_code=200)
 
+    def test_gazetteer_paging(self):
+        """
+        Verify that the pages of each search mode return all the placenames once,
+        the ranked modes giving the same rank to all of them
+        """
+        if settings.USE_WORLDMAP:
+            c = Client()
+            for mode in ('prefix', 'fulltext', 'trigram'):
+                with mock.patch.object(utils, 'GAZETTEER_SEARCH_MODE', mode):
+                    placenames = []
+                    response = c.get("/gazetteer/Paradise", {'limit': 2})
+                    while True:
+                        page = json.loads(response.content)
+                        self.assertTrue(len(page) <= 2)
+                        placenames.extend(placename["placename"] for placename in page)
+                        if 'X-Gazetteer-Next-Cursor' not in response:
+                            break
+                        response = c.get("/gazetteer/Paradise",
+                                         {'limit': 2, 'cursor': response['X-Gazetteer-Next-Cursor']})
+                    self.assertEquals(["Paradise1", "Paradise2", "Paradise3", "Paradise4", "Paradise5"],
+                                      placenames, mode)
+
+            response = c.get("/gazetteer/Paradise", {'cursor': 'invalid'})
+            self.assertEquals(400, response.status_code)
+
+    def test_invalid_search_mode(self):
+        """
+        Verify that an unknown search mode is rejected when the module is loaded
+        """
+        try:
+            with self.settings(GAZETTEER_SEARCH_MODE='substring'):
+                self.assertRaises(ImproperlyConfigured, reload_module, utils)
+        finally:
+            reload_module(utils)
+
     def test_gazetteer_project(self):
         if settings.USE_WORLDMAP:
             c = Client()
@@ -1,4 +1,6 @@
 import re
+import json
+import base64
 import logging
 import psycopg2
 
@@ -6,6 +8,8 @@ from geopy import geocoders
 
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 from django.db.models import Q
 
 from geonode.maps.models import Layer, MapLayer, Map
@@ -16,20 +20,40 @@ from .models import GazetteerEntry
 
 GAZETTEER_TABLE = 'gazetteer_gazetteerentry'
 
+# prefix: case insensitive prefix match, ordered by place name
+# fulltext: prefix match of the words in placename_tsv, ranked with ts_rank
+# trigram: pg_trgm similarity match, ordered by trigram distance
+GAZETTEER_SEARCH_MODE = getattr(
+    settings, 'GAZETTEER_SEARCH_MODE',
+    'fulltext' if getattr(settings, 'GAZETTEER_FULLTEXTSEARCH', False) else 'prefix')
+if GAZETTEER_SEARCH_MODE not in ('prefix', 'fulltext', 'trigram'):
+    raise ImproperlyConfigured('Invalid GAZETTEER_SEARCH_MODE %s, expected prefix, fulltext or trigram'
+                               % GAZETTEER_SEARCH_MODE)
+# maximum number of results of a page
+GAZETTEER_PAGE_SIZE = getattr(settings, 'GAZETTEER_PAGE_SIZE', 500)
+# minimum similarity of the place names matched by the trigram mode
+GAZETTEER_TRIGRAM_THRESHOLD = getattr(settings, 'GAZETTEER_TRIGRAM_THRESHOLD', 0.3)
+
+# the placename_tsv column and the indexes of the search modes are created
+# by the 0004_search_indexes and 0005_trigram_gist_index migrations
+SEARCH_MATCH = {
+    'fulltext': '{}.placename_tsv @@ to_tsquery(%s)'.format(GAZETTEER_TABLE),
+    'trigram': '{}.place_name %% %s'.format(GAZETTEER_TABLE),
+}
+SEARCH_RANK = {
+    'fulltext': 'ts_rank({}.placename_tsv, to_tsquery(%s))'.format(GAZETTEER_TABLE),
+    'trigram': '{}.place_name <-> %s'.format(GAZETTEER_TABLE),
+}
+# ordering of the ranks from the best match, and comparison of the ranks after the cursor
+SEARCH_ORDER = {
+    'fulltext': ('-rank', '<'),
+    'trigram': ('rank', '>'),
+}
+
 __author__ = 'mbertrand'
 
 logger = logging.getLogger("geonode.gazetteer.utils")
 
-'''
-ALTER TABLE gazetteer_gazetteerentry ADD COLUMN placename_tsv tsvector;
-CREATE INDEX placename_tsv_index on gazetteer_gazetteerentry using gin(placename_tsv);
-UPDATE gazetteer_gazetteerentry SET text_search =
-     to_tsvector('english', coalesce(place_name,''));
-CREATE TRIGGER tsvectorupdate BEFORE INSERT OR UPDATE
-  ON gazetteer_gazetteerentry FOR EACH ROW EXECUTE PROCEDURE
-  tsvector_update_trigger(placename_tsv, 'pg_catalog.english', place_name);
-'''
-
 
 def get_geometry_type(layer):
     """
@@ -63,39 +87,82 @@ def getGazetteerEntry(input_id):
 
 
 def formatSourceLink(layer_name):
-    if Layer.objects.filter(name=layer_name).exists():
-        layer = Layer.objects.get(name=layer_name)
-        return "<a href='{0}data/{1}' target='_blank'>{2}</a>".format(settings.SITEURL, layer.typename, layer.name)
-    else:
-        return "This layer does not exist anymore"
+    return getSourceLinks([layer_name])[layer_name]
+
+
+def getSourceLinks(layer_names):
+    """
+    Return the source links of the layers by layer name, fetching all the layers at once
+    """
+    links = dict((layer_name, "This layer does not exist anymore") for layer_name in layer_names)
+    found = set()
+    for layer in Layer.objects.filter(name__in=set(layer_names)).order_by('id'):
+        if layer.name not in found:
+            found.add(layer.name)
+            links[layer.name] = "<a href='{0}data/{1}' target='_blank'>{2}</a>".format(
+                settings.SITEURL, layer.typename, layer.name)
+    return links
+
+
+def encodeCursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    """
+    Return the [order value, id] of the last result of the previous page,
+    raises ValueError for an invalid cursor
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %s' % cursor)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor %s' % cursor)
+    return values
 
 
 def getGazetteerResults(place_name, map=None, layer=None, start_date=None, end_date=None, project=None, user=None):
     """
-    Return placenames from gazetteer that match certain filters:
-        place_name: text to do a LIKE search for
+    Return the first page of placenames from gazetteer that match certain filters,
+    see getGazetteerPage
+    """
+    return getGazetteerPage(place_name, map, layer, start_date, end_date, project, user)[0]
+
+
+def getGazetteerPage(place_name, map=None, layer=None, start_date=None, end_date=None, project=None, user=None,
+                     cursor=None, limit=None):
+    """
+    Return a page of placenames from gazetteer that match certain filters,
+    and the cursor of the next page (None for the last page):
+        place_name: text to search, as set by GAZETTEER_SEARCH_MODE
         map: search all layers that are present in this map (map id)
         layer: search only this layer (layer name)
         start_date: return only matches with a start date >= this value
         end_date: return only matches with an end date <= this value
         project: only return matches within the specified project
+        cursor: the cursor returned with the previous page
+        limit: the number of results of the page, at most GAZETTEER_PAGE_SIZE
     """
+    limit = min(limit or GAZETTEER_PAGE_SIZE, GAZETTEER_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('Invalid limit %s' % limit)
+    mode = GAZETTEER_SEARCH_MODE
+    last = decodeCursor(cursor) if cursor else None
+
     layers = []
     if map:
         mapObject = get_object_or_404(Map, pk=map)
-        maplayers = MapLayer.objects.filter(map=mapObject.id)
-        for maplayer in maplayers:
-            try:
-                layer = Layer.objects.get(typename=maplayer.name)
-                layers.append(layer.name)
-            except Exception:
-                logger.info("Could not find %s", maplayer.name)
+        maplayers = list(MapLayer.objects.filter(map=mapObject.id).values_list('name', flat=True))
+        layers = list(Layer.objects.filter(typename__in=maplayers).values_list('name', flat=True))
+        if len(layers) < len(set(maplayers)):
+            logger.info("Could not find some of %s", maplayers)
 
     elif layer:
         layers = [layer]
 
     # The following retrieves results using the GazetteerEntry model.
-    criteria = Q() if settings.GAZETTEER_FULLTEXTSEARCH else Q(place_name__istartswith=place_name)
+    criteria = Q(place_name__istartswith=place_name) if mode == 'prefix' else Q()
     if layers:
         criteria = criteria & Q(layer_name__in=layers)
 
@@ -136,23 +203,58 @@ def getGazetteerResults(place_name, map=None, layer=None, start_date=None, end_d
     if user:
         criteria = criteria & Q(username__exact=user)
 
-    matchingEntries = (GazetteerEntry.objects.extra(
-        where=['placename_tsv @@ to_tsquery(%s)'],
-        params=[re.sub(r"\s+", " & ", place_name.strip()) + ":*"]).filter(criteria))[:500] \
-        if settings.GAZETTEER_FULLTEXTSEARCH else GazetteerEntry.objects.filter(criteria)
+    if mode == 'prefix':
+        matchingEntries = GazetteerEntry.objects.filter(criteria).order_by('place_name', 'id')
+        if last:
+            matchingEntries = matchingEntries.filter(Q(place_name__gt=last[0]) |
+                                                     Q(place_name=last[0], id__gt=last[1]))
+    else:
+        if mode == 'fulltext':
+            # to_tsquery fails on its own operators
+            words = re.sub(r"[^\w\s]", " ", place_name, flags=re.UNICODE).split()
+            if not words:
+                return [], None
+            query = " & ".join(words) + ":*"
+            match_param = query
+        else:
+            query = match_param = place_name
+        order, after = SEARCH_ORDER[mode]
+        matchingEntries = GazetteerEntry.objects.extra(
+            select={'rank': SEARCH_RANK[mode]}, select_params=[query],
+            where=[SEARCH_MATCH[mode]], params=[match_param]).filter(criteria).order_by(order, 'id')
+        if last:
+            # results ranked worse, or equally and after the last one; ranks are real,
+            # so the cursor value is compared as real too
+            matchingEntries = matchingEntries.extra(
+                where=['({rank} {after} %s::real OR ({rank} = %s::real AND {table}.id > %s))'.format(
+                    rank=SEARCH_RANK[mode], after=after, table=GAZETTEER_TABLE)],
+                params=[query, float(last[0]), query, float(last[0]), int(last[1])])
+        if mode == 'trigram':
+            # the threshold of the % operator, set on the connection running the search
+            with connections[matchingEntries.db].cursor() as cursor:
+                cursor.execute('SELECT set_limit(%s)', [GAZETTEER_TRIGRAM_THRESHOLD])
+
+    entries = list(matchingEntries[:limit + 1])
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        last_entry = entries[-1]
+        next_cursor = encodeCursor([last_entry.place_name if mode == 'prefix' else last_entry.rank, last_entry.id])
+
+    links = getSourceLinks([entry.layer_name for entry in entries])
     posts = []
-    for entry in matchingEntries:
+    for entry in entries:
         posts.append(
             {
                 'placename': entry.place_name,
                 'coordinates': (entry.latitude, entry.longitude),
-                'source': formatSourceLink(entry.layer_name),
+                'source': links[entry.layer_name],
                 'start_date': entry.start_date,
                 'end_date': entry.end_date,
                 'gazetteer_id': entry.id
             }
         )
-    return posts
+    return posts, next_cursor
 
 
 def delete_from_gazetteer(layer_name):
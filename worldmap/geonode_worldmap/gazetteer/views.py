@@ -3,12 +3,12 @@ from dicttoxml import dicttoxml
 import logging
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render
 
 from geonode.layers.views import _resolve_layer
 
-from .utils import add_to_gazetteer, getGazetteerResults, getGazetteerEntry, getExternalServiceResults
+from .utils import add_to_gazetteer, getGazetteerPage, getGazetteerEntry, getExternalServiceResults
 from .models import GazetteerAttribute
 
 logger = logging.getLogger("geonode.contrib.worldmap.gazetteer.views")
@@ -19,6 +19,9 @@ def search(request, place_name, map=None, layer=None,
            user=None, format='json'):
     """
     Search the Gazetteer and return results in JSON or XML format.
+    The WorldMap results are paged: the cursor of the next page, if any, is
+    returned in the X-Gazetteer-Next-Cursor header, to be sent back with the
+    cursor parameter. The limit parameter sets the number of results of a page.
     """
     if not format:
         out_format = 'json'
@@ -27,20 +30,34 @@ def search(request, place_name, map=None, layer=None,
     if out_format not in ('xml', 'json'):
         out_format = 'json'
 
+    try:
+        limit = int(request.GET['limit']) if 'limit' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest('Invalid limit', content_type="text/plain")
+
     posts = []
+    next_cursor = None
     if 'worldmap' in services:
         if place_name.isdigit():
             posts = getGazetteerEntry(place_name)
         else:
-            posts = getGazetteerResults(place_name, map, layer, start_date, end_date, project, user)
+            try:
+                posts, next_cursor = getGazetteerPage(place_name, map, layer, start_date, end_date, project, user,
+                                                      cursor=request.GET.get('cursor'), limit=limit)
+            except ValueError as e:
+                return HttpResponseBadRequest(str(e), content_type="text/plain")
     if services is not None:
         posts.extend(getExternalServiceResults(place_name, services))
     if out_format == 'json':
-        return HttpResponse(json.dumps(posts, sort_keys=True, indent=4),
-                            content_type="application/json")
+        response = HttpResponse(json.dumps(posts, sort_keys=True, indent=4),
+                                content_type="application/json")
     elif out_format == 'xml':
-        return HttpResponse(dicttoxml([{'resource': post} for post in posts], attr_type=False, custom_root='response'),
-                            content_type="application/xml")
+        response = HttpResponse(dicttoxml([{'resource': post} for post in posts], attr_type=False,
+                                          custom_root='response'),
+                                content_type="application/xml")
+    if next_cursor:
+        response['X-Gazetteer-Next-Cursor'] = next_cursor
+    return response
 
 
 @login_required
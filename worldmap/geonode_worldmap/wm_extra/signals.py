@@ -1,10 +1,14 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import Group
 
-from geonode.layers.models import Layer
-from geonode.maps.models import Map
+from geonode.base.models import TopicCategory
+from geonode.layers.models import Attribute, Layer
+from geonode.maps.models import Map, MapLayer
 from geonode.people.models import Profile
 
+from .utils import clear_topic_categories, touch_viewer_configs
+
 
 def save_profile(sender, instance, created, **kwargs):
     """
@@ -44,7 +48,50 @@ def validate_wm_map(sender, instance, **kwargs):
         instance.bbox_y1 = y1
 
 
+def drop_topic_categories(sender, instance, **kwargs):
+    """
+    Drop the topic categories cached by the process.
+    """
+    clear_topic_categories()
+    transaction.on_commit(touch_viewer_configs)
+
+
+def touch_map_viewer_config(sender, instance, **kwargs):
+    """
+    Invalidate the cached viewer configuration of a changed map.
+    """
+    # ExtMap and MapLayer link the map
+    map_id = instance.id if isinstance(instance, Map) else instance.map_id
+    # once committed, a configuration cached meanwhile would still come from the old map
+    transaction.on_commit(lambda: touch_viewer_configs(map_id))
+
+
+def touch_layer_viewer_configs(sender, instance, **kwargs):
+    """
+    Invalidate the cached viewer configurations of the maps using a changed layer.
+    """
+    if isinstance(instance, Layer):
+        layer = instance
+    elif isinstance(instance, Attribute):
+        layer = instance.layer
+    else:
+        # ExtLayerAttribute
+        layer = instance.attribute.layer
+    map_ids = list(MapLayer.objects.filter(name=layer.alternate).values_list('map_id', flat=True).distinct())
+    if map_ids:
+        transaction.on_commit(lambda: touch_viewer_configs(*map_ids))
+
+
 post_save.connect(save_profile, sender=Profile)
 post_save.connect(add_ext_layer, sender=Layer)
 post_save.connect(add_ext_map, sender=Map)
 post_save.connect(validate_wm_map, sender=Map)
+post_save.connect(drop_topic_categories, sender=TopicCategory)
+post_delete.connect(drop_topic_categories, sender=TopicCategory)
+
+for sender in (Map, MapLayer, 'wm_extra.ExtMap'):
+    post_save.connect(touch_map_viewer_config, sender=sender)
+    post_delete.connect(touch_map_viewer_config, sender=sender)
+for sender in (Layer, Attribute, 'wm_extra.ExtLayerAttribute'):
+    post_save.connect(touch_layer_viewer_configs, sender=sender)
+    post_delete.connect(touch_layer_viewer_configs, sender=sender)
@@ -0,0 +1,247 @@
+"""
+Buffered visit counters of the layers and maps.
+
+Visits are counted in the Django cache, per time bucket of WM_STATS_BUCKET
+seconds, and the first visit of an object in a bucket is logged in the
+bucket entries, so that flush_stats finds the counters to write without
+scanning the cache. flush_stats is run periodically by a Celery task and
+writes the closed buckets to LayerStats, MapStats and Map.popular_count
+with F() updates.
+
+Unique visitors are estimated with a HyperLogLog sketch per object, kept in
+the cache; each flush adds the growth of the estimate since the last flush.
+"""
+import hashlib
+import math
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from geonode.layers.models import Layer
+from geonode.maps.models import Map
+
+from .models import LayerStats, MapStats
+
+# seconds of the buckets the visits are counted in
+STATS_BUCKET = getattr(settings, 'WM_STATS_BUCKET', 60)
+# seconds the buffered visits wait for a flush before being lost
+STATS_TTL = getattr(settings, 'WM_STATS_TTL', 24 * 60 * 60)
+KEY_PREFIX = 'wm_extra:stats'
+
+LAYER = 'layer'
+MAP = 'map'
+
+# 2 ** HLL_BITS registers, about 3% of standard error
+HLL_BITS = 10
+HLL_REGISTERS = 2 ** HLL_BITS
+
+
+def _incr(key, timeout):
+    """
+    Increment a cache counter, created on first use, and return its value.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, 1, timeout):
+            return 1
+        return cache.incr(key)
+
+
+def _visits_key(bucket, kind, object_id):
+    return '{}:visits:{}:{}:{}'.format(KEY_PREFIX, bucket, kind, object_id)
+
+
+def _entries_key(bucket):
+    return '{}:entries:{}'.format(KEY_PREFIX, bucket)
+
+
+def _entry_key(bucket, number):
+    return '{}:entry:{}:{}'.format(KEY_PREFIX, bucket, number)
+
+
+def _sketch_key(kind, object_id):
+    return '{}:hll:{}:{}'.format(KEY_PREFIX, kind, object_id)
+
+
+def _flushed_key(kind, object_id):
+    return '{}:hll_flushed:{}:{}'.format(KEY_PREFIX, kind, object_id)
+
+
+def get_visitor(request):
+    """
+    Return a string identifying the visitor of a request.
+    """
+    if request.user.is_authenticated:
+        return 'user:{}'.format(request.user.pk)
+    if request.session.session_key:
+        return 'session:{}'.format(request.session.session_key)
+    return 'client:{}:{}'.format(request.META.get('REMOTE_ADDR'), request.META.get('HTTP_USER_AGENT'))
+
+
+def get_layer_id(typename):
+    """
+    Return the id of the layer with the typename, None if it does not exist.
+    """
+    key = '{}:layer_id:{}'.format(KEY_PREFIX, hashlib.md5(typename.encode('utf-8')).hexdigest())
+    layer_id = cache.get(key)
+    if layer_id is None:
+        layer_id = Layer.objects.filter(typename=typename).values_list('id', flat=True).first()
+        if layer_id is None:
+            return None
+        cache.set(key, layer_id, STATS_TTL)
+    return layer_id
+
+
+def add_visitor(kind, object_id, visitor):
+    """
+    Add a visitor to the HyperLogLog sketch of an object.
+    """
+    digest = int(hashlib.md5(visitor.encode('utf-8')).hexdigest(), 16)
+    register = digest & (HLL_REGISTERS - 1)
+    bits = (digest >> HLL_BITS) & (2 ** 64 - 1)
+    rank = 64 - bits.bit_length() + 1
+
+    key = _sketch_key(kind, object_id)
+    sketch = cache.get(key)
+    if sketch is None:
+        # the creation time tells a lost sketch from the one last flushed
+        sketch = (time.time(), bytearray(HLL_REGISTERS))
+    if sketch[1][register] < rank:
+        sketch[1][register] = rank
+        # concurrent updates may lose a register, which only lowers the estimate
+        cache.set(key, sketch, None)
+
+
+def estimate_uniques(registers):
+    """
+    Return the HyperLogLog estimate of the number of visitors of a sketch.
+    """
+    alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+    estimate = alpha * HLL_REGISTERS ** 2 / sum(2.0 ** -rank for rank in registers)
+    zeros = len([rank for rank in registers if not rank])
+    if estimate <= 2.5 * HLL_REGISTERS and zeros:
+        estimate = HLL_REGISTERS * math.log(float(HLL_REGISTERS) / zeros)
+    return int(round(estimate))
+
+
+def record_visit(kind, object_id, visitor=None):
+    """
+    Count a visit of a layer or map in the current bucket.
+    """
+    bucket = int(time.time() // STATS_BUCKET)
+    if _incr(_visits_key(bucket, kind, object_id), STATS_TTL) == 1:
+        # first visit of the object in the bucket
+        number = _incr(_entries_key(bucket), STATS_TTL)
+        cache.set(_entry_key(bucket, number), (kind, object_id), STATS_TTL)
+    if visitor:
+        add_visitor(kind, object_id, visitor)
+
+
+def get_new_uniques(kind, object_id):
+    """
+    Return the number of visitors added to the sketch of an object since the
+    last flush, and the flushed estimate to store once they are written.
+    """
+    sketch = cache.get(_sketch_key(kind, object_id))
+    if sketch is None:
+        return 0, None
+    created, registers = sketch
+    estimate = estimate_uniques(registers)
+    flushed = cache.get(_flushed_key(kind, object_id))
+    if flushed is None or flushed[0] != created:
+        # first flush of the sketch
+        flushed = (created, 0)
+    return max(estimate - flushed[1], 0), (created, max(estimate, flushed[1]))
+
+
+def _update_stats(model, field, counts):
+    """
+    Add the (visits, uniques) counts by object id to the stats, with one
+    UPDATE for each distinct pair of counts. Returns the ids of the
+    existing objects by counts.
+    """
+    related = model._meta.get_field(field).related_model
+    ids = set(related.objects.filter(id__in=counts.keys()).values_list('id', flat=True))
+    existing = set(model.objects.filter(**{'%s__in' % field: ids}).values_list(field, flat=True))
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([model(**{'%s_id' % field: object_id}) for object_id in ids - existing])
+    except IntegrityError:
+        # created meanwhile, the update below still counts the visits
+        pass
+
+    grouped = defaultdict(list)
+    for object_id in ids:
+        grouped[counts[object_id]].append(object_id)
+    now = timezone.now()
+    for (visits, uniques), object_ids in grouped.items():
+        # update() skips the auto_now of last_modified
+        model.objects.filter(**{'%s__in' % field: object_ids}).update(
+            visits=F('visits') + visits, uniques=F('uniques') + uniques, last_modified=now)
+    return grouped
+
+
+def flush_bucket(bucket):
+    """
+    Write the visits counted in a bucket to the database.
+    """
+    count = cache.get(_entries_key(bucket)) or 0
+    if not count:
+        return 0
+    entry_keys = [_entry_key(bucket, number) for number in range(1, count + 1)]
+    entries = cache.get_many(entry_keys).values()
+    visits_keys = dict((_visits_key(bucket, kind, object_id), (kind, object_id)) for kind, object_id in entries)
+    visits = cache.get_many(visits_keys.keys())
+
+    counts = {LAYER: {}, MAP: {}}
+    flushed = {}
+    for key, (kind, object_id) in visits_keys.items():
+        if visits.get(key):
+            uniques, estimate = get_new_uniques(kind, object_id)
+            counts[kind][object_id] = (visits[key], uniques)
+            if estimate is not None:
+                flushed[_flushed_key(kind, object_id)] = estimate
+    with transaction.atomic():
+        if counts[LAYER]:
+            _update_stats(LayerStats, 'layer', counts[LAYER])
+        if counts[MAP]:
+            grouped = _update_stats(MapStats, 'map', counts[MAP])
+            for (visits, uniques), object_ids in grouped.items():
+                Map.objects.filter(id__in=object_ids).update(popular_count=F('popular_count') + visits)
+
+    # the visitors are only marked as flushed once written, a failed flush counts them again
+    cache.set_many(flushed, None)
+    cache.delete_many(entry_keys + list(visits_keys.keys()) + [_entries_key(bucket)])
+    return len(visits)
+
+
+def flush_stats():
+    """
+    Write the visits of the closed buckets to the database, returns the
+    number of counters written.
+    """
+    lock = '{}:flush_lock'.format(KEY_PREFIX)
+    if not cache.add(lock, 1, 10 * 60):
+        # flushed by another worker
+        return 0
+    try:
+        current = int(time.time() // STATS_BUCKET)
+        first = current - int(STATS_TTL // STATS_BUCKET)
+        last_flushed = cache.get('{}:flushed_bucket'.format(KEY_PREFIX))
+        if last_flushed is not None:
+            first = max(first, last_flushed + 1)
+        written = 0
+        # the previous bucket may still get the visits of late requests
+        for bucket in range(first, current - 1):
+            written += flush_bucket(bucket)
+            cache.set('{}:flushed_bucket'.format(KEY_PREFIX), bucket, None)
+        return written
+    finally:
+        cache.delete(lock)
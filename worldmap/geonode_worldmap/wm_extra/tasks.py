@@ -0,0 +1,11 @@
+from celery import shared_task
+
+from . import stats
+
+
+@shared_task
+def flush_stats():
+    """
+    Write the buffered layer and map visits to the database.
+    """
+    return stats.flush_stats()
@@ -0,0 +1,247 @@
+import itertools
+import json
+import mock
+from guardian.shortcuts import assign_perm
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from geonode.layers.models import Attribute, Layer
+from geonode.maps.models import Map, MapLayer, MapSnapshot
+from . import stats, utils, views
+from .models import LayerStats, MapStats
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                             'LOCATION': 'wm_extra_tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StatsTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000 * stats.STATS_BUCKET
+        patcher = mock.patch.object(stats, 'time')
+        patcher.start().time.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+        self.layer = Layer.objects.create(name='stats_layer', alternate='geonode:stats_layer')
+        self.map = Map.objects.create(title='stats map', zoom=1, projection='EPSG:900913',
+                                      center_x=0, center_y=0)
+
+    def flush(self):
+        """
+        Flush the visits once their bucket is closed.
+        """
+        self.now += 2 * stats.STATS_BUCKET
+        return stats.flush_stats()
+
+    def test_record_visit(self):
+        """
+        Verify that the visits are written once their bucket is closed, and the
+        visitors counted once.
+        """
+        popular_count = Map.objects.get(id=self.map.id).popular_count
+        for visitor in ('user:1', 'user:2', 'user:1'):
+            stats.record_visit(stats.MAP, self.map.id, visitor)
+        for visitor in ('user:1', 'user:1'):
+            stats.record_visit(stats.LAYER, self.layer.id, visitor)
+        self.assertEquals(0, stats.flush_stats())
+        self.assertFalse(MapStats.objects.filter(map=self.map).exists())
+
+        self.assertEquals(2, self.flush())
+        map_stats = MapStats.objects.get(map=self.map)
+        self.assertEquals((3, 2), (map_stats.visits, map_stats.uniques))
+        self.assertIsNotNone(map_stats.last_modified)
+        self.assertEquals(popular_count + 3, Map.objects.get(id=self.map.id).popular_count)
+        layer_stats = LayerStats.objects.get(layer=self.layer)
+        self.assertEquals((2, 1), (layer_stats.visits, layer_stats.uniques))
+        self.assertEquals(0, self.flush())
+
+        stats.record_visit(stats.MAP, self.map.id, 'user:1')
+        stats.record_visit(stats.MAP, self.map.id, 'user:3')
+        self.assertEquals(1, self.flush())
+        map_stats = MapStats.objects.get(map=self.map)
+        self.assertEquals((5, 3), (map_stats.visits, map_stats.uniques))
+
+    def test_failed_flush(self):
+        """
+        Verify that the visits and visitors of a failed flush are written by
+        the next one.
+        """
+        stats.record_visit(stats.MAP, self.map.id, 'user:1')
+        stats.record_visit(stats.MAP, self.map.id, 'user:2')
+        with mock.patch.object(stats.Map.objects, 'filter', side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, self.flush)
+        self.assertFalse(MapStats.objects.filter(map=self.map).exists())
+
+        self.assertEquals(1, self.flush())
+        map_stats = MapStats.objects.get(map=self.map)
+        self.assertEquals((2, 2), (map_stats.visits, map_stats.uniques))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ViewerConfigTest(TransactionTestCase):
+
+    def setUp(self):
+        # a new stamp for each touch
+        patcher = mock.patch.object(utils, 'time')
+        patcher.start().time.side_effect = itertools.count(1)
+        self.addCleanup(patcher.stop)
+        self.layer = Layer.objects.create(name='viewer_layer', alternate='geonode:viewer_layer')
+        self.map = Map.objects.create(title='viewer map', zoom=1, projection='EPSG:900913',
+                                      center_x=0, center_y=0)
+        self.other_map = Map.objects.create(title='other map', zoom=1, projection='EPSG:900913',
+                                            center_x=0, center_y=0)
+        MapLayer.objects.create(map=self.map, stack_order=0, name=self.layer.alternate,
+                                layer_params='{}', source_params='{}')
+
+    def test_map_invalidation(self):
+        """
+        Verify that the viewer configuration of a map is invalidated once its
+        changes are committed.
+        """
+        key = utils.get_viewer_config_key(self.map.id)
+        other_key = utils.get_viewer_config_key(self.other_map.id)
+        with transaction.atomic():
+            self.map.save()
+            self.assertEquals(key, utils.get_viewer_config_key(self.map.id))
+        self.assertNotEquals(key, utils.get_viewer_config_key(self.map.id))
+        self.assertEquals(other_key, utils.get_viewer_config_key(self.other_map.id))
+
+        try:
+            with transaction.atomic():
+                MapLayer.objects.create(map=self.other_map, stack_order=0, name=self.layer.alternate,
+                                        layer_params='{}', source_params='{}')
+                raise DatabaseError
+        except DatabaseError:
+            pass
+        self.assertEquals(other_key, utils.get_viewer_config_key(self.other_map.id))
+
+    def test_layer_invalidation(self):
+        """
+        Verify that a layer change invalidates the viewer configurations of the
+        maps using it.
+        """
+        key = utils.get_viewer_config_key(self.map.id)
+        other_key = utils.get_viewer_config_key(self.other_map.id)
+        self.layer.save()
+        self.assertNotEquals(key, utils.get_viewer_config_key(self.map.id))
+        self.assertEquals(other_key, utils.get_viewer_config_key(self.other_map.id))
+
+    def test_viewer_permissions(self):
+        """
+        Verify that the cached viewer configuration gets the permissions of
+        each user.
+        """
+        hidden = Layer.objects.create(name='hidden_layer', alternate='geonode:hidden_layer')
+        for resource in (self.map, self.layer, hidden):
+            resource.remove_all_permissions()
+        editor = get_user_model().objects.create_user('editor', password='editor')
+        viewer = get_user_model().objects.create_user('viewer', password='viewer')
+        assign_perm('base.change_resourcebase', editor, self.map.get_self_resource())
+        for user in (editor, viewer):
+            assign_perm('base.view_resourcebase', user, self.layer.get_self_resource())
+        assign_perm('base.view_resourcebase', editor, hidden.get_self_resource())
+
+        config = {
+            'sources': {},
+            'map': {'layers': [{'name': layer.alternate, 'local': True, 'visibility': True}
+                               for layer in (self.layer, hidden)]},
+        }
+
+        def get_layers(user):
+            request = RequestFactory().get('/')
+            request.user = user
+            request.session = {}
+            viewer_config = views.get_viewer_config(request, self.map)
+            return viewer_config['edit_map'], [(layer_config['name'], layer_config.get('disabled', False))
+                                               for layer_config in viewer_config['map']['layers']]
+
+        with mock.patch.object(Map, 'viewer_json'), \
+                mock.patch.object(views, 'gxp2wm', return_value=config) as gxp2wm:
+            for user in (editor, viewer, editor):
+                self.assertEquals((user == editor, [(self.layer.alternate, False),
+                                                    (hidden.alternate, user != editor)]),
+                                  get_layers(user))
+        self.assertEquals(1, gxp2wm.call_count)
+
+
+    def test_snapshot_viewer_permissions(self):
+        """
+        Verify that the snapshot configurations get the permissions of the user.
+        """
+        self.map.remove_all_permissions()
+        editor = get_user_model().objects.create_user('editor', password='editor')
+        viewer = get_user_model().objects.create_user('viewer', password='viewer')
+        assign_perm('base.change_resourcebase', editor, self.map.get_self_resource())
+        config = {'sources': {}, 'map': {'layers': []}}
+
+        for user in (editor, viewer):
+            request = RequestFactory().get('/')
+            request.user = user
+            request.session = {}
+            with mock.patch.object(views, 'snapshot_config', return_value=config), \
+                    mock.patch.object(views, 'gxp2wm', side_effect=lambda config, map_obj: dict(config, edit_map=True)):
+                viewer_config = views.get_snapshot_viewer_config(request, self.map, 'snapshot')
+            self.assertEquals(user == editor, viewer_config['edit_map'])
+
+class ConfigQueriesTest(TestCase):
+
+    def setUp(self):
+        self.alternates = []
+        for number in range(4):
+            layer = Layer.objects.create(name='config_layer%s' % number, alternate='geonode:config_layer%s' % number,
+                                         srid='EPSG:4326', bbox_x0=-10, bbox_x1=10, bbox_y0=-10, bbox_y1=10)
+            for order, attribute in enumerate(('name', 'value')):
+                Attribute.objects.create(layer=layer, attribute=attribute, display_order=order)
+            self.alternates.append(layer.alternate)
+        # the topic categories are cached by the process
+        utils.get_topic_categories()
+
+    def make_config(self, alternates):
+        return {
+            'about': {},
+            'sources': {'0': {'url': '%sows' % settings.GEOSERVER_PUBLIC_LOCATION}},
+            'map': {'layers': [{'name': alternate, 'source': '0', 'styles': ['generic']}
+                               for alternate in alternates]},
+        }
+
+    def assertSameQueries(self, func, *configs):
+        """
+        Verify that func runs as many queries for each config.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            func(configs[0])
+        for config in configs[1:]:
+            with self.assertNumQueries(len(queries)):
+                func(config)
+
+    def test_gxp2wm_queries(self):
+        """
+        Verify that the queries of gxp2wm do not depend on the number of local layers.
+        """
+        config = views.gxp2wm(self.make_config(self.alternates))
+        self.assertEquals(self.alternates, [layer_config['name'] for layer_config in config['map']['layers']])
+        attributes = config['map']['layers'][0]['attributes']
+        self.assertEquals(['name', 'value'], [attribute['id'] for attribute in attributes])
+        self.assertSameQueries(views.gxp2wm, self.make_config(self.alternates[:1]),
+                               self.make_config(self.alternates))
+
+    def test_snapshot_config_queries(self):
+        """
+        Verify that the queries of build_snapshot_config do not depend on the
+        number of local layers.
+        """
+        map_obj = Map.objects.create(title='snapshot map', zoom=1, projection='EPSG:900913',
+                                     center_x=0, center_y=0)
+
+        def make_snapshot(alternates):
+            config = self.make_config(alternates)
+            config['sources']['0']['ptype'] = 'gxp_gnsource'
+            return MapSnapshot.objects.create(map=map_obj, config=json.dumps(config))
+
+        snapshot = make_snapshot(self.alternates)
+        config, layer_ids = views.build_snapshot_config(snapshot)
+        self.assertEquals(set(self.alternates), set(layer_ids))
+        self.assertEquals(self.alternates, [layer_config['name'] for layer_config in config['map']['layers']])
+        self.assertSameQueries(views.build_snapshot_config, make_snapshot(self.alternates[:1]), snapshot)
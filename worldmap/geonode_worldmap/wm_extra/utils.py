@@ -1,7 +1,23 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from geonode.base.models import TopicCategory
 from geonode.layers.utils import create_gs_thumbnail_geonode
-from geonode.layers.models import Layer
+from geonode.layers.models import Attribute, Layer
 from geonode.geoserver.createlayer.utils import DATA_QUALITY_MESSAGE
 
+# seconds the topic categories are cached in each process
+TOPIC_CATEGORIES_TTL = getattr(settings, 'WM_TOPIC_CATEGORIES_TTL', 10 * 60)
+_topic_categories = {}
+
+# seconds the WorldMap viewer configurations of the maps are cached
+VIEWER_CONFIG_TTL = getattr(settings, 'WM_VIEWER_CONFIG_TTL', 24 * 60 * 60)
+VIEWER_CONFIG_PREFIX = 'wm_extra:viewer_config'
+SNAPSHOT_CONFIG_PREFIX = 'wm_extra:snapshot_config'
+
 
 def create_wm_thumbnail(instance, overwrite=False):
     """
@@ -14,3 +30,62 @@ def create_wm_thumbnail(instance, overwrite=False):
             create_gs_thumbnail_geonode(instance)
     else:
         return None
+
+
+def get_topic_categories():
+    """
+    Return the [identifier, gn_description] of the topic categories, cached in the process.
+    """
+    cached = _topic_categories.get('categories')
+    if cached is None or cached[0] < time.time():
+        categories = [list(topic) for topic in TopicCategory.objects.values_list('identifier', 'gn_description')]
+        cached = _topic_categories['categories'] = (time.time() + TOPIC_CATEGORIES_TTL, categories)
+    # callers extend the list with their own groups
+    return [list(topic) for topic in cached[1]]
+
+
+def clear_topic_categories():
+    _topic_categories.clear()
+
+
+def get_config_layers(alternates):
+    """
+    Return the layers with the given alternates by alternate, with the styles,
+    category and attributes used in the map configurations fetched along.
+    """
+    if not alternates:
+        return {}
+    attributes = Attribute.objects.order_by('display_order').select_related('extlayerattribute')
+    layers = Layer.objects.filter(alternate__in=set(alternates))\
+                          .select_related('default_style', 'category')\
+                          .prefetch_related('styles',
+                                            Prefetch('attribute_set', queryset=attributes, to_attr='config_attributes'))
+    return dict((layer.alternate, layer) for layer in layers)
+
+
+def _viewer_config_stamp_key(map_id):
+    return '{}:stamp:{}'.format(VIEWER_CONFIG_PREFIX, map_id)
+
+
+def get_viewer_config_key(map_id):
+    """
+    Return the cache key of the viewer configuration of a map, which changes
+    with the last modification stamps of the map and of the topic categories.
+    """
+    keys = [_viewer_config_stamp_key(map_id), _viewer_config_stamp_key('all')]
+    stamps = cache.get_many(keys)
+    for key in keys:
+        if key not in stamps:
+            # a stamp lost by the cache restarts from the current time
+            cache.add(key, int(time.time() * 1000), None)
+            stamps[key] = cache.get(key)
+    return '{}:{}:{}:{}'.format(VIEWER_CONFIG_PREFIX, map_id, *[stamps[key] for key in keys])
+
+
+def touch_viewer_configs(*map_ids):
+    """
+    Invalidate the cached viewer configurations of the maps, or of all the
+    maps when no map is given.
+    """
+    stamp = int(time.time() * 1000)
+    cache.set_many(dict((_viewer_config_stamp_key(map_id), stamp) for map_id in map_ids or ('all', )), None)
@@ -6,10 +6,10 @@ import urlparse
 
 from six import string_types
 
-from guardian.shortcuts import get_perms
+from guardian.shortcuts import get_objects_for_user, get_perms
 
 from django.conf import settings
-from django.db.models import F
+from django.core.cache import cache
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.serializers.json import DjangoJSONEncoder
@@ -18,7 +18,7 @@ from django.shortcuts import render, get_object_or_404
 from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import csrf_exempt
 
-from geonode.base.models import TopicCategory
+from geonode.base.models import ResourceBase
 from geonode.documents.models import get_related_documents
 from geonode.geoserver.helpers import ogc_server_settings
 from geonode.layers.models import Layer
@@ -30,14 +30,20 @@ from geonode.utils import (
     DEFAULT_TITLE, DEFAULT_ABSTRACT,
     forward_mercator, default_map_config,
     llbbox_to_mercator, bbox_to_projection,
-    build_social_links, num_encode
+    build_social_links, num_encode, num_decode,
+    layer_from_viewer_config
 )
 
 from geonode.security.views import _perms_info_json
 
-from .models import LayerStats, ExtLayerAttribute
+from . import stats
+from .models import ExtLayerAttribute
 from .forms import EndpointForm
 from .encode import despam, XssCleaner
+from .utils import (
+    get_config_layers, get_topic_categories, get_viewer_config_key,
+    SNAPSHOT_CONFIG_PREFIX, VIEWER_CONFIG_TTL
+)
 
 
 _PERMISSION_MSG_LOGIN = _("You must be logged in to save this map")
@@ -57,6 +63,11 @@ def snapshot_create(request):
             config=clean_config(conf),
             map=Map.objects.get(
                 id=config['id']))
+        try:
+            get_snapshot_config(snapshot)
+        except Exception as e:
+            # resolved again when the snapshot is loaded
+            print 'Could not resolve the configuration of snapshot %s: %s' % (snapshot.id, str(e))
         return HttpResponse(num_encode(snapshot.id), content_type="text/plain")
     else:
         return HttpResponse(
@@ -67,7 +78,7 @@ def snapshot_create(request):
 
 def ajax_snapshot_history(request, mapid):
     map_obj = Map.objects.get(pk=mapid)
-    snapshots = MapSnapshot.objects.filter(map=map_obj)
+    snapshots = MapSnapshot.objects.filter(map=map_obj).select_related('map', 'user')
     history = [snapshot.json() for snapshot in snapshots]
     return HttpResponse(json.dumps(history), content_type="text/plain")
 
@@ -227,18 +238,9 @@ def ajax_increment_layer_stats(request):
         return HttpResponseNotAllowed('Only POST is supported')
 
     if request.POST['layername'] != '':
-        layer_match = Layer.objects.filter(typename=request.POST['layername'])[:1]
-        for l in layer_match:
-            layerStats, created = LayerStats.objects.get_or_create(layer=l)
-            layerStats.visits += 1
-            first_visit = True
-            if request.session.get('visitlayer' + str(l.id), False):
-                first_visit = False
-            else:
-                request.session['visitlayer' + str(l.id)] = True
-            if first_visit or created:
-                layerStats.uniques += 1
-            layerStats.save()
+        layer_id = stats.get_layer_id(request.POST['layername'])
+        if layer_id is not None:
+            stats.record_visit(stats.LAYER, layer_id, stats.get_visitor(request))
 
     return HttpResponse(
         status=200
@@ -273,14 +275,14 @@ def map_view_wm(request, mapid, snapshot=None, layer_name=None, template='wm_ext
         'base.view_resourcebase',
         _PERMISSION_MSG_VIEW)
 
-    if snapshot is None:
-        config = map_obj.viewer_json(request)
-    else:
-        config = snapshot_config(snapshot, map_obj, request)
     if layer_name:
-        config = add_layers_to_map_config(request, map_obj, (layer_name, ), False)
-
-    config = gxp2wm(config, map_obj)
+        config = gxp2wm(add_layers_to_map_config(request, map_obj, (layer_name, ), False), map_obj)
+        # the layers the user cannot view are skipped by add_layers_to_map_config
+        config = apply_viewer_permissions(request, map_obj, config, {})
+    elif snapshot is None:
+        config = get_viewer_config(request, map_obj)
+    else:
+        config = get_snapshot_viewer_config(request, map_obj, snapshot)
 
     return render(request, template, {
         'config': json.dumps(config),
@@ -314,11 +316,9 @@ def map_view_wm_mobile(request, mapid=None, snapshot=None):
     #    map_obj = Map.objects.get(urlsuffix=mapid)
 
     if snapshot is None:
-        config = map_obj.viewer_json(request)
+        config = get_viewer_config(request, map_obj)
     else:
-        config = snapshot_config(snapshot, map_obj, request)
-
-    config = gxp2wm(config, map_obj)
+        config = get_snapshot_viewer_config(request, map_obj, snapshot)
 
     first_visit_mobile = True
     if request.session.get('visit_mobile' + str(map_obj.id), False):
@@ -682,23 +682,18 @@ def map_detail_wm(request, mapid, snapshot=None, template='wm_extra/maps/map_det
     # Update count for popularity ranking,
     # but do not includes admins or resource owners
     if request.user != map_obj.owner and not request.user.is_superuser:
-        Map.objects.filter(
-            id=map_obj.id).update(
-            popular_count=F('popular_count') + 1)
+        stats.record_visit(stats.MAP, map_obj.id, stats.get_visitor(request))
 
     if snapshot is None:
-        config = map_obj.viewer_json(request)
+        config = get_viewer_config(request, map_obj)
     else:
-        config = snapshot_config(snapshot, map_obj, request)
+        config = get_snapshot_viewer_config(request, map_obj, snapshot)
 
-    config = json.dumps(config)
     layers = MapLayer.objects.filter(map=map_obj.id)
     links = map_obj.link_set.download()
 
-    config = gxp2wm(config)
-
     context_dict = {
-        'config': config,
+        'config': json.dumps(config),
         'resource': map_obj,
         'layers': layers,
         'perms_list': get_perms(request.user, map_obj.get_self_resource()),
@@ -748,18 +743,16 @@ def gxp2wm(config, map_obj=None):
     if map_obj:
         config['id'] = map_obj.id
 
-    topics = TopicCategory.objects.all()
-    topicArray = []
-    for topic in topics:
-        topicArray.append([topic.identifier, topic.gn_description])
+    topicArray = get_topic_categories()
     topicArray.append(['General', 'General'])
+    topic_groups = set(topic[1] for topic in topicArray)
     groups = set()
 
     config['topic_categories'] = topicArray
 
     config['proxy'] = '/proxy/?url='
 
-    # TODO check permissions here
+    # replaced by apply_viewer_permissions with the permission of the request user
     config['edit_map'] = True
 
     # 3 different layer types
@@ -784,6 +777,15 @@ def gxp2wm(config, map_obj=None):
     # let's detect WM or HH layers and alter configuration as needed
     bbox = [-180, -90, 180, 90]
     valid_layers = []
+
+    # fetch all the WM local layers of the config at once
+    alternates = []
+    for layer_config in config['map']['layers']:
+        source = config['sources'].get(layer_config.get('source'), {})
+        if 'name' in layer_config and settings.GEOSERVER_PUBLIC_LOCATION in source.get('url', ''):
+            alternates.append(layer_config['name'])
+    config_layers = get_config_layers(alternates)
+
     for layer_config in config['map']['layers']:
         is_valid = True
         is_wm = False
@@ -811,10 +813,8 @@ def gxp2wm(config, map_obj=None):
                 layer_config['local'] = True
                 layer_config['queryable'] = True
                 alternate = layer_config['name']
-                layer = None
-                try:
-                    layer = Layer.objects.get(alternate=alternate)
-                except Layer.DoesNotExist:
+                layer = config_layers.get(alternate)
+                if layer is None:
                     is_valid = False
                     print 'Skipping this layer as it is not existing in GeoNode... %s' % layer_config
                 if layer:
@@ -824,8 +824,9 @@ def gxp2wm(config, map_obj=None):
                         if layer.default_style:
                             layer_config['styles'] = [layer.default_style.name, ]
                         else:
-                            if layer.styles.all().count() > 0:
-                                layer_config['styles'] = [layer.styles.all()[0].name, ]
+                            styles = layer.styles.all()
+                            if styles:
+                                layer_config['styles'] = [styles[0].name, ]
                     else:
                         if isinstance(layer_config['styles'], unicode):
                             try:
@@ -868,7 +869,7 @@ def gxp2wm(config, map_obj=None):
                     (layer_config['detail_url'], layer_config['name'])
                 )
                 layer_config['url'] = hh_url
-            if is_wm or is_hh:
+            if (is_wm and layer) or is_hh:
                 # bbox
                 if is_wm:
                     layer_config['llbbox'] = [float(layer.ll_bbox[0]),
@@ -886,12 +887,9 @@ def gxp2wm(config, map_obj=None):
                 if group not in groups:
                     groups.add(group)
                 # let's make sure the group exists in topicArray (it could be a custom group create from user in GXP)
-                is_in_topicarray = False
-                for cat in topicArray:
-                    if group == cat[1]:
-                        is_in_topicarray = True
-                if not is_in_topicarray:
+                if group not in topic_groups:
                     topicArray.append([group, group])
+                    topic_groups.add(group)
         if is_valid:
             valid_layers.append(layer_config)
 
@@ -918,12 +916,73 @@ def gxp2wm(config, map_obj=None):
     return config
 
 
+def get_viewer_config(request, map_obj):
+    """
+    Return the WorldMap viewer configuration of a map for the request user.
+    The configuration is built without user once per map modification and
+    cached, then the permissions of the user are applied to it.
+    """
+    key = get_viewer_config_key(map_obj.id)
+    cached = cache.get(key)
+    if cached is None:
+        config = gxp2wm(map_obj.viewer_json(None), map_obj)
+        alternates = [layer_config['name'] for layer_config in config['map']['layers'] if layer_config.get('local')]
+        layer_ids = dict(Layer.objects.filter(alternate__in=alternates).values_list('alternate', 'id'))
+        cached = (config, layer_ids)
+        cache.set(key, cached, VIEWER_CONFIG_TTL)
+    config, layer_ids = cached
+    return apply_viewer_permissions(request, map_obj, config, layer_ids)
+
+
+def get_snapshot_viewer_config(request, map_obj, snapshot):
+    """
+    Return the WorldMap viewer configuration of a map snapshot for the request user.
+    """
+    # the hidden layers are disabled by snapshot_config
+    config = gxp2wm(snapshot_config(snapshot, map_obj, request), map_obj)
+    return apply_viewer_permissions(request, map_obj, config, {})
+
+
+def apply_viewer_permissions(request, map_obj, config, layer_ids):
+    """
+    Apply the permissions and the access token of the request user to a viewer configuration.
+    """
+    config['edit_map'] = request.user.has_perm('base.change_resourcebase', obj=map_obj.get_self_resource())
+    disable_hidden_layers(request.user, config, layer_ids)
+
+    access_token = request.session.get('access_token')
+    if access_token:
+        for source in config['sources'].values():
+            url = source.get('url')
+            if url and settings.GEOSERVER_PUBLIC_LOCATION in url and 'access_token' not in url:
+                source['url'] = '%s?access_token=%s' % (url, access_token)
+    return config
+
+
+def disable_hidden_layers(user, config, layer_ids):
+    """
+    Disable the local layers of a configuration the user is not allowed to view.
+    """
+    if not layer_ids:
+        return
+    resources = ResourceBase.objects.filter(id__in=layer_ids.values())
+    visible = set(get_objects_for_user(user, 'base.view_resourcebase', klass=resources)
+                  .values_list('id', flat=True))
+    for layer_config in config['map']['layers']:
+        if layer_config.get('local') and layer_ids.get(layer_config['name']) not in visible:
+            layer_config['disabled'] = True
+            layer_config['visibility'] = False
+
+
 def get_layer_attributes(layer):
     """
     Return a dictionary of attributes for a layer.
     """
     attribute_fields = []
-    attributes = layer.attribute_set.order_by('display_order')
+    # prefetched by get_config_layers
+    attributes = getattr(layer, 'config_attributes', None)
+    if attributes is None:
+        attributes = layer.attribute_set.order_by('display_order')
     for la in attributes:
         searchable = False
         if hasattr(la, 'extlayerattribute'):
@@ -940,6 +999,35 @@ def snapshot_config(snapshot, map_obj, request):
     Get the snapshot map configuration - look up WMS parameters (bunding box)
     for local GeoNode layers
     """
+    decodedid = num_decode(snapshot)
+    snapshot = get_object_or_404(MapSnapshot, pk=decodedid)
+    if snapshot.map_id == map_obj.id:
+        config, layer_ids = get_snapshot_config(snapshot)
+        disable_hidden_layers(request.user, config, layer_ids)
+    else:
+        config = map_obj.viewer_json(request)
+    return config
+
+
+def get_snapshot_config(snapshot):
+    """
+    Return the user independent configuration of a snapshot and the ids of
+    its local layers by name. Snapshots never change, so the configuration
+    is resolved once, when the snapshot is created, and kept in the cache.
+    """
+    key = '{}:{}'.format(SNAPSHOT_CONFIG_PREFIX, snapshot.id)
+    cached = cache.get(key)
+    if cached is None:
+        cached = build_snapshot_config(snapshot)
+        cache.set(key, cached, None)
+    return cached
+
+
+def build_snapshot_config(snapshot):
+    """
+    Resolve the configuration of a snapshot, with the GeoNode layers of all
+    its local layers fetched at once.
+    """
 
     def source_config(maplayer):
         """
@@ -960,7 +1048,7 @@ def snapshot_config(snapshot, map_obj, request):
             cfg["restUrl"] = "/gs/rest"
         return cfg
 
-    def layer_config(maplayer, user):
+    def layer_config(maplayer, gnLayer):
         """
         Generate a dict that can be serialized to a GXP layer configuration
         suitable for loading this layer.
@@ -999,7 +1087,8 @@ def snapshot_config(snapshot, map_obj, request):
         if maplayer.name is not None and maplayer.source_params.find("gxp_gnsource") > -1:
             # Get parameters from GeoNode instead of WMS GetCapabilities
             try:
-                gnLayer = Layer.objects.get(alternate=maplayer.name)
+                if gnLayer is None:
+                    raise Layer.DoesNotExist('Layer matching query does not exist.')
                 if gnLayer.srid:
                     cfg['srs'] = gnLayer.srid
                 if gnLayer.bbox:
@@ -1007,13 +1096,17 @@ def snapshot_config(snapshot, map_obj, request):
                 if gnLayer.llbbox:
                     cfg['llbbox'] = json.loads(gnLayer.llbbox)
                 cfg['attributes'] = (get_layer_attributes(gnLayer))
-                attribute_cfg = gnLayer.attribute_config()
-                if "getFeatureInfo" in attribute_cfg:
-                    cfg["getFeatureInfo"] = attribute_cfg["getFeatureInfo"]
-                cfg['queryable'] = (gnLayer.storeType == 'dataStore'),
-                cfg['disabled'] = user is not None and not user.has_perm('maps.view_layer', obj=gnLayer)
-                # cfg["displayOutsideMaxExtent"] = user is not None and  user.has_perm('maps.change_layer', obj=gnLayer)
-                cfg['visibility'] = cfg['visibility'] and not cfg['disabled']
+                # the getFeatureInfo of Layer.attribute_config, from the prefetched attributes
+                visible = [attribute for attribute in gnLayer.config_attributes if attribute.visible]
+                if visible:
+                    cfg["getFeatureInfo"] = {
+                        "fields": [attribute.attribute for attribute in visible],
+                        "propertyNames": dict((attribute.attribute, attribute.attribute_label)
+                                              for attribute in visible)
+                    }
+                cfg['queryable'] = (gnLayer.storeType == 'dataStore')
+                # disabled for the users not allowed to view the layer by disable_hidden_layers
+                cfg['disabled'] = False
                 cfg['abstract'] = gnLayer.abstract
                 cfg['styles'] = maplayer.styles
                 cfg['local'] = True
@@ -1022,7 +1115,7 @@ def snapshot_config(snapshot, map_obj, request):
                 cfg['srs'] = 'EPSG:900913'
                 cfg['llbbox'] = [-180, -90, 180, 90]
                 cfg['attributes'] = []
-                cfg['queryable'] = False,
+                cfg['queryable'] = False
                 cfg['disabled'] = False
                 cfg['visibility'] = cfg['visibility'] and not cfg['disabled']
                 cfg['abstract'] = ''
@@ -1035,20 +1128,12 @@ def snapshot_config(snapshot, map_obj, request):
 
         return cfg
 
-    # Match up the layer with it's source
-    def snapsource_lookup(source, sources):
-        for k, v in sources.items():
-            if v.get("id") == source.get("id"):
-                return k
-        return None
-
     # Set up the proper layer configuration
-    # def snaplayer_config(layer, sources, user):
-    def snaplayer_config(layer, sources, request):
-        user = request.user if request else None
-        cfg = layer_config(layer, user)
+    def snaplayer_config(layer, source_keys, gnLayer):
+        cfg = layer_config(layer, gnLayer)
         src_cfg = source_config(layer)
-        source = snapsource_lookup(src_cfg, sources)
+        # Match up the layer with it's source
+        source = source_keys.get(src_cfg.get("id"))
         if source:
             cfg["source"] = source
         if src_cfg.get(
@@ -1059,35 +1144,32 @@ def snapshot_config(snapshot, map_obj, request):
             cfg["buffer"] = 0
         return cfg
 
-    from geonode.utils import num_decode
-    from geonode.utils import layer_from_viewer_config
-    decodedid = num_decode(snapshot)
-    snapshot = get_object_or_404(MapSnapshot, pk=decodedid)
-    if snapshot.map == map_obj.map:
-        config = json.loads(clean_config(snapshot.config))
-        layers = [l for l in config["map"]["layers"]]
-        sources = config["sources"]
-        maplayers = []
-        for ordering, layer in enumerate(layers):
-            maplayers.append(
-                layer_from_viewer_config(
-                    map_obj.id,
-                    MapLayer,
-                    layer,
-                    config["sources"][
-                        layer["source"]],
-                    ordering,
-                    False))
-#             map_obj.map.layer_set.from_viewer_config(
-# map_obj, layer, config["sources"][layer["source"]], ordering))
-        config['map']['layers'] = [
-            snaplayer_config(
-                l,
-                sources,
-                request) for l in maplayers]
-    else:
-        config = map_obj.viewer_json(request)
-    return config
+    config = json.loads(clean_config(snapshot.config))
+    layers = [l for l in config["map"]["layers"]]
+    sources = config["sources"]
+    source_keys = {}
+    for k, v in sources.items():
+        source_keys.setdefault(v.get("id"), k)
+    maplayers = []
+    for ordering, layer in enumerate(layers):
+        maplayers.append(
+            layer_from_viewer_config(
+                snapshot.map_id,
+                MapLayer,
+                layer,
+                config["sources"][
+                    layer["source"]],
+                ordering,
+                False))
+    gn_layers = get_config_layers([l.name for l in maplayers
+                                   if l.name is not None and l.source_params.find("gxp_gnsource") > -1])
+    config['map']['layers'] = [
+        snaplayer_config(
+            l,
+            source_keys,
+            gn_layers.get(l.name)) for l in maplayers]
+    layer_ids = dict((alternate, layer.id) for alternate, layer in gn_layers.items())
+    return (config, layer_ids)
 
 
 def printmap(request, mapid=None, snapshot=None):